@@ -4,48 +4,206 @@ API
 Main app
 """
 
+import signal
+import asyncio
+import logging
+from collections.abc import Mapping
+
 import asyncpg
 from aiohttp import web
 import aioredis
+from config import ConfigError
+from lib.proxies.pool import ProxyPool
+from lib.proxies.catalog import ProxyCatalog
+from lib.proxies.prewarm import PoolPrewarmer
+from lib.proxies.tor import TorController
+from lib.hasher import PasswordHasher
+from lib.serializer import set_encoder
+from lib.proxies.strategies import STRATEGIES
+from lib.proxies.strategies import get_strategy
+from lib.proxies.scripts import register_scripts
 from api.routes import init_routes
+from api.handlers.proxy_list import get_target_proxies
 from api.auth import apikey_middleware
 from api.auth import basicauth_token_middleware
+from api.auth import init_auth
+
+
+# Integer keys of the reloadable sections: (section, key) => required
+INTEGER_KEYS = {
+    ('pool', 'length'): True,
+    ('pool', 'lease_ttl'): False,
+    ('pool', 'max_lease_ttl'): False,
+    ('pool', 'rotation_ttl'): False,
+    ('pool', 'session_ttl'): False,
+}
+
+
+def validate_config(config):
+    '''Raise ConfigError if the config is not valid
+    It is checked before a reload is applied: the reloadable sections must be complete'''
+    for section in ('api', 'pool'):
+        if not isinstance(config.get(section), Mapping):
+            raise ConfigError('The [{}] section is missing'.format(section))
+    for (section, key), required in INTEGER_KEYS.items():
+        value = config[section].get(key)
+        if value is None:
+            if required:
+                raise ConfigError('The {}.{} key is missing'.format(section, key))
+        elif isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ConfigError('Not valid {}.{} (a positive integer): {!r}'.format(
+                section, key, value))
+    pool_mode = config['pool'].get('mode', 'batched')
+    if pool_mode not in ProxyPool.load_modes:
+        raise ConfigError('Not valid pool mode: {}'.format(pool_mode))
+    pool_strategy = config['pool'].get('strategy', 'random')
+    if pool_strategy not in STRATEGIES:
+        raise ConfigError('Not valid pool strategy: {}'.format(pool_strategy))
+    pool_refill = config['pool'].get('refill', 'reset')
+    if pool_refill not in ProxyPool.refill_policies:
+        raise ConfigError('Not valid pool refill policy: {}'.format(pool_refill))
+    if not isinstance(config['api'].get('api_key'), str):
+        raise ConfigError('The API key is missing')
+
+
+def reload_config(app):
+    '''Reload the config (SIGHUP)'''
+    app['config'].reload(validate=validate_config)
+
+
+async def watch_config(app, interval: float):
+    '''Reload the config when the config file changes'''
+    while True:
+        await asyncio.sleep(interval)
+        if app['config'].changed():
+            reload_config(app)
+
+
+async def start_config_reload(app):
+    '''Reload the config on SIGHUP and when the config file changes (optional)'''
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload_config, app)
+    interval = app['config'].get('server', {}).get('config_watch_interval', 0)
+    if interval:
+        app['config_watcher'] = asyncio.ensure_future(watch_config(app, interval))
+
+
+async def stop_config_reload(app):
+    '''Stop reloading the config'''
+    asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+    if 'config_watcher' in app:
+        app['config_watcher'].cancel()
+
 
+async def close_catalog(app):
+    '''Stop listening for proxy catalog changes'''
+    await app['catalog'].close()
 
-def load_api_keys(app, config):
-    '''Load the API Keys from config'''
-    # Main API Key
-    app['api_key'] = config['api']['api_key']
-    # Methods API Keys
-    for method in ('get', 'post', 'put', 'delete'):
-        api_key_k = '{}_api_key'.format(method)
-        if api_key_k in config['api']:
-            app[api_key_k] = config['api'][api_key_k]
+
+async def close_hasher(app):
+    '''Shut down the password hasher process pool'''
+    app['hasher'].close()
+
+
+async def close_tor(app):
+    '''Close the Tor control connections'''
+    await app['tor'].close()
+
+
+async def start_prewarmer(app):
+    '''Start refilling the proxy pool buffers'''
+    await app['prewarmer'].start()
+
+
+async def close_prewarmer(app):
+    '''Stop refilling the proxy pool buffers'''
+    await app['prewarmer'].close()
+
+
+def init_prewarmer(app, config):
+    '''Create the proxy pool prewarmer (optional)
+    It is not used in the lease mode: the leases would start before the requests'''
+    prewarm_config = config.get('prewarm', {})
+    if not prewarm_config.get('enabled', False):
+        return
+    pool_mode = config['pool'].get('mode', 'batched')
+    if pool_mode == 'lease':
+        logging.warning('Proxy pool prewarming is not available in the lease mode')
+        return
+    app['prewarmer'] = PoolPrewarmer(
+        lambda target_identifier, codes: get_target_proxies(app, target_identifier, codes),
+        app['redis'], mode=pool_mode,
+        strategy_factory=lambda: get_strategy(app['config']['pool'].get('strategy', 'random')),
+        refill=lambda: app['config']['pool'].get('refill', 'reset'),
+        lease_ttl=lambda: app['config']['pool'].get('lease_ttl', 300),
+        interval=prewarm_config.get('interval', 1.0),
+        min_rate=prewarm_config.get('min_rate', 1.0),
+        max_age=prewarm_config.get('max_age', 30.0),
+        max_pools=prewarm_config.get('max_pools', 10))
+    app.on_startup.append(start_prewarmer)
+    app.on_cleanup.append(close_prewarmer)
 
 
 async def init_app(loop, config):
-    '''Init aiohttp app'''
+    '''Init aiohttp app
+    @param config: the config (see config.py). It is reloaded on SIGHUP'''
+    validate_config(config)
     auth_method = config['api'].get('auth_method', 'key')  # Default auth method is `key`
     if auth_method == 'key':
         app = web.Application(middlewares=[apikey_middleware])
-        load_api_keys(app, config)
     elif auth_method == 'token':
         app = web.Application(middlewares=[basicauth_token_middleware])
     else:
         app = web.Application()  # Authentication disabled
 
+    # JSON encoder of the responses
+    try:
+        set_encoder(config.get('server', {}).get('json_encoder', 'json'))
+    except ValueError as err:
+        raise ConfigError(str(err))
+
     app['config'] = config
+    app.on_startup.append(start_config_reload)
+    app.on_cleanup.append(stop_config_reload)
+    init_auth(app, config)
+    if auth_method == 'token':
+        # Password hashes run in a process pool
+        app['hasher'] = PasswordHasher(
+            max_workers=config['security'].get('hasher_workers', 2),
+            max_pending=config['security'].get('hasher_max_pending', 100))
+        app.on_cleanup.append(close_hasher)
 
     # Create a database connection pool
     app['pool'] = await asyncpg.create_pool(
         config['database']['postgres']['uri'],
         min_size=config['database']['postgres']['pool_min'],
-        max_size=config['database']['postgres']['pool_max'])
+        max_size=config['database']['postgres']['pool_max'],
+        statement_cache_size=config['database']['postgres'].get('statement_cache_size', 100))
     app['redis'] = await aioredis.create_redis_pool(
         config['database']['redis']['uri'],
         minsize=config['database']['redis']['pool_min'],
         maxsize=config['database']['redis']['pool_max'],
         loop=loop)
+    await register_scripts(app['redis'])
+
+    # In memory proxy catalog (optional)
+    catalog_config = config.get('catalog', {})
+    if catalog_config.get('enabled', False):
+        app['catalog'] = ProxyCatalog(app['pool'], config['database']['postgres']['uri'],
+                                      reload_interval=catalog_config.get('reload_interval', 0))
+        await app['catalog'].start()
+        app.on_cleanup.append(close_catalog)
+
+    # Tor identity renewal of the blocked Tor proxies
+    tor_config = config.get('tor', {})
+    if tor_config.get('enabled', True):
+        app['tor'] = TorController(min_interval=tor_config.get('min_interval', 10.0),
+                                   timeout=tor_config.get('timeout', 5.0),
+                                   renew_timeout=tor_config.get('renew_timeout', 5.0))
+        app.on_cleanup.append(close_tor)
+
+    # Proxy pool prewarming (optional)
+    init_prewarmer(app, config)
 
     init_routes(app)
 
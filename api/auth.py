@@ -3,26 +3,100 @@ API authentication
 
 - API Key
 - Basic-Auth & Token
+
+The token serializer is built once and held on the app (app['auth']) with
+a cache of the valid tokens and a short lived cache of the verified credentials
+so the password hash is checked once per `credentials_ttl` seconds
+The verified credentials are cached with the stored password hash: a password change
+or a removed user takes effect right away (the user is still read on every request)
 """
 
+import hmac
+import time
+import hashlib
+
 from itsdangerous import SignatureExpired
 from itsdangerous import BadSignature
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 
 from aiohttp import web
 from aiohttp import hdrs
 from aiohttp import BasicAuth
 
+from api.handlers.base import json_response
 from api.models.user import UserDB
+from lib.cache import TTLCache
+from lib.hasher import HasherBusyError
 
 
 FORBIDDEN_MESSAGE = 'forbidden'
 
 
+class TokenAuth:
+    '''Token serializer and authentication caches shared by all the requests'''
+
+    def __init__(self, secret_key: str, token_expires_in: int, cache_size: int = 10000,
+                 credentials_ttl: float = 60):
+        '''
+        @param secret_key: the key the tokens are signed with
+        @param token_expires_in: seconds a token is valid
+        @param cache_size: max number of tokens and credentials cached
+        @param credentials_ttl: seconds the verified credentials are cached (0: disabled)'''
+        self.secret_key = secret_key.encode('utf-8')
+        self.serializer = Serializer(secret_key, expires_in=token_expires_in)
+        self.tokens = TTLCache(cache_size)
+        self.credentials = TTLCache(cache_size, ttl=credentials_ttl)
+
+    def load_token(self, token: str):
+        '''Return the token data if the token is valid
+        A valid token is cached until it expires
+        Raise SignatureExpired or BadSignature if it is not valid'''
+        data = self.tokens.get(token)
+        if data is None:
+            data, header = self.serializer.loads(token, return_header=True)
+            self.tokens.set(token, data, ttl=header['exp'] - time.time())
+        return data
+
+    def dump_token(self, data: dict):
+        '''Return a new token with the data'''
+        return self.serializer.dumps(data)
+
+    def _credentials_key(self, username: str, password: str, password_hash: str):
+        # The passwords are not kept in memory, just a keyed digest
+        message = '{}\0{}\0{}'.format(username, password, password_hash).encode('utf-8')
+        return hmac.new(self.secret_key, message, hashlib.sha256).digest()
+
+    def is_verified(self, username: str, password: str, password_hash: str):
+        '''Return True if the credentials were verified recently against the stored hash'''
+        return self.credentials.get(self._credentials_key(username, password, password_hash),
+                                    False)
+
+    def set_verified(self, username: str, password: str, password_hash: str):
+        '''Cache the credentials verified against the stored hash'''
+        self.credentials.set(self._credentials_key(username, password, password_hash), True)
+
+
+def init_auth(app, config):
+    '''Hold the token serializer and the authentication caches on the app'''
+    security_config = config['security']
+    app['auth'] = TokenAuth(security_config['secret_key'],
+                            security_config['token_expires_in'],
+                            cache_size=security_config.get('auth_cache_size', 10000),
+                            credentials_ttl=security_config.get('credentials_ttl', 60))
+
+
 async def get_403_response(message=FORBIDDEN_MESSAGE):
     '''GET 403 Unauthorized response'''
-    return web.json_response({'message': message,
-                              'data': {},
-                              'status': 'forbidden'}, status=403)
+    return json_response({'message': message,
+                          'data': {},
+                          'status': 'forbidden'}, status=403)
+
+
+async def get_503_response(message):
+    '''GET 503 Service Unavailable response'''
+    return json_response({'message': message,
+                          'data': {},
+                          'status': 'unavailable'}, status=503)
 
 
 def parse_auth_header(request):
@@ -42,7 +116,9 @@ async def apikey_middleware(request, handler):
     '''API api-key authentication aiohttp middleware'''
     api_key = request.query.get('api_key', None)
     api_key_method = '{}_api_key'.format(request.method.lower())
-    app_api_key = request.app.get(api_key_method, request.app['api_key'])
+    # Main API Key or the method API Key. They are read from the config (reloadable)
+    api_config = request.app['config']['api']
+    app_api_key = api_config.get(api_key_method, api_config['api_key'])
     if api_key is None or api_key != app_api_key:
         return await get_403_response()
     return await handler(request)
@@ -68,7 +144,10 @@ async def basicauth_token_middleware(request, handler):
     except SignatureExpired:
         message = 'Token expired'
     except BadSignature:
-        authenticated = await user_db.verify_identity(auth_h.login, auth_h.password)
+        try:
+            authenticated = await user_db.verify_identity(auth_h.login, auth_h.password)
+        except HasherBusyError as err:
+            return await get_503_response(str(err))
 
     if not authenticated:
         return await get_403_response(message)
@@ -6,45 +6,32 @@ PUT: put_handler
 DELETE: delete_handler
 """
 
-import json
 import datetime
 from aiohttp import web
+from lib.serializer import dumps
 
 
-DEFAULT_DATE_FORMAT = '%Y-%m-%d'
-DEFAULT_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
-
-
-def parse_datetime(content):
-    '''Parse a date or datetime object and return a string'''
-    if isinstance(content, datetime.datetime):
-        return content.strftime(DEFAULT_DATETIME_FORMAT)
-    if isinstance(content, datetime.date):
-        return content.strftime(DEFAULT_DATE_FORMAT)
-    return content
-
-
-def custom_dumps(content):
-    '''Custom JSON dumps including a parse date/datetime function'''
-    return json.dumps(content, default=parse_datetime)
+def json_response(data, status=200):
+    '''Return a JSON response encoded with the current JSON encoder (see lib/serializer.py)'''
+    return web.Response(body=dumps(data), status=status, content_type='application/json')
 
 
 def get_404_response():
     '''Default 404 response'''
-    return web.json_response({'message': 'Not found',
-                              'data': {},
-                              'status': 'unknown'}, status=404)
+    return json_response({'message': 'Not found',
+                          'data': {},
+                          'status': 'unknown'}, status=404)
 
 
 def get_value(key, value):
     """It detects if it's a special key (ie: date or time)
-    In that case it converts the value to the proper type
+    In that case it converts the value (ISO 8601) to the proper type
     It returns the value without previous formating in other case"""
     if value is not None:
         if field_is_a_date(key):
-            return datetime.datetime.strptime(value, DEFAULT_DATE_FORMAT).date()
+            return datetime.date.fromisoformat(value)
         if field_is_a_datetime(key):
-            return datetime.datetime.strptime(value, DEFAULT_DATETIME_FORMAT)
+            return datetime.datetime.fromisoformat(value)
     return value
 
 
@@ -98,11 +85,10 @@ def get_base_get(db_model, *where, extra=None):
             result = [dict(r) for r in rows]
             total_c = await model_db.count(*where_query)
             total = total_c['count']
-        return web.json_response({'message': 'All OK',
-                                  'data': result,
-                                  'total': total,
-                                  'status': 'success'}, status=200,
-                                 dumps=custom_dumps)
+        return json_response({'message': 'All OK',
+                              'data': result,
+                              'total': total,
+                              'status': 'success'}, status=200)
     return get_handler
 
 
@@ -119,14 +105,13 @@ def get_base_post(db_model):
                 try:
                     values.append(get_value(key, value))
                 except ValueError as err:
-                    return web.json_response({'message': str(err),
-                                              'data': None,
-                                              'status': 'client error'}, status=400)
+                    return json_response({'message': str(err),
+                                          'data': None,
+                                          'status': 'client error'}, status=400)
             result = await model_db.insert(','.join(columns), *[tuple(values)])
-            return web.json_response({'message': 'All OK',
-                                      'data': {'id': result},
-                                      'status': 'success'}, status=201,
-                                     dumps=custom_dumps)
+            return json_response({'message': 'All OK',
+                                  'data': {'id': result},
+                                  'status': 'success'}, status=201)
         return get_404_response()
     return post_handler
 
@@ -146,17 +131,16 @@ def get_base_put(db_model):
                     try:
                         values.append(get_value(key, value))
                     except ValueError as err:
-                        return web.json_response({'message': str(err),
-                                                  'data': None,
-                                                  'status': 'client error'}, status=400)
+                        return json_response({'message': str(err),
+                                              'data': None,
+                                              'status': 'client error'}, status=400)
                 where_query = [('id', '=', int(model_id)), ]
                 result = await model_db.update(','.join(columns),
                                                tuple(values),
                                                *where_query)
-                return web.json_response({'message': 'All OK',
-                                          'data': dict(result),
-                                          'status': 'success'}, status=200,
-                                         dumps=custom_dumps)
+                return json_response({'message': 'All OK',
+                                      'data': dict(result),
+                                      'status': 'success'}, status=200)
         return get_404_response()
     return put_handler
 
@@ -169,9 +153,8 @@ def get_base_delete(db_model):
             model_db = db_model(request.app)
             where_query = [('id', '=', int(model_id)), ]
             result = await model_db.delete(*where_query)
-            return web.json_response({'message': 'All OK',
-                                      'data': dict(result),
-                                      'status': 'success'}, status=200,
-                                     dumps=custom_dumps)
+            return json_response({'message': 'All OK',
+                                  'data': dict(result),
+                                  'status': 'success'}, status=200)
         return get_404_response()
     return delete_handler
@@ -0,0 +1,134 @@
+"""
+Proxy feedback
+
+Clients report the outcome of the requests made with the proxies of a target:
+
+POST /proxy_feedback/{tid}
+{"outcomes": [{"proxy_id": 1, "outcome": "success", "latency": 350},
+              {"proxy_id": 2, "outcome": "ban"}]}
+
+Outcomes: success, ban, timeout, error
+Banned proxies are set as blocked. The outcomes feed the weighted proxy selection
+The identity of the banned Tor proxies with identity renewal is renewed instead
+
+GET /proxy_feedback/{tid} returns the stats of every proxy of the target
+"""
+
+import math
+
+from api.handlers.base import json_response
+from api.models.proxy import ProxyDB
+from api.models.target import TargetDB
+from lib.proxies.pool import ProxyPool
+
+
+def get_400_response(message):
+    '''Client error response'''
+    return json_response({'message': message,
+                          'data': None,
+                          'status': 'client error'}, status=400)
+
+
+def get_target_404_response(target_identifier):
+    '''Target not found response'''
+    return json_response({
+        'message': 'Target "{}" does not exist'.format(target_identifier),
+        'data': {},
+        'status': 'not found'}, status=404)
+
+
+async def get_target_data(request, target_identifier: str):
+    '''Return the target data given its identifier or None'''
+    if 'catalog' in request.app:
+        return request.app['catalog'].get_target(target_identifier)
+    target_db = TargetDB(request.app)
+    return await target_db.select_one(*[('identifier', '=', target_identifier)])
+
+
+def parse_outcomes(params):
+    '''Return the list of outcome tuples <proxy ID>, <outcome>, <latency> given the POST data
+    Raise ValueError if any of them is not valid'''
+    if not isinstance(params, dict) or not isinstance(params.get('outcomes', []), list):
+        raise ValueError('Not valid data: a list of outcomes is expected')
+    outcomes = []
+    for outcome in params.get('outcomes', []):
+        if not isinstance(outcome, dict):
+            raise ValueError('Not valid outcome: {}'.format(outcome))
+        if outcome.get('outcome') not in ProxyPool.outcomes:
+            raise ValueError('Not valid outcome: {}'.format(outcome.get('outcome')))
+        latency = outcome.get('latency')
+        if latency is not None:
+            latency = float(latency)
+            if not math.isfinite(latency):
+                raise ValueError('Not valid latency: {}'.format(latency))
+        outcomes.append((int(outcome['proxy_id']), outcome['outcome'], latency))
+    return outcomes
+
+
+async def renew_tor_identities(app, proxy_ids, proxies=()):
+    '''Renew the identity of the Tor proxies (with identity renewal) among the proxy IDs
+    @param proxies: proxy objects already read. The rest are read from the proxy catalog
+    or the database
+    @return: set of IDs of the proxies renewed'''
+    if 'tor' not in app or not proxy_ids:
+        return set()
+    proxy_ids = set(proxy_ids)
+    proxy_map = {proxy['id']: proxy for proxy in proxies if proxy['id'] in proxy_ids}
+    missing_ids = proxy_ids - set(proxy_map)
+    if missing_ids:
+        if 'catalog' in app:
+            proxy_map.update({pid: app['catalog'].proxies[pid] for pid in missing_ids
+                              if pid in app['catalog'].proxies})
+        else:
+            proxy_db = ProxyDB(app)
+            rows = await proxy_db.select(*[('id', 'in', sorted(missing_ids)),
+                                           ('tor_renew_identity', '=', True)])
+            proxy_map.update({row['id']: dict(row) for row in rows})
+    return await app['tor'].renew_list(*proxy_map.values())
+
+
+def get_proxy_pool(request, target_data):
+    '''Return the proxy pool of the target. It is only used to access its state'''
+    return ProxyPool(pool_id=str(target_data['id']), pool_len=0,
+                     standby_mins=target_data['blocked_standby'],
+                     redis=request.app['redis'])
+
+
+async def post_handler(request):
+    '''POST the outcomes of some proxy requests'''
+    target_identifier = request.match_info.get('tid')
+    target_data = await get_target_data(request, target_identifier)
+    if target_data is None:
+        return get_target_404_response(target_identifier)
+    params = await request.json()
+    try:
+        outcomes = parse_outcomes(params)
+    except (KeyError, TypeError, ValueError) as err:
+        return get_400_response(str(err))
+    proxy_pool = get_proxy_pool(request, target_data)
+    await proxy_pool.record_outcomes(*outcomes)
+    banned_ids = {pid for pid, outcome, _ in outcomes if outcome == 'ban'}
+    banned_ids -= await renew_tor_identities(request.app, banned_ids)
+    if banned_ids:
+        await proxy_pool.set_as_blocked_list(*banned_ids)
+        if 'prewarmer' in request.app:
+            request.app['prewarmer'].discard(target_data['id'], banned_ids)
+    return json_response({'message': 'All OK',
+                          'data': {'target_id': target_data['id'],
+                                   'outcomes': len(outcomes)},
+                          'status': 'success'}, status=200)
+
+
+async def get_handler(request):
+    '''GET the stats of every proxy of the target'''
+    target_identifier = request.match_info.get('tid')
+    target_data = await get_target_data(request, target_identifier)
+    if target_data is None:
+        return get_target_404_response(target_identifier)
+    proxy_pool = get_proxy_pool(request, target_data)
+    stats = await proxy_pool.get_stats()
+    return json_response({'message': 'All OK',
+                          'data': {'target_id': target_data['id'],
+                                   'proxies': stats},
+                          'total': len(stats),
+                          'status': 'success'}, status=200)
@@ -0,0 +1,54 @@
+"""
+Proxy leases
+
+In the `lease` pool mode every proxy returned by the proxy list is leased for some
+seconds and it is not returned again until the lease expires or it is released:
+
+DELETE /proxy_lease/{tid}?ids=1|2|3
+"""
+
+from api.handlers.base import json_response
+from api.handlers.proxy_feedback import get_400_response
+from api.handlers.proxy_feedback import get_target_404_response
+from api.handlers.proxy_feedback import get_target_data
+from api.handlers.proxy_feedback import get_proxy_pool
+
+
+def get_proxy_ids(request):
+    '''Read the request.query data and returns the proxy IDs presents there
+    Raise ValueError if any of them is not valid'''
+    ids_str = request.query.get('ids', '')
+    return [int(p_id.strip()) for p_id in ids_str.split('|') if p_id.strip()]
+
+
+async def delete_handler(request):
+    '''Release the leases of some proxies'''
+    target_identifier = request.match_info.get('tid')
+    target_data = await get_target_data(request, target_identifier)
+    if target_data is None:
+        return get_target_404_response(target_identifier)
+    try:
+        proxy_ids = get_proxy_ids(request)
+    except ValueError as err:
+        return get_400_response(str(err))
+    proxy_pool = get_proxy_pool(request, target_data)
+    await proxy_pool.release(*proxy_ids)
+    return json_response({'message': 'All OK',
+                          'data': {'target_id': target_data['id'],
+                                   'released': len(proxy_ids)},
+                          'status': 'success'}, status=200)
+
+
+async def get_handler(request):
+    '''GET the proxy IDs leased right now'''
+    target_identifier = request.match_info.get('tid')
+    target_data = await get_target_data(request, target_identifier)
+    if target_data is None:
+        return get_target_404_response(target_identifier)
+    proxy_pool = get_proxy_pool(request, target_data)
+    leased_ids = sorted(await proxy_pool.get_leased_ids())
+    return json_response({'message': 'All OK',
+                          'data': {'target_id': target_data['id'],
+                                   'proxy_ids': leased_ids},
+                          'total': len(leased_ids),
+                          'status': 'success'}, status=200)
@@ -11,87 +11,21 @@ The parameters could be:
 - Providers
 - Profile
 - Proxy type (http, tor, backconnect, residential)
+- Lease TTL in seconds (lease pool mode)
+- Session: the same proxy is returned for the same session key until it gets blocked
+
+The identity of the blocked Tor proxies with identity renewal is renewed instead of blocking them
 
 Some targets may not have permission to use some providers and plans
 """
 
-from aiohttp import web
-from api.models.target import TargetDB
-from api.models.target_provider import TargetProviderDB
-from api.models.target_provider_plan import TargetProviderPlanDB
+from api.handlers.base import json_response
+from api.handlers.proxy_feedback import renew_tor_identities
+from api.handlers.proxy_feedback import get_400_response
 from api.models.proxy import ProxyDB
-from api.models.proxy_location import ProxyLocationDB
-from api.models.proxy_type import ProxyTypeDB
-from api.models.provider import ProviderDB
-from api.models.provider_plan import ProviderPlanDB
 from lib.proxies.pool import ProxyPool
-
-
-async def get_target_id_from_identifier(request, identifier: str):
-    '''Given a Target identifier it returns the value if the ID in the database'''
-    target_db = TargetDB(request.app)
-    target_id = await target_db.select_val(*[('identifier', '=', identifier)], columns='id')
-    return target_id
-
-
-async def get_db_element_id_from_code(request, model_db, code):
-    '''Return an ID from a given code
-    @param request: the aiohttp request
-    @param model_db: a DBModel class
-    @param code: a string with the unique element code
-    @return: an integer with the element ID or None'''
-    model_inst = model_db(request.app)
-    elem_id = await model_inst.select_val(*[('code', '=', code)], columns='id')
-    return elem_id
-
-
-async def add_filter_if_not_none(request, model_db, filter_in, filter_out, where):
-    '''If the ID exists in database the filter will be added to the where query
-    The filter uses the `code` of the element. A unique "code" to use so it does not use the actual
-    element ID. So, it needs to make a query to get the actual ID using that element code
-    Then, the query is added to the where list to filter the proxy list by the related element ID
-    @param request: the aiohttp request
-    @param model_db: the DBModel class. Where to get the id from
-    @param filter_in: string with the key in the request.query dict
-    @param filter_out: string with the column name of the relationship in the `proxies` table
-    @param where: reference to the where list with the queries'''
-    elem_code = request.query.get(filter_in)
-    if elem_code is not None:
-        elem_id = await get_db_element_id_from_code(request, model_db, elem_code)
-        if elem_id is not None:
-            where.append((filter_out, '=', elem_id))
-
-
-async def add_proxy_filter_to_where(request, where):
-    '''Given a query it will complete the where query passed as reference
-    Query:
-    - loc: Location
-    - type: Proxy Type
-    - prov: Provider
-    - plan: Provider Plan'''
-    await add_filter_if_not_none(request, ProxyLocationDB, 'loc', 'proxy_location_id', where)
-    await add_filter_if_not_none(request, ProxyTypeDB, 'type', 'proxy_type_id', where)
-    await add_filter_if_not_none(request, ProviderDB, 'prov', 'provider_id', where)
-    await add_filter_if_not_none(request, ProviderPlanDB, 'plan', 'provider_plan_id', where)
-
-
-async def add_target_constraints_to_where(request, target_id, where):
-    '''Add the providers and plans to the where query'''
-    await add_target_restriction_to_where(request, target_id, where,
-                                          column_name='provider_id',
-                                          model_db=TargetProviderDB)
-    await add_target_restriction_to_where(request, target_id, where,
-                                          column_name='provider_plan_id',
-                                          model_db=TargetProviderPlanDB)
-
-
-async def add_target_restriction_to_where(request, target_id, where, column_name, model_db):
-    '''Check if there are any restrictions for the Target given a model
-    Add them to the where if any'''
-    model_inst = model_db(request.app)
-    results = await model_inst.select(*[('target_id', '=', int(target_id))], columns=column_name)
-    if results:
-        where.append((column_name, 'in', [row[column_name] for row in results]))
+from lib.proxies.backconnect import expand_virtual_slots
+from lib.proxies.strategies import get_strategy
 
 
 def get_blocked_proxy_ids(request):
@@ -103,43 +37,123 @@ def get_blocked_proxy_ids(request):
     return blocked_ids
 
 
-async def get_target_data(request, target_id: int):
-    '''It returns the data in database for the Target with ID <target_id>'''
-    target_db = TargetDB(request.app)
-    target_data = await target_db.select_one(*[('id', '=', target_id)])
-    return target_data
+def get_lease_ttl(request, pool_config):
+    '''Return the lease TTL in the query (seconds) or the default one (`pool.lease_ttl`)
+    Raise ValueError if it is not an integer between 1 and `pool.max_lease_ttl`'''
+    lease = request.query.get('lease')
+    if lease is None:
+        return pool_config.get('lease_ttl', 300)
+    max_lease_ttl = pool_config.get('max_lease_ttl', 3600)
+    try:
+        lease_ttl = int(lease)
+    except ValueError:
+        raise ValueError('Not valid lease: {}'.format(lease))
+    if not 1 <= lease_ttl <= max_lease_ttl:
+        raise ValueError('The lease must be between 1 and {} seconds'.format(max_lease_ttl))
+    return lease_ttl
+
+
+def get_query_codes(request):
+    '''Return the filter codes in the query
+    - loc: Location
+    - type: Proxy Type
+    - prov: Provider
+    - plan: Provider Plan'''
+    return {key: request.query.get(key) for key in ('loc', 'type', 'prov', 'plan')}
+
+
+async def get_proxies_from_db(app, target_identifier: str, codes: dict):
+    '''Return the target data and all the proxies filtered by the codes
+    and allowed for this target. The target data is None if the target does not exist'''
+    proxy_db = ProxyDB(app)
+    return await proxy_db.select_for_target(target_identifier,
+                                            location=codes.get('loc'),
+                                            proxy_type=codes.get('type'),
+                                            provider=codes.get('prov'),
+                                            plan=codes.get('plan'))
+
+
+def get_proxies_from_catalog(app, target_identifier: str, codes: dict):
+    '''Same as `get_proxies_from_db` but using the in memory proxy catalog'''
+    catalog = app['catalog']
+    target_data = catalog.get_target(target_identifier)
+    if target_data is None:
+        return None, []
+    all_proxies = catalog.select(target_data['id'], **codes)
+    return target_data, all_proxies
+
+
+async def get_target_proxies(app, target_identifier: str, codes: dict):
+    '''Return the target data and all the proxies filtered by the codes
+    from the proxy catalog if it is enabled or from the database
+    The proxies with virtual slots are expanded (see lib/proxies/backconnect.py)'''
+    if 'catalog' in app:
+        target_data, all_proxies = get_proxies_from_catalog(app, target_identifier, codes)
+    else:
+        target_data, all_proxies = await get_proxies_from_db(app, target_identifier, codes)
+    return target_data, expand_virtual_slots(all_proxies)
+
+
+def get_pool_response(target_id: int, pool: list):
+    '''Proxy list response'''
+    return json_response({'message': 'All OK',
+                          'data': {
+                              'target_id': target_id,
+                              'pool': pool},
+                          'total': len(pool),
+                          'status': 'success'}, status=200)
 
 
 async def get_handler(request):
     '''Main get handler'''
     config = request.app['config']
     target_identifier = request.match_info.get('tid')
-    target_id = await get_target_id_from_identifier(request, target_identifier)
-    if target_id is None:
-        return web.json_response({
+    codes = get_query_codes(request)
+    pool_length = int(request.query.get('len', config['pool']['length']))  # List length
+    session = request.query.get('session')  # Sticky session key
+    blocked_ids = get_blocked_proxy_ids(request) # Blocked proxies to be added
+    try:
+        lease_ttl = get_lease_ttl(request, config['pool'])
+    except ValueError as err:
+        return get_400_response(str(err))
+    prewarm = 'prewarmer' in request.app and session is None and not blocked_ids
+    if prewarm:
+        # Proxies already selected in background
+        prewarmed = request.app['prewarmer'].take(target_identifier, codes, pool_length)
+        if prewarmed is not None:
+            return get_pool_response(*prewarmed)
+    target_data, all_proxies = await get_target_proxies(request.app, target_identifier, codes)
+    if target_data is None:
+        return json_response({
             'message': 'Target "{}" does not exist'.format(target_identifier),
             'data': {},
             'status': 'not found'}, status=404)
-    target_data = await get_target_data(request, target_id)  # Target DB data
-    pool_length = int(request.query.get('len', config['pool']['length']))  # List length
-    blocked_ids = get_blocked_proxy_ids(request) # Blocked proxies to be added
-    where = [] # Where query to filter proxy results
-    await add_proxy_filter_to_where(request, where) # Basic proxy filter
-    await add_target_constraints_to_where(request, target_id, where) # Target constraints
-    proxy_db = ProxyDB(request.app)
-    # Get all proxies filtered by the user query and allowed for this target
-    all_proxies = await proxy_db.select(*where)
+    if prewarm:
+        request.app['prewarmer'].record(target_identifier, codes, pool_length)
+    target_id = target_data['id']
+    banned_ids = blocked_ids
+    if blocked_ids:
+        renewed_ids = await renew_tor_identities(request.app, blocked_ids, all_proxies)
+        blocked_ids = [pid for pid in blocked_ids if pid not in renewed_ids]
+    if blocked_ids and 'prewarmer' in request.app:
+        request.app['prewarmer'].discard(target_id, blocked_ids)
+    if session is not None:
+        pool_length = 1
     # Create a Proxy pool manager
     proxy_pool = ProxyPool(pool_id=str(target_id), pool_len=pool_length,
                            standby_mins=target_data['blocked_standby'],
-                           redis=request.app['redis'])
-    # Mark proxies as blocked if any
-    if blocked_ids:
-        await proxy_pool.set_as_blocked_list(*blocked_ids)
-    await proxy_pool.load(*all_proxies) # Load the proxy pool passing the proxies as parameter
-    return web.json_response({'message': 'All OK',
-                              'data': {
-                                  'target_id': target_id,
-                                  'pool': proxy_pool.pool},
-                              'total': proxy_pool.length,
-                              'status': 'success'}, status=200)
+                           redis=request.app['redis'],
+                           strategy=get_strategy(config['pool'].get('strategy', 'random')),
+                           lease_ttl=lease_ttl,
+                           refill=config['pool'].get('refill', 'reset'))
+    pool_mode = config['pool'].get('mode', 'batched')
+    if session is not None:
+        # Load the proxy pinned to the session
+        await proxy_pool.load_session(session, config['pool'].get('session_ttl', 600),
+                                      *all_proxies, blocked_ids=blocked_ids, mode=pool_mode)
+    else:
+        # Load the proxy pool passing the proxies as parameter and mark proxies as blocked if any
+        await proxy_pool.loader(pool_mode)(*all_proxies, blocked_ids=blocked_ids)
+    if banned_ids:
+        await proxy_pool.record_outcomes(*[(pid, 'ban', None) for pid in banned_ids])
+    return get_pool_response(target_id, proxy_pool.pool)
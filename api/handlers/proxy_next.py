@@ -0,0 +1,81 @@
+"""
+Next proxy handler
+
+Returns a single proxy for clients rotating the proxy on every request:
+
+GET /proxy_next/{tid}?loc=US&type=PRV&blocked=1|2
+
+The proxies are taken in round robin from a rotation queue in Redis per target
+and filter (see lib/proxies/rotation.py), skipping the blocked proxies
+and the proxies at their caps (429 if every proxy is at its caps)
+The queue is built on the first request and rebuilt every `pool.rotation_ttl` seconds
+The target is taken from the proxy catalog when it is enabled
+"""
+
+import time
+
+from api.handlers.base import json_response
+from api.handlers.proxy_list import get_blocked_proxy_ids
+from api.handlers.proxy_list import get_query_codes
+from api.handlers.proxy_list import get_target_proxies
+from api.handlers.proxy_feedback import get_target_404_response
+from api.handlers.proxy_feedback import get_target_data
+from api.handlers.proxy_feedback import get_proxy_pool
+from api.handlers.proxy_feedback import renew_tor_identities
+from lib.proxies.rotation import ProxyRotation
+from lib.serializer import dumps
+
+
+FILTER_KEYS = ('loc', 'type', 'prov', 'plan')
+
+
+def get_filter_signature(request):
+    '''Return the filter in the query as a string. There is a rotation queue per filter'''
+    return '&'.join('{}={}'.format(key, request.query[key])
+                    for key in FILTER_KEYS if key in request.query)
+
+
+async def get_handler(request):
+    '''GET the next proxy'''
+    config = request.app['config']
+    target_identifier = request.match_info.get('tid')
+    target_data = await get_target_data(request, target_identifier)
+    if target_data is None:
+        return get_target_404_response(target_identifier)
+    target_id = target_data['id']
+    blocked_ids = get_blocked_proxy_ids(request)
+    if blocked_ids:
+        proxy_pool = get_proxy_pool(request, target_data)
+        renewed_ids = await renew_tor_identities(request.app, blocked_ids)
+        not_renewed_ids = [pid for pid in blocked_ids if pid not in renewed_ids]
+        await proxy_pool.set_as_blocked_list(*not_renewed_ids)
+        await proxy_pool.record_outcomes(*[(pid, 'ban', None) for pid in blocked_ids])
+        if not_renewed_ids and 'prewarmer' in request.app:
+            request.app['prewarmer'].discard(target_id, not_renewed_ids)
+    rotation = ProxyRotation(pool_id=str(target_id), redis=request.app['redis'],
+                             signature=get_filter_signature(request),
+                             ttl=config['pool'].get('rotation_ttl', 60),
+                             lease_ttl=config['pool'].get('lease_ttl', 300))
+    now = time.time()
+    proxy = await rotation.next(now)
+    if proxy is None:
+        # No rotation queue yet
+        _, all_proxies = await get_target_proxies(request.app, target_identifier,
+                                                  get_query_codes(request))
+        await rotation.build(*all_proxies, dumps=dumps)
+        proxy = await rotation.next(now)
+    if proxy is None:
+        return json_response({
+            'message': 'There are no proxies for target "{}"'.format(target_identifier),
+            'data': {},
+            'status': 'not found'}, status=404)
+    if not proxy:
+        return json_response({
+            'message': 'Every proxy for target "{}" is at its caps'.format(target_identifier),
+            'data': {},
+            'status': 'too many requests'}, status=429)
+    return json_response({'message': 'All OK',
+                          'data': {
+                              'target_id': target_id,
+                              'proxy': proxy},
+                          'status': 'success'}, status=200)
@@ -0,0 +1,18 @@
+"""
+Status handler
+
+Returns the service metrics:
+- hasher: the password hasher process pool (token auth method)
+"""
+
+from api.handlers.base import json_response
+
+
+async def get_handler(request):
+    '''GET the service metrics'''
+    data = {}
+    if 'hasher' in request.app:
+        data['hasher'] = request.app['hasher'].get_metrics()
+    return json_response({'message': 'All OK',
+                          'data': data,
+                          'status': 'success'}, status=200)
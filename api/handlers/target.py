@@ -2,8 +2,8 @@
 Handler for targets
 """
 
-from aiohttp import web
 from api.handlers.base import get_value
+from api.handlers.base import json_response
 from api.handlers.base import get_404_response
 from api.models.target import TargetDB
 from api.models.target_provider import TargetProviderDB
@@ -45,10 +45,10 @@ async def get_handler(request):
         result = [dict(r) for r in rows]
         total_c = await model_db.count(*where_query)
         total = total_c['count']
-    return web.json_response({'message': 'All OK',
-                              'data': result,
-                              'total': total,
-                              'status': 'success'}, status=200)
+    return json_response({'message': 'All OK',
+                          'data': result,
+                          'total': total,
+                          'status': 'success'}, status=200)
 
 
 async def post_handler(request):
@@ -65,9 +65,9 @@ async def post_handler(request):
             try:
                 values.append(get_value(key, value))
             except ValueError as err:
-                return web.json_response({'message': str(err),
-                                          'data': None,
-                                          'status': 'client error'}, status=400)
+                return json_response({'message': str(err),
+                                      'data': None,
+                                      'status': 'client error'}, status=400)
         result = await model_db.insert(','.join(columns), *[tuple(values)])
         providers_db = TargetProviderDB(request.app)
         plans_db = TargetProviderPlanDB(request.app)
@@ -77,9 +77,9 @@ async def post_handler(request):
         if params['plans']:
             await plans_db.insert('target_id,provider_plan_id',
                                 *[(result, int(pid)) for pid in params['plans']])
-        return web.json_response({'message': 'All OK',
-                                  'data': {'id': result},
-                                  'status': 'success'}, status=201)
+        return json_response({'message': 'All OK',
+                              'data': {'id': result},
+                              'status': 'success'}, status=201)
     return get_404_response()
 
 
@@ -99,9 +99,9 @@ async def put_handler(request):
                 try:
                     values.append(get_value(key, value))
                 except ValueError as err:
-                    return web.json_response({'message': str(err),
-                                              'data': None,
-                                              'status': 'client error'}, status=400)
+                    return json_response({'message': str(err),
+                                          'data': None,
+                                          'status': 'client error'}, status=400)
             where_query = [('id', '=', int(model_id)), ]
             result = await model_db.update(','.join(columns),
                                            tuple(values),
@@ -116,9 +116,9 @@ async def put_handler(request):
             if params['plans']:
                 await plans_db.insert('target_id,provider_plan_id',
                                     *[(int(model_id), int(pid)) for pid in params['plans']])
-            return web.json_response({'message': 'All OK',
-                                      'data': dict(result),
-                                      'status': 'success'}, status=200)
+            return json_response({'message': 'All OK',
+                                  'data': dict(result),
+                                  'status': 'success'}, status=200)
     return get_404_response()
 
 
@@ -129,7 +129,7 @@ async def delete_handler(request):
         model_db = TargetDB(request.app)
         where_query = [('id', '=', int(model_id)), ]
         await model_db.delete(*where_query)
-        return web.json_response({'message': 'All OK',
-                                  'data': {},
-                                  'status': 'success'}, status=200)
+        return json_response({'message': 'All OK',
+                              'data': {},
+                              'status': 'success'}, status=200)
     return get_404_response()
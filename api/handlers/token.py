@@ -2,7 +2,7 @@
 Handler to return a Token
 """
 
-from aiohttp import web
+from api.handlers.base import json_response
 
 from api.models.user import UserDB
 
@@ -10,10 +10,10 @@ from api.models.user import UserDB
 async def post_handler(request):
     params = await request.json()
     if not 'username' in params:
-        return web.json_response({'message': 'Not valid request',
-                                  'data': {},
-                                  'status': 'error'}, status=401)
-    token = UserDB.generate_auth_token(params['username'])
-    return web.json_response({'message': 'All OK',
-                              'data': {'token': token.decode()},
-                              'status': 'success'}, status=200)
+        return json_response({'message': 'Not valid request',
+                              'data': {},
+                              'status': 'error'}, status=401)
+    token = UserDB(request.app).generate_auth_token(params['username'])
+    return json_response({'message': 'All OK',
+                          'data': {'token': token.decode()},
+                          'status': 'success'}, status=200)
@@ -1,10 +1,18 @@
 """
 Base solution to make queries to database
+
+Reads run without an explicit transaction. The SELECT query strings are cached
+by shape (table, columns, where columns and comparators, extra) so the same text is
+sent every time and asyncpg reuses its prepared statement for the connection
 """
 
+from functools import lru_cache
 from itertools import chain
 
 
+QUERY_CACHE_SIZE = 1024
+
+
 class DBModel:
     '''Represents a table in the database and defines methods for basic operations'''
     tablename = None  # It must not be None
@@ -87,7 +95,8 @@ class DBModel:
             w_v_args.append('${}'.format(arg_no))
         return w_v_args, arg_no
 
-    def _where_str(self, *where, first_arg_no=1):
+    @staticmethod
+    def _where_str(*where, first_arg_no=1):
         arg_no = first_arg_no - 1
         where_cl = []
         for w_c, w_e, w_v in where:
@@ -97,38 +106,57 @@ class DBModel:
                 # All the arguments will be {} so we can use format to insert
                 # the correct position number
                 qry_str, qry_args = w_v()
-                w_v_args, arg_no = self._w_v_args(qry_args, arg_no)
+                w_v_args, arg_no = DBModel._w_v_args(qry_args, arg_no)
                 qry_str = qry_str.format(*w_v_args)
                 where_cl.append('{} {} ({})'.format(w_c, w_e, qry_str))
             elif w_e == 'in':
-                w_v_args, arg_no = self._w_v_args(w_v, arg_no)
+                w_v_args, arg_no = DBModel._w_v_args(w_v, arg_no)
                 where_cl.append('{} in ({})'.format(w_c, ','.join(w_v_args)))
             else:
                 arg_no += 1
                 where_cl.append('{} {} ${}'.format(w_c, w_e, arg_no))
         return ' AND '.join(where_cl)
 
-    def _select_query(self, *where, columns='*', extra=None):
-        query = 'SELECT {} FROM {}'.format(columns, self.tablename)
-        query_args = []
+    @staticmethod
+    def _where_shape(*where):
+        """Return the where query shape: tuples <column, comparator, number of values>
+        The number of values is None but for `in` comparators
+        It returns None when the query can not be cached (subqueries)"""
+        shape = []
+        for w_c, w_e, w_v in where:
+            if callable(w_v):
+                return None
+            shape.append((w_c, w_e, len(w_v) if w_e == 'in' else None))
+        return tuple(shape)
+
+    @staticmethod
+    def _read_query_str(query, *where, extra=None):
         if where:
-            query_args = self._where_args(*where)
-            where_query_str = self._where_str(*where)
-            query += ' WHERE {}'.format(where_query_str)
+            query += ' WHERE {}'.format(DBModel._where_str(*where))
         if extra is not None:
             query += ' {}'.format(extra)
-        return query, query_args
+        return query
+
+    @staticmethod
+    @lru_cache(maxsize=QUERY_CACHE_SIZE)
+    def _cached_read_query_str(query, shape, extra):
+        where = [(w_c, w_e, [None] * w_n if w_e == 'in' else None) for w_c, w_e, w_n in shape]
+        return DBModel._read_query_str(query, *where, extra=extra)
+
+    def _read_query(self, query, *where, extra=None):
+        query_args = self._where_args(*where)
+        shape = self._where_shape(*where)
+        if shape is None:
+            return self._read_query_str(query, *where, extra=extra), query_args
+        return self._cached_read_query_str(query, shape, extra), query_args
+
+    def _select_query(self, *where, columns='*', extra=None):
+        query = 'SELECT {} FROM {}'.format(columns, self.tablename)
+        return self._read_query(query, *where, extra=extra)
 
     def _select_count_query(self, *where, columns='*', extra=None):
         query = 'SELECT count({}) FROM {}'.format(columns, self.tablename)
-        query_args = []
-        if where:
-            query_args = self._where_args(*where)
-            where_query_str = self._where_str(*where)
-            query += ' WHERE {}'.format(where_query_str)
-        if extra is not None:
-            query += ' {}'.format(extra)
-        return query, query_args
+        return self._read_query(query, *where, extra=extra)
 
     async def select(self, *where, columns='*', extra=None):
         """SQL SELECT Query
@@ -137,18 +165,16 @@ class DBModel:
         extra: str (ie: ORDER BY 1 OFFSET 3 LIMIT 5)"""
         query, query_args = self._select_query(*where, columns=columns, extra=extra)
         async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetch(query, *query_args)
-                return result
+            result = await connection.fetch(query, *query_args)
+        return result
 
     async def count(self, *where):
         """SQL COUNT Query
         *where: tuples <column, comparator, value> (ie: ('age', '>', 15))"""
         query, query_args = self._select_count_query(*where, columns='id')
         async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchrow(query, *query_args)
-                return result
+            result = await connection.fetchrow(query, *query_args)
+        return result
 
     async def select_one(self, *where, columns='*', extra=None, no_limit=False):
         """SQL SELECT Query (only one row)
@@ -160,9 +186,8 @@ class DBModel:
         if not no_limit:
             query += ' LIMIT 1'
         async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchrow(query, *query_args)
-                return result
+            result = await connection.fetchrow(query, *query_args)
+        return result
 
     async def select_val(self, *where, columns='*', extra=None, no_limit=False):
         """SQL SELECT Query (return a value in the first row)
@@ -174,9 +199,8 @@ class DBModel:
         if not no_limit:
             query += ' LIMIT 1'
         async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchval(query, *query_args)
-                return result
+            result = await connection.fetchval(query, *query_args)
+        return result
 
     async def delete(self, *where):
         """SQL DELETE Query
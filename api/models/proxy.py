@@ -5,11 +5,66 @@ DB operations for Proxies
 from api.models.base import DBModel
 
 
+# Target data and all the active proxies allowed for it filtered by location, type, provider
+# and plan codes
+# A filter is ignored when its code is NULL or does not exist
+# The target row is returned once with NULL proxy columns when there are no proxies
+# Every proxy comes with the caps of its plan (plan_max_concurrency and plan_max_rpm)
+# They are shared by all the proxies of the plan (see ProxyPool.get_caps_groups)
+TARGET_PROXIES_QUERY = '''
+WITH tgt AS (SELECT id, identifier, blocked_standby FROM targets WHERE identifier = $1),
+     loc_f AS (SELECT id FROM proxy_locations WHERE code = $2),
+     type_f AS (SELECT id FROM proxy_types WHERE code = $3),
+     prov_f AS (SELECT id FROM providers WHERE code = $4),
+     plan_f AS (SELECT id FROM provider_plans WHERE code = $5)
+SELECT tgt.id AS target_id, tgt.identifier AS target_identifier,
+       tgt.blocked_standby AS target_blocked_standby, proxy.*
+FROM tgt LEFT JOIN LATERAL (
+    SELECT prx.*, pp.max_concurrency AS plan_max_concurrency, pp.max_rpm AS plan_max_rpm
+    FROM proxies prx LEFT JOIN provider_plans pp ON (pp.id = prx.provider_plan_id)
+    WHERE prx.active
+      AND (NOT EXISTS (SELECT 1 FROM loc_f) OR prx.proxy_location_id IN (SELECT id FROM loc_f))
+      AND (NOT EXISTS (SELECT 1 FROM type_f) OR prx.proxy_type_id IN (SELECT id FROM type_f))
+      AND (NOT EXISTS (SELECT 1 FROM prov_f) OR prx.provider_id IN (SELECT id FROM prov_f))
+      AND (NOT EXISTS (SELECT 1 FROM plan_f) OR prx.provider_plan_id IN (SELECT id FROM plan_f))
+      AND (NOT EXISTS (SELECT 1 FROM target_providers tp WHERE tp.target_id = tgt.id)
+           OR prx.provider_id IN (
+               SELECT tp.provider_id FROM target_providers tp WHERE tp.target_id = tgt.id))
+      AND (NOT EXISTS (SELECT 1 FROM target_provider_plans tpp WHERE tpp.target_id = tgt.id)
+           OR prx.provider_plan_id IN (
+               SELECT tpp.provider_plan_id FROM target_provider_plans tpp
+               WHERE tpp.target_id = tgt.id))
+) proxy ON TRUE
+'''
+TARGET_COLUMNS = {
+    'target_id': 'id',
+    'target_identifier': 'identifier',
+    'target_blocked_standby': 'blocked_standby',
+}
+
+
 class ProxyDB(DBModel):
     '''DBModel for the proxies table'''
 
     tablename = 'proxies'
 
+    async def select_for_target(self, identifier: str, location: str = None,
+                                proxy_type: str = None, provider: str = None, plan: str = None):
+        """Return the target data and all the active proxies allowed for the target
+        filtered by the given codes in a single query
+        identifier: str, the target identifier
+        location, proxy_type, provider, plan: str, the codes to filter by (optional)
+        return: tuple <target data (dict) or None>, <proxies (list of dicts)>"""
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(TARGET_PROXIES_QUERY, identifier,
+                                          location, proxy_type, provider, plan)
+        if not rows:
+            return None, []
+        target_data = {key: rows[0][column] for column, key in TARGET_COLUMNS.items()}
+        proxies = [{key: value for key, value in row.items() if key not in TARGET_COLUMNS}
+                   for row in rows if row['id'] is not None]
+        return target_data, proxies
+
 
 class ProxyView(DBModel):
     '''List proxies view'''
@@ -3,9 +3,6 @@ DB operations for Users
 """
 
 from passlib.apps import custom_app_context as pwd_context
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-
-from config import get_config
 
 from api.models.base import DBModel
 
@@ -20,23 +17,13 @@ class UserDB(DBModel):
         where = [('username', '=', username)]
         return await self.select_one(*where)
 
-    @staticmethod
-    def get_token_data(username, token):
-        '''If the token exists, check if it's valid'''
-        app_config = get_config()
-        serializer = Serializer(
-            app_config['security']['secret_key'],
-            expires_in=app_config['security']['token_expires_in'])
-        return serializer.loads(token)
+    def get_token_data(self, username, token):  # pylint: disable=unused-argument
+        '''If the token exists, check if it's valid (see TokenAuth in api/auth.py)'''
+        return self._app['auth'].load_token(token)
 
-    @staticmethod
-    def generate_auth_token(username):
+    def generate_auth_token(self, username):
         '''Generate a new token'''
-        app_config = get_config()
-        serializer = Serializer(
-            app_config['security']['secret_key'],
-            expires_in=app_config['security']['token_expires_in'])
-        return serializer.dumps({'user': username})
+        return self._app['auth'].dump_token({'user': username})
 
     @staticmethod
     def password_hash(password):
@@ -44,14 +31,29 @@ class UserDB(DBModel):
         return pwd_context.encrypt(password)
 
     async def verify_identity(self, username, password):
-        '''Verify if the password `pwd` is valid'''
+        '''Verify if the password `pwd` is valid
+        The hash is verified in the app password hasher process pool (see lib/hasher.py)
+        The verified credentials are cached with the stored hash (see TokenAuth in api/auth.py)
+        Raise HasherBusyError if there are too many hashes pending'''
         user = await self.get_user(username)
         if user is None:
             return False
-        return pwd_context.verify(password, user['password'])
+        auth = self._app.get('auth')
+        if auth is not None and auth.is_verified(username, password, user['password']):
+            return True
+        if 'hasher' in self._app:
+            verified = await self._app['hasher'].verify(password, user['password'])
+        else:
+            verified = pwd_context.verify(password, user['password'])
+        if verified and auth is not None:
+            auth.set_verified(username, password, user['password'])
+        return verified
 
     async def set_password(self, username, password):
         '''Set a new password for the current user'''
-        new_password = self.password_hash(password)
+        if 'hasher' in self._app:
+            new_password = await self._app['hasher'].hash(password)
+        else:
+            new_password = self.password_hash(password)
         where = [('username', '=', username)]
         await self.update('password', (new_password, ), *where)
@@ -11,7 +11,11 @@ from api.routes.provider_plan import init_provider_plan_routes
 from api.routes.target_provider import init_target_provider_routes
 from api.routes.target_provider_plan import init_target_provider_plan_routes
 from api.routes.proxy_list import init_proxy_list_routes
+from api.routes.proxy_next import init_proxy_next_routes
+from api.routes.proxy_feedback import init_proxy_feedback_routes
+from api.routes.proxy_lease import init_proxy_lease_routes
 from api.routes.token import init_token_routes
+from api.routes.status import init_status_routes
 
 
 def init_routes(app):
@@ -30,4 +34,8 @@ def init_routes(app):
     init_target_provider_routes(app)
     init_target_provider_plan_routes(app)
     init_proxy_list_routes(app)
+    init_proxy_next_routes(app)
+    init_proxy_feedback_routes(app)
+    init_proxy_lease_routes(app)
     init_token_routes(app)
+    init_status_routes(app)
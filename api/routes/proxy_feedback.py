@@ -0,0 +1,12 @@
+"""
+Routes for Proxy Feedback
+"""
+
+from api.handlers.proxy_feedback import get_handler
+from api.handlers.proxy_feedback import post_handler
+
+
+def init_proxy_feedback_routes(app):
+    '''Init routes for proxy feedback'''
+    app.router.add_route('GET', r'/proxy_feedback/{tid}', get_handler)
+    app.router.add_route('POST', r'/proxy_feedback/{tid}', post_handler)
@@ -0,0 +1,12 @@
+"""
+Routes for Proxy Leases
+"""
+
+from api.handlers.proxy_lease import get_handler
+from api.handlers.proxy_lease import delete_handler
+
+
+def init_proxy_lease_routes(app):
+    '''Init routes for proxy leases'''
+    app.router.add_route('GET', r'/proxy_lease/{tid}', get_handler)
+    app.router.add_route('DELETE', r'/proxy_lease/{tid}', delete_handler)
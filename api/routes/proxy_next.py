@@ -0,0 +1,10 @@
+"""
+Routes for Next Proxy
+"""
+
+from api.handlers.proxy_next import get_handler
+
+
+def init_proxy_next_routes(app):
+    '''Init routes for next proxy'''
+    app.router.add_route('GET', r'/proxy_next/{tid}', get_handler)
@@ -0,0 +1,10 @@
+"""
+Routes for Status
+"""
+
+from api.handlers.status import get_handler
+
+
+def init_status_routes(app):
+    '''Init routes for status'''
+    app.router.add_route('GET', r'/status', get_handler)
@@ -1,26 +1,114 @@
 """
 Read the config file
 - config.toml
+
+The file is parsed once. The config is read only, but it can be reloaded
+(SIGHUP or file changes, see api/__init__.py): only the reloadable sections are applied,
+the rest of the changes need a restart
 """
 
 import os
+import logging
+from types import MappingProxyType
+from collections.abc import Mapping
+
 import toml
 
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 CONFIG_FILENAME = 'config.toml'
+# Sections applied when the config is reloaded
+RELOADABLE_SECTIONS = ('api', 'pool')
+# Keys of the reloadable sections that still need a restart
+STRUCTURAL_KEYS = {('api', 'auth_method'), ('pool', 'mode')}
 
 
 class ConfigError(Exception):
     '''Used when an error happens'''
 
 
+def freeze(value):
+    '''Return a read only copy of the parsed config value'''
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Config(Mapping):
+    '''Read only config'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        self._data = freeze(self.read())
+
+    def read(self):
+        '''Parse the config file and return a dict'''
+        if not os.path.exists(self.path):
+            raise ConfigError('File does not exist: {}'.format(self.path))
+        self.mtime = os.path.getmtime(self.path)
+        with open(self.path) as c_f:
+            return toml.load(c_f)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def changed(self):
+        '''Return True if the config file changed since it was read'''
+        try:
+            return os.path.getmtime(self.path) != self.mtime
+        except OSError:
+            return False
+
+    def merge(self, new_config: dict):
+        '''Return the current config with the reloadable sections of `new_config`'''
+        data = dict(self._data)
+        for section in set(self._data) | set(new_config):
+            if section not in RELOADABLE_SECTIONS:
+                if freeze(new_config.get(section)) != self._data.get(section):
+                    logging.warning('Config section [%s] changed: it needs a restart', section)
+                continue
+            current = self._data.get(section, {})
+            new_section = dict(new_config.get(section, {}))
+            for key in {key for sec, key in STRUCTURAL_KEYS if sec == section}:
+                if new_section.get(key) != current.get(key):
+                    logging.warning('Config key %s.%s changed: it needs a restart', section, key)
+                new_section.pop(key, None)
+                if key in current:
+                    new_section[key] = current[key]
+            data[section] = new_section
+        return data
+
+    def reload(self, validate=None):
+        '''Read the config file again and apply the reloadable sections
+        @param validate: function raising ConfigError if the new config is not valid
+        @return: True if the config was reloaded'''
+        try:
+            data = self.merge(self.read())
+            if validate is not None:
+                validate(data)
+        except (ConfigError, OSError, toml.TomlDecodeError) as err:
+            logging.error('Unable to reload the config: %s', err)
+            return False
+        self._data = freeze(data)
+        logging.info('Config reloaded: %s', self.path)
+        return True
+
+
+_CONFIG = None
+
+
 def get_config():
-    '''Read the config file and return a dict'''
-    config = None
-    config_path = os.path.join(HERE, CONFIG_FILENAME)
-    if not os.path.exists(config_path):
-        raise ConfigError('File does not exist: {}'.format(config_path))
-    with open(config_path) as c_f:
-        config = toml.load(c_f)
-    return config
+    '''Return the config. The config file is read only once'''
+    global _CONFIG  # pylint: disable=global-statement
+    if _CONFIG is None:
+        _CONFIG = Config(os.path.join(HERE, CONFIG_FILENAME))
+    return _CONFIG
@@ -0,0 +1,56 @@
+"""
+In memory cache
+
+Bounded: the least recently used entries are evicted when it is full
+Every entry expires after `ttl` seconds (or the TTL given when it is set)
+"""
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''Bounded in memory cache with expiration'''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        '''
+        @param maxsize: max number of entries
+        @param ttl: default seconds until an entry expires'''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Key => tuple <expiration (monotonic clock)>, <value>
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        '''Return the value of the key or `default` if it is not cached or it expired'''
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        '''Cache the value of the key for `ttl` seconds (default: self.ttl)'''
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''Remove the key and return its value'''
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        '''Remove all the entries'''
+        self._data.clear()
@@ -0,0 +1,86 @@
+"""
+Password Hasher
+
+The password hashes are slow on purpose, so they run in a process pool
+instead of blocking the event loop
+
+The number of hashes waiting or running is limited (`max_pending`):
+HasherBusyError is raised over that limit instead of queueing without bound
+"""
+
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.apps import custom_app_context as pwd_context
+
+
+class HasherBusyError(Exception):
+    '''Used when there are too many hashes pending'''
+
+
+def _hash_password(password: str):
+    '''Return the hashed password (it runs in the process pool)'''
+    return pwd_context.hash(password)
+
+
+def _verify_password(password: str, hashed_password: str):
+    '''Return True if the password matches the hash (it runs in the process pool)'''
+    return pwd_context.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    '''Hash and verify passwords in a process pool'''
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 100):
+        '''
+        @param max_workers: number of processes
+        @param max_pending: max number of hashes waiting or running'''
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def _run(self, function, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherBusyError('Too many password hashes pending')
+        self.pending += 1
+        start_time = time.monotonic()
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+        finally:
+            elapsed = time.monotonic() - start_time
+            self.pending -= 1
+            self.completed += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    async def hash(self, password: str):
+        '''Return the hashed password'''
+        return await self._run(_hash_password, password)
+
+    async def verify(self, password: str, hashed_password: str):
+        '''Return True if the password matches the hash'''
+        return await self._run(_verify_password, password, hashed_password)
+
+    def get_metrics(self):
+        '''Return the hasher metrics (dict)'''
+        return {
+            'workers': self.max_workers,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_time': self.total_time / self.completed if self.completed else 0.0,
+            'max_time': self.max_time,
+        }
+
+    def close(self):
+        '''Shut down the process pool'''
+        self.executor.shutdown(wait=False)
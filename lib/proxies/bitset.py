@@ -0,0 +1,40 @@
+"""
+Bitsets of proxy positions
+
+A bitset is a Python int where the bit N is set when the item N is in the set
+Intersections and unions are just `&` and `|` between ints
+
+The catalog gives every proxy a dense position (see ProxyCatalog.positions), so the
+size of the bitsets follows the number of proxies and not the range of the proxy IDs
+"""
+
+
+def from_ids(ids) -> int:
+    '''Return the bitset with the given positions'''
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for pid in ids:
+        buffer[pid >> 3] |= 1 << (pid & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def to_ids(bits: int) -> list:
+    '''Return the sorted list of positions in the bitset
+    The bitset is read in 64 bit words: only the set bits of the non zero words are visited'''
+    ids = []
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for offset in range(0, len(data), 8):
+        word = int.from_bytes(data[offset:offset + 8], 'little')
+        position = offset * 8
+        while word:
+            lowest = word & -word
+            ids.append(position + lowest.bit_length() - 1)
+            word ^= lowest
+    return ids
+
+
+def count(bits: int) -> int:
+    '''Return the number of positions in the bitset'''
+    return bin(bits).count('1')
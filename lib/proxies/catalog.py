@@ -0,0 +1,351 @@
+"""
+Proxies Catalog
+
+In memory copy of the proxies and targets tables
+The proxies are indexed by type, location, provider, plan and active flag
+so the proxies allowed for a target can be filtered without querying the database
+Every index is a bitset of proxy positions (see lib/proxies/bitset.py) and the proxies
+allowed for every target are precomputed, so a filter is a handful of bitwise ANDs
+Every proxy gets a dense position (the positions of the removed proxies are reused)
+
+It is loaded once and refreshed incrementally with Postgres LISTEN/NOTIFY
+(see the `notify_proxy_catalog` triggers in sql/schema.sql)
+If the LISTEN connection is lost it is opened again and the whole catalog reloaded
+"""
+
+import json
+import asyncio
+import logging
+from collections import defaultdict
+
+import asyncpg
+
+from lib.proxies import bitset
+
+
+class ProxyCatalog:  # pylint: disable=too-many-instance-attributes
+    '''Proxies Catalog'''
+
+    channel = 'proxy_catalog'
+    # Query key => code table
+    code_tables = {
+        'loc': 'proxy_locations',
+        'type': 'proxy_types',
+        'prov': 'providers',
+        'plan': 'provider_plans',
+    }
+    # Query key => proxies column
+    code_columns = {
+        'loc': 'proxy_location_id',
+        'type': 'proxy_type_id',
+        'prov': 'provider_id',
+        'plan': 'provider_plan_id',
+    }
+    # Target restriction table => column
+    restriction_tables = {
+        'target_providers': 'provider_id',
+        'target_provider_plans': 'provider_plan_id',
+    }
+    indexed_columns = ('proxy_type_id', 'proxy_location_id', 'provider_id',
+                       'provider_plan_id', 'active')
+    # Pending changes to apply in a single refresh
+    flush_delay = 0.1
+    # Reload everything instead of refreshing rows one by one over this number of changes
+    max_pending = 10000
+    # Seconds to wait before retrying a failed refresh or reconnection
+    retry_delay = 5.0
+    # Every proxy comes with the caps of its plan (see ProxyPool.get_caps_groups)
+    proxies_query = '''
+    SELECT prx.*, pp.max_concurrency AS plan_max_concurrency, pp.max_rpm AS plan_max_rpm
+    FROM proxies prx LEFT JOIN provider_plans pp ON (pp.id = prx.provider_plan_id)'''
+
+    def __init__(self, pool: object, dsn: str, reload_interval: int = 0):
+        '''
+        @param pool: the asyncpg connection pool
+        @param dsn: the Postgres URI used to open the LISTEN connection
+        @param reload_interval: seconds between full reloads (0: never)'''
+        self.pool = pool
+        self.dsn = dsn
+        self.reload_interval = reload_interval
+        self.proxies = {}
+        # Proxy ID => bit position and bit position => proxy ID (None: free)
+        self.positions = {}
+        self.position_ids = []
+        self.free_positions = []
+        self.indexes = {column: defaultdict(int) for column in self.indexed_columns}
+        self.codes = {table: {} for table in self.code_tables.values()}
+        self.targets = {}
+        self.target_ids = {}
+        self.restrictions = {table: defaultdict(set) for table in self.restriction_tables}
+        self.target_bits = {}
+        self._listener = None
+        self._pending = defaultdict(set)
+        self._flush_handle = None
+        self._reload_task = None
+        self._reconnect_task = None
+
+    async def start(self):
+        '''Listen for changes and load the catalog'''
+        await self.listen()
+        await self.load()
+        if self.reload_interval:
+            self._reload_task = asyncio.ensure_future(self._reload_periodically())
+
+    async def close(self):
+        '''Stop listening for changes'''
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        if self._reload_task is not None:
+            self._reload_task.cancel()
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.remove_termination_listener(self._on_listener_lost)
+            await listener.close()
+
+    async def listen(self):
+        '''Open the LISTEN connection'''
+        listener = await asyncpg.connect(self.dsn)
+        try:
+            await listener.add_listener(self.channel, self._on_notify)
+        except BaseException:
+            await listener.close()
+            raise
+        listener.add_termination_listener(self._on_listener_lost)
+        self._listener = listener
+
+    def _on_listener_lost(self, connection):
+        '''Termination callback of the LISTEN connection'''
+        if connection is not self._listener:
+            return
+        logging.warning('Proxy catalog LISTEN connection lost: reconnecting')
+        self._listener = None
+        self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        '''Open the LISTEN connection again and reload the whole catalog
+        (the changes notified while the connection was down are lost)'''
+        while self._listener is None:
+            try:
+                await self.listen()
+            except (OSError, asyncpg.PostgresError) as err:
+                logging.warning('Unable to reconnect the proxy catalog: %s', err)
+                await asyncio.sleep(self.retry_delay)
+        while True:
+            try:
+                await self.load()
+                break
+            except (OSError, asyncpg.PostgresError):
+                logging.exception('Unable to reload the proxy catalog')
+                await asyncio.sleep(self.retry_delay)
+        self._reconnect_task = None
+
+    async def load(self):
+        '''Load the whole catalog'''
+        async with self.pool.acquire() as connection:
+            proxies = await connection.fetch(self.proxies_query)
+            targets = await connection.fetch('SELECT * FROM targets')
+            restrictions = {}
+            for table, column in self.restriction_tables.items():
+                restrictions[table] = await connection.fetch(
+                    'SELECT target_id, {} FROM {}'.format(column, table))
+            codes = {}
+            for table in self.codes:
+                codes[table] = await connection.fetch('SELECT id, code FROM {}'.format(table))
+        self.proxies = {row['id']: dict(row) for row in proxies}
+        self.position_ids = sorted(self.proxies)
+        self.positions = {pid: position for position, pid in enumerate(self.position_ids)}
+        self.free_positions = []
+        self.indexes = {}
+        for column in self.indexed_columns:
+            index_ids = defaultdict(list)
+            for proxy in self.proxies.values():
+                index_ids[proxy[column]].append(self.positions[proxy['id']])
+            self.indexes[column] = defaultdict(int, {
+                value: bitset.from_ids(ids) for value, ids in index_ids.items()})
+        self.targets = {}
+        self.target_ids = {}
+        for row in targets:
+            self._add_target(dict(row))
+        for table, column in self.restriction_tables.items():
+            self.restrictions[table] = defaultdict(set)
+            for row in restrictions[table]:
+                self.restrictions[table][row['target_id']].add(row[column])
+        for table, rows in codes.items():
+            self.codes[table] = {row['code']: row['id'] for row in rows}
+        self.target_bits = {}
+        logging.info('Proxy catalog loaded: %d proxies, %d targets',
+                     len(self.proxies), len(self.targets))
+
+    def _add_proxy(self, proxy: dict):
+        self.proxies[proxy['id']] = proxy
+        if self.free_positions:
+            position = self.free_positions.pop()
+            self.position_ids[position] = proxy['id']
+        else:
+            position = len(self.position_ids)
+            self.position_ids.append(proxy['id'])
+        self.positions[proxy['id']] = position
+        bit = 1 << position
+        for column in self.indexed_columns:
+            self.indexes[column][proxy[column]] |= bit
+
+    def _remove_proxy(self, pid: int):
+        proxy = self.proxies.pop(pid, None)
+        if proxy is None:
+            return
+        position = self.positions.pop(pid)
+        self.position_ids[position] = None
+        self.free_positions.append(position)
+        mask = ~(1 << position)
+        for column in self.indexed_columns:
+            self.indexes[column][proxy[column]] &= mask
+
+    def _add_target(self, target: dict):
+        self.targets[target['id']] = target
+        if target['identifier'] is not None:
+            self.target_ids[target['identifier']] = target['id']
+
+    def _remove_target(self, target_id: int):
+        target = self.targets.pop(target_id, None)
+        if target is None:
+            return
+        if self.target_ids.get(target['identifier']) == target_id:
+            del self.target_ids[target['identifier']]
+
+    def _on_notify(self, connection, pid, channel, payload):  # pylint: disable=unused-argument
+        '''LISTEN callback. The changes are applied in batches'''
+        change = json.loads(payload)
+        table = change['table']
+        if table in self.restriction_tables:
+            self._pending[table].add(change['target_id'])
+        else:
+            self._pending[table].add(change['id'])
+        self._schedule_flush(self.flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(
+                delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        '''Apply the pending changes
+        If it fails the changes are kept pending and applied again after `retry_delay`'''
+        self._flush_handle = None
+        pending, self._pending = self._pending, defaultdict(set)
+        try:
+            if sum(len(ids) for ids in pending.values()) > self.max_pending:
+                await self.load()
+                return
+            async with self.pool.acquire() as connection:
+                for table, ids in pending.items():
+                    if table == 'proxies':
+                        await self._refresh_proxies(connection, ids)
+                    elif table == 'targets':
+                        await self._refresh_targets(connection, ids)
+                    elif table in self.restriction_tables:
+                        await self._refresh_restrictions(connection, table, ids)
+                    elif table in self.codes:
+                        await self._refresh_codes(connection, table)
+                        if table == 'provider_plans':
+                            await self._refresh_plan_proxies(connection, ids)
+        except (OSError, asyncpg.PostgresError):
+            logging.exception('Unable to refresh the proxy catalog')
+            for table, ids in pending.items():
+                self._pending[table] |= ids
+            self._schedule_flush(self.retry_delay)
+
+    async def _refresh_proxies(self, connection, ids):
+        rows = await connection.fetch(self.proxies_query + ' WHERE prx.id = ANY($1)',
+                                      list(ids))
+        for pid in ids:
+            self._remove_proxy(pid)
+        for row in rows:
+            self._add_proxy(dict(row))
+        self.target_bits = {}
+
+    async def _refresh_plan_proxies(self, connection, plan_ids):
+        '''Refresh the proxies of the plans. They carry the plan caps'''
+        rows = await connection.fetch(
+            'SELECT id FROM proxies WHERE provider_plan_id = ANY($1)', list(plan_ids))
+        if rows:
+            await self._refresh_proxies(connection, {row['id'] for row in rows})
+
+    async def _refresh_targets(self, connection, ids):
+        rows = await connection.fetch('SELECT * FROM targets WHERE id = ANY($1)', list(ids))
+        for target_id in ids:
+            self._remove_target(target_id)
+        for row in rows:
+            self._add_target(dict(row))
+
+    async def _refresh_restrictions(self, connection, table, target_ids):
+        column = self.restriction_tables[table]
+        rows = await connection.fetch(
+            'SELECT target_id, {} FROM {} WHERE target_id = ANY($1)'.format(column, table),
+            list(target_ids))
+        for target_id in target_ids:
+            self.restrictions[table].pop(target_id, None)
+        for row in rows:
+            self.restrictions[table][row['target_id']].add(row[column])
+        for target_id in target_ids:
+            self.target_bits.pop(target_id, None)
+
+    async def _refresh_codes(self, connection, table):
+        rows = await connection.fetch('SELECT id, code FROM {}'.format(table))
+        self.codes[table] = {row['code']: row['id'] for row in rows}
+
+    async def _reload_periodically(self):
+        '''Reload the whole catalog every `reload_interval` seconds
+        It covers any notification lost while the LISTEN connection was down'''
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.load()
+            except (OSError, asyncpg.PostgresError):
+                logging.exception('Unable to reload the proxy catalog')
+
+    def get_target(self, identifier: str):
+        '''Return the target data given the target identifier or None'''
+        target_id = self.target_ids.get(identifier)
+        if target_id is None:
+            return None
+        return self.targets[target_id]
+
+    def get_id_from_code(self, key: str, code: str):
+        '''Return the ID of the element with code `code`
+        @param key: the query key (loc, type, prov or plan)
+        @param code: the element code
+        @return: an integer with the element ID or None'''
+        return self.codes[self.code_tables[key]].get(code)
+
+    def get_target_bits(self, target_id: int):
+        '''Return the bitset of the active proxies allowed for the target
+        (providers and plans restrictions). It is computed once and cached'''
+        bits = self.target_bits.get(target_id)
+        if bits is None:
+            bits = self.indexes['active'].get(True, 0)
+            for table, column in self.restriction_tables.items():
+                allowed = self.restrictions[table].get(target_id)
+                if allowed:
+                    allowed_bits = 0
+                    for value in allowed:
+                        allowed_bits |= self.indexes[column].get(value, 0)
+                    bits &= allowed_bits
+            self.target_bits[target_id] = bits
+        return bits
+
+    def select(self, target_id: int, **codes):
+        '''Return the active proxies allowed for the target filtered by the given codes
+        The codes not found in the catalog are ignored
+        @param target_id: the target ID
+        @param **codes: <query key>=<code> (ie: loc='US', type='PRV')'''
+        bits = self.get_target_bits(target_id)
+        for key, code in codes.items():
+            if code is None:
+                continue
+            elem_id = self.get_id_from_code(key, code)
+            if elem_id is not None:
+                bits &= self.indexes[self.code_columns[key]].get(elem_id, 0)
+        return [self.proxies[self.position_ids[position]] for position in bitset.to_ids(bits)]
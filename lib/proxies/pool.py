@@ -6,83 +6,448 @@ Stores already returned proxies in Redis
 Also add a standby time value for some proxies. It can be used for blocked IPs
 The goal is make fair use of proxies
 Also the pool can be configured to give flexibility using proxies
+
+Blocked proxies are stored in a sorted set per pool scored by the unblock timestamp
+The proxy caps (max concurrency and max requests per minute of every proxy and plan)
+are enforced in every selection mode (see CAPS in scripts.py). The caps of a plan
+are shared by all the proxies of the plan. A returned proxy counts for the concurrency
+until its lease expires (`lease_ttl`) or it is released
 """
 
-import random
+import time
+import uuid
 from datetime import datetime
-from datetime import timedelta
+
+from lib.proxies.scripts import SELECT_POOL
+from lib.proxies.scripts import LEASE_POOL
+from lib.proxies.scripts import TAKE_CAPS
+from lib.proxies.scripts import RENEW_LEASES
+from lib.proxies.scripts import PIN_SESSION
+from lib.proxies.scripts import RECORD_OUTCOMES
+from lib.proxies.strategies import RandomStrategy
+from lib.proxies.backconnect import get_proxy_id
 
 
 class ProxyPool:
     '''Proxy Pool'''
 
     used_key_frmt = '{pool_id}_used_list'
-    blocked_key_frmt = '{pool_id}_blocked:{pid}'
-    blocked_datetime_frmt = '%Y-%m-%d %H:%M'
+    # Last time every proxy was returned (sorted set). It is kept for the `lru` refill policy
+    lru_key_frmt = '{pool_id}_lru'
+    # Leased proxy IDs sorted set scored by the lease expiration timestamp
+    leases_key_frmt = '{pool_id}_leases'
+    # Proxy ID pinned to a client session
+    session_key_frmt = '{pool_id}_session:{session}'
+    # Cap checkouts of every leased proxy: proxy ID => <leases key> <checkout> ... (see `release`)
+    lease_caps_key_frmt = '{pool_id}_lease_caps'
+    # Cap groups: proxies and provider plans with caps (see CAPS in scripts.py)
+    proxy_caps_group_frmt = 'proxy_{pid}'
+    plan_caps_group_frmt = 'plan_{plan_id}'
+    caps_keys_frmt = ('{group}_leases', '{group}_bucket')
+    blocked_key_frmt = '{pool_id}_blocked'
+    # Blocked proxies used to be stored in a key per proxy (see `migrate_legacy_blocked`)
+    legacy_blocked_key_frmt = '{pool_id}_blocked:{pid}'
+    legacy_blocked_datetime_frmt = '%Y-%m-%d %H:%M'
+    # Observed success rate and latency (EWMAs) of every proxy
+    success_key_frmt = '{pool_id}_success'
+    latency_key_frmt = '{pool_id}_latency'
+    ewma_alpha = 0.2
+    # Outcome counters (<proxy ID>:<outcome> => count) for the pool and for all the pools
+    outcomes_key_frmt = '{pool_id}_outcomes'
+    global_outcomes_key = 'proxy_outcomes'
+    # Request outcome => success value
+    outcomes = {
+        'success': 1,
+        'ban': 0,
+        'timeout': 0,
+        'error': 0,
+    }
+    # Selection mode => load method
+    load_modes = {
+        'batched': 'load',
+        'atomic': 'load_atomic',
+        'lease': 'load_leased',
+    }
+    # What to do when there are not enough fresh proxies (not used yet and not blocked)
+    # reset: clean the used proxies and reuse them in random order, then unblock random proxies
+    # lru: reuse the least recently used proxies, then unblock the oldest blocks first
+    # partial: return only the fresh proxies. `lru` when there are no fresh proxies at all
+    refill_policies = ('reset', 'lru', 'partial')
 
-    def __init__(self, pool_id: str, pool_len: int, standby_mins: int, redis: object):
+    def __init__(self, pool_id: str, pool_len: int, standby_mins: int, redis: object,
+                 strategy: object = None, lease_ttl: int = 300, refill: str = 'reset'):
         '''
         @param pool_id: the pool ID (ie: the domain or the target ID)
         @param pool_len: the min size of the pool or the min number of proxies to be returned
         @param standby_mins: how much time a blocked proxy should be excluded from the pool
-        @redis: the redis connection pool'''
+        @redis: the redis connection pool
+        @param strategy: the proxy selection strategy (default: RandomStrategy)
+        @param lease_ttl: seconds a proxy is leased for (`lease` selection mode)
+                          and it counts for the max concurrency of its caps
+        @param refill: the refill policy (see `refill_policies`, batched and atomic modes)'''
         self.pool_id = pool_id
         self.pool_len = pool_len
         self.standby_mins = standby_mins
         self.redis = redis
+        self.strategy = strategy if strategy is not None else RandomStrategy()
+        self.lease_ttl = lease_ttl
+        if refill not in self.refill_policies:
+            raise ValueError('Not valid refill policy: {}'.format(refill))
+        self.refill = refill
+        self.lru_scores = {}
+        self.blocked_scores = {}
         self.pool = []
+        # Checkout ID of the caps taken by the last load (see `unuse`)
+        self.checkout_id = None
 
     @property
     def length(self):
         '''Return the pool length'''
         return len(self.pool)
 
-    async def load(self, *proxies):
+    @property
+    def used_key(self):
+        '''Return the Redis key of the used proxy IDs set'''
+        return self.used_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def lru_key(self):
+        '''Return the Redis key of the last use sorted set'''
+        return self.lru_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def leases_key(self):
+        '''Return the Redis key of the leased proxy IDs sorted set'''
+        return self.leases_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def lease_caps_key(self):
+        '''Return the Redis key of the cap checkouts of the leased proxies hash'''
+        return self.lease_caps_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def blocked_key(self):
+        '''Return the Redis key of the blocked proxy IDs sorted set'''
+        return self.blocked_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def success_key(self):
+        '''Return the Redis key of the success rate EWMAs hash'''
+        return self.success_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def latency_key(self):
+        '''Return the Redis key of the latency EWMAs hash'''
+        return self.latency_key_frmt.format(pool_id=self.pool_id)
+
+    @property
+    def outcomes_key(self):
+        '''Return the Redis key of the outcome counters hash'''
+        return self.outcomes_key_frmt.format(pool_id=self.pool_id)
+
+    def blocked_until(self, now: float = None):
+        '''Return the timestamp when a proxy blocked at `now` (default: now) must be unblocked'''
+        if now is None:
+            now = time.time()
+        return now + self.standby_mins * 60
+
+    def loader(self, mode: str):
+        '''Return the load method for the selection mode `mode`'''
+        if mode not in self.load_modes:
+            raise ValueError('Not valid pool selection mode: {}'.format(mode))
+        return getattr(self, self.load_modes[mode])
+
+    async def load_session(self, session: str, ttl: int, *proxies, blocked_ids=(),
+                           mode: str = 'batched'):
+        '''Load the proxy pinned to the session in the pool
+        A new proxy is loaded with the `mode` selection mode and pinned to the session
+        if there is no proxy pinned yet or the pinned proxy is blocked, not available
+        or at its caps (the caps of the pinned proxy are taken every time it is returned)
+        Concurrent requests of a new session get the same proxy (the first one pinned)
+        In lease mode the lease of the pinned proxy is renewed every time it is returned
+        @param session: the session key given by the client
+        @param ttl: seconds the session lasts since it was used last time
+        @param *proxies: a list of already filtered proxy objects (dict)
+        @param blocked_ids: proxy IDs to be set as blocked before loading the pool
+        @param mode: the selection mode (see `load_modes`)'''
+        session_key = self.session_key_frmt.format(pool_id=self.pool_id, session=session)
+        if blocked_ids:
+            await self.set_as_blocked_list(*blocked_ids)
+        pinned_id = await self.redis.get(session_key)
+        if pinned_id is not None:
+            pinned_id = int(pinned_id)
+            proxy = next((proxy for proxy in proxies if proxy['id'] == pinned_id), None)
+            if proxy is not None and (proxy['dont_block'] or not await self.is_blocked(pinned_id)):
+                if await self._take_session_caps(proxy, mode):
+                    await self.redis.expire(session_key, ttl)
+                    if mode == 'lease':
+                        await self.renew_leases(pinned_id)
+                    self.pool.append(dict(proxy))
+                    return
+                if mode == 'lease':
+                    await self.release(pinned_id)
+        await self.loader(mode)(*proxies)
+        if not self.pool:
+            return
+        session_id = int(await PIN_SESSION(self.redis, keys=[session_key], args=[
+            '' if pinned_id is None else pinned_id, self.pool[0]['id'], ttl]))
+        proxy = next((proxy for proxy in proxies if proxy['id'] == session_id), None)
+        if session_id == self.pool[0]['id'] or proxy is None:
+            return
+        if mode == 'lease':
+            await self.release(*[proxy['id'] for proxy in self.pool])
+            await self.renew_leases(session_id)
+        self.pool = [dict(proxy)]
+
+    async def _take_session_caps(self, proxy: dict, mode: str):
+        '''Take the caps of the proxy pinned to a session
+        In lease mode its concurrency is held by its lease: only the tokens are taken
+        @return: False if the proxy is at its caps'''
+        if mode == 'lease':
+            proxy = dict(proxy, max_concurrency=None, plan_max_concurrency=None)
+        caps_keys, caps_args = self.get_caps_args({proxy['id']: proxy})
+        if not caps_keys:
+            return True
+        return bool(await self.take_caps(caps_keys, caps_args, [proxy['id']]))
+
+    async def load(self, *proxies, blocked_ids=()):
         '''Load N (self.pool_len) proxies in the pool if available
         The pool size is a minimum number of proxies.
         It will reuse proxies if necessary or use blocked proxies
         To load N number of proxies is a MUST for this method
-        @param *proxies: a list of already filtered proxy objects (dict)'''
-        blocked_ids = set()
-        used_ids = await self.get_used_ids()
+        The Redis state is read in one round trip and written back in a second one
+        If some proxies have caps, their caps are checked before the selection
+        and taken after it (two more round trips)
+        @param *proxies: a list of already filtered proxy objects (dict)
+        @param blocked_ids: proxy IDs to be set as blocked before loading the pool'''
         proxy_map = {proxy['id']: dict(proxy) for proxy in proxies}
         all_ids = {int(proxy_id) for proxy_id in proxy_map}
-        available_ids = all_ids
-        if used_ids:
-            available_ids = available_ids - used_ids
-        for proxy_id in available_ids:
-            proxy_blocked = await self.is_blocked(proxy_id)
-            if proxy_blocked:
-                if not proxy_map[proxy_id]['dont_block']:
-                    blocked_ids.add(proxy_id)
-        if blocked_ids:
-            available_ids = available_ids - blocked_ids
-        if len(available_ids) < self.pool_len:
-            # First will try cleaning used proxies and adding some used proxies
-            if used_ids:
-                await self.clean_used_stack()
-                _ = self.fill_pool_ids(available_ids, used_ids)
+        caps_keys, caps_args = self.get_caps_args(proxy_map)
+        if caps_keys:
+            all_ids -= await self.get_saturated_ids(caps_keys, caps_args)
+        used_ids, blocked_ids = await self.get_state(new_blocked_ids=blocked_ids)
+        blocked_ids = {proxy_id for proxy_id in blocked_ids & all_ids
+                       if not proxy_map[proxy_id]['dont_block']}
+        available_ids = all_ids - used_ids - blocked_ids
+        clean_used = False
+        unblocked_ids = []
+        if len(available_ids) < self.pool_len and not (self.refill == 'partial' and available_ids):
+            if self.refill == 'reset':
+                # First will try cleaning used proxies and adding some used proxies
+                if used_ids:
+                    clean_used = True
+                    _ = self.fill_pool_ids(available_ids, (used_ids & all_ids) - blocked_ids,
+                                           proxy_map)
+            else:
+                # First will try adding the least recently used proxies
+                _ = self.fill_pool_ids(available_ids, (used_ids & all_ids) - blocked_ids,
+                                       proxy_map, sort_key=lambda pid: self.lru_scores.get(pid, 0))
             # If the length is still low then it will try using blocked proxies
             if len(available_ids) < self.pool_len and blocked_ids:
-                added_ids = self.fill_pool_ids(available_ids, blocked_ids)
-                for blocked_id in added_ids:
-                    await self.unblock_proxy(blocked_id)
-        for proxy_id in available_ids:
-            if len(self.pool) >= self.pool_len:
+                sort_key = None if self.refill == 'reset' else self.blocked_scores.get
+                unblocked_ids = self.fill_pool_ids(available_ids, blocked_ids, proxy_map,
+                                                   sort_key=sort_key)
+        selected_ids = []
+        for proxy_id in self.strategy.order(available_ids, proxy_map):
+            if len(selected_ids) >= self.pool_len:
                 break
             # Some previous filters can exclude proxies
             if proxy_id in proxy_map:
-                self.pool.append(proxy_map[proxy_id])
-                await self.set_as_used(proxy_id)
+                selected_ids.append(proxy_id)
+        if caps_keys and selected_ids:
+            # The proxies saturated in the meantime are discarded
+            selected_ids = await self.take_caps(caps_keys, caps_args, selected_ids)
+            unblocked_ids = [proxy_id for proxy_id in unblocked_ids if proxy_id in selected_ids]
+        for proxy_id in selected_ids:
+            self.pool.append(proxy_map[proxy_id])
+        await self.commit_state(selected_ids, unblocked_ids, clean_used=clean_used)
+
+    async def get_state(self, new_blocked_ids=()):
+        '''Get the used IDs and the IDs blocked right now
+        The stats needed by the selection strategy are fetched as well
+        as the last use of every proxy for the `lru` and `partial` refill policies
+        (`lru_scores`) and the unblock timestamps (`blocked_scores`)
+        Expired blocks are removed. Everything is done in a single pipelined round trip
+        @param new_blocked_ids: proxy IDs to be set as blocked in the same round trip
+        @return: tuple of sets <used IDs>, <blocked IDs>'''
+        now = time.time()
+        pipe = self.redis.pipeline()
+        if new_blocked_ids:
+            pipe.zadd(self.blocked_key, *self._blocked_pairs(new_blocked_ids, now))
+        pipe.zremrangebyscore(self.blocked_key, max=now)
+        pipe.smembers(self.used_key)
+        pipe.zrangebyscore(self.blocked_key, min=now, exclude=self.redis.ZSET_EXCLUDE_MIN,
+                           withscores=True)
+        lru_no = 0
+        if self.refill != 'reset':
+            pipe.zrange(self.lru_key, withscores=True)
+            lru_no = 1
+        stats_no = self.strategy.stats_commands(pipe, self)
+        results = await pipe.execute()
+        if stats_no:
+            self.strategy.load_stats(results[-stats_no:])
+            results = results[:-stats_no]
+        if lru_no:
+            self.lru_scores = {int(pid): score for pid, score in results[-1]}
+            results = results[:-1]
+        used_ids = {int(pid) for pid in results[-2]}
+        self.blocked_scores = {int(pid): score for pid, score in results[-1]}
+        return used_ids, set(self.blocked_scores)
+
+    async def get_strategy_stats(self):
+        '''Fetch the stats needed by the selection strategy (if any)'''
+        pipe = self.redis.pipeline()
+        stats_no = self.strategy.stats_commands(pipe, self)
+        if stats_no:
+            self.strategy.load_stats(await pipe.execute())
+
+    async def commit_state(self, used_ids, unblocked_ids, clean_used=False):
+        '''Write all the pool mutations in a single MULTI/EXEC round trip
+        @param used_ids: proxy IDs to be set as used
+        @param unblocked_ids: proxy IDs to be unblocked
+        @param clean_used: clean the used stack before setting the new used IDs'''
+        if not (used_ids or unblocked_ids or clean_used):
+            return
+        transaction = self.redis.multi_exec()
+        if clean_used:
+            transaction.delete(self.used_key)
+        if unblocked_ids:
+            transaction.zrem(self.blocked_key, *unblocked_ids)
+        if used_ids:
+            transaction.sadd(self.used_key, *used_ids)
+            now = time.time()
+            lru_pairs = []
+            for pid in used_ids:
+                lru_pairs += [now, pid]
+            transaction.zadd(self.lru_key, *lru_pairs)
+        await transaction.execute()
 
-    def fill_pool_ids(self, pool_set, ids_set):
+    async def load_atomic(self, *proxies, blocked_ids=()):
+        '''Load N (self.pool_len) proxies in the pool like `load` does
+        The whole selection runs in Redis as a single Lua script so concurrent
+        requests for the same pool never get the same proxies
+        @param *proxies: a list of already filtered proxy objects (dict)
+        @param blocked_ids: proxy IDs to be set as blocked before loading the pool'''
+        await self._load_with_script(SELECT_POOL, [self.used_key, self.blocked_key, self.lru_key],
+                                     proxies, blocked_ids, self.refill)
+
+    async def load_leased(self, *proxies, blocked_ids=()):
+        '''Load N (self.pool_len) proxies in the pool and lease them for `lease_ttl` seconds
+        A leased proxy is not returned again until it is released or its lease expires
+        so concurrent workers of the same pool get disjoint proxies
+        If there are not enough proxies it will use blocked proxies and then the proxies
+        with the oldest leases
+        @param *proxies: a list of already filtered proxy objects (dict)
+        @param blocked_ids: proxy IDs to be set as blocked (and released) before loading the pool'''
+        if blocked_ids:
+            # Their cap checkouts are released too
+            await self.set_as_blocked_list(*blocked_ids)
+        await self._load_with_script(LEASE_POOL,
+                                     [self.leases_key, self.blocked_key, self.lease_caps_key],
+                                     proxies, ())
+
+    @classmethod
+    def get_caps_groups(cls, proxy: dict):
+        '''Return the cap groups of the proxy: the proxy and its plan (if they have caps)
+        The caps of a plan are shared by all the proxies of the plan
+        and the caps of a backconnect gateway by all its virtual slots
+        @return: list of tuples <group>, <max concurrency or None>, <max rpm or None>'''
+        groups = []
+        concurrency, rpm = proxy.get('max_concurrency'), proxy.get('max_rpm')
+        if concurrency is not None or rpm is not None:
+            groups.append((cls.proxy_caps_group_frmt.format(pid=get_proxy_id(proxy['id'])),
+                           concurrency, rpm))
+        concurrency, rpm = proxy.get('plan_max_concurrency'), proxy.get('plan_max_rpm')
+        if proxy.get('provider_plan_id') is not None and (concurrency is not None or
+                                                          rpm is not None):
+            groups.append((cls.plan_caps_group_frmt.format(plan_id=proxy['provider_plan_id']),
+                           concurrency, rpm))
+        return groups
+
+    @classmethod
+    def get_caps_args(cls, proxy_map: dict):
+        '''Return the cap group keys and the caps of the proxies as expected by the scripts
+        (see CAPS in scripts.py)
+        @return: tuple <list of keys>, <list: cap groups of the proxies, caps of the groups>'''
+        group_numbers = {}
+        groups_caps = []
+        keys = []
+        proxies_groups = []
+        for pid, proxy in proxy_map.items():
+            numbers = []
+            for group, concurrency, rpm in cls.get_caps_groups(proxy):
+                if group not in group_numbers:
+                    group_numbers[group] = len(group_numbers) + 1
+                    groups_caps.append('{}:{}'.format('' if concurrency is None else concurrency,
+                                                      '' if rpm is None else rpm))
+                    keys += [key_frmt.format(group=group) for key_frmt in cls.caps_keys_frmt]
+                numbers.append(str(group_numbers[group]))
+            if numbers:
+                proxies_groups.append(':'.join([str(pid)] + numbers))
+        return keys, [','.join(proxies_groups), ','.join(groups_caps)]
+
+    def _checkout_args(self, now: float):
+        '''Return the checkout ID (unique) and the checkout expiration (see CAPS in scripts.py)'''
+        self.checkout_id = '{}:{}'.format(self.pool_id, uuid.uuid4().hex)
+        return [self.checkout_id, now + self.lease_ttl]
+
+    async def get_saturated_ids(self, caps_keys, caps_args):
+        '''Return the IDs of the proxies that are at their caps right now
+        @param caps_keys, caps_args: see `get_caps_args`
+        @return: set of IDs (int)'''
+        capped_ids = [int(groups.split(':', 1)[0]) for groups in caps_args[0].split(',')]
+        free_ids = await self._run_take_caps(caps_keys, caps_args, capped_ids, take=False)
+        return set(capped_ids) - set(free_ids)
+
+    async def take_caps(self, caps_keys, caps_args, proxy_ids):
+        '''Take the caps of the proxies (batched mode)
+        @param caps_keys, caps_args: see `get_caps_args`
+        @return: list of the IDs of the proxies that were not saturated, in the same order'''
+        return await self._run_take_caps(caps_keys, caps_args, proxy_ids, take=True)
+
+    async def _run_take_caps(self, caps_keys, caps_args, proxy_ids, take: bool):
+        now = time.time()
+        args = ['1' if take else '0', now, ''] + caps_args + self._checkout_args(now)
+        free_ids = await TAKE_CAPS(self.redis, keys=caps_keys, args=args + list(proxy_ids))
+        return [int(pid) for pid in free_ids]
+
+    async def _load_with_script(self, script, keys, proxies, blocked_ids, *extra_args):
+        '''Load the pool running a selection script
+        KEYS: the script keys and the cap group keys
+        ARGV: pool length, now, unblock timestamp, caps and checkout (see CAPS in scripts.py),
+        *extra_args, dont_block flags, number of blocked IDs (M), M blocked IDs
+        and the candidate IDs'''
+        proxy_map = {int(proxy['id']): dict(proxy) for proxy in proxies}
+        if not proxy_map:
+            if blocked_ids:
+                await self.set_as_blocked_list(*blocked_ids)
+            return
+        await self.get_strategy_stats()
+        candidate_ids = self.strategy.order(proxy_map, proxy_map)
+        now = time.time()
+        flags = ''.join('1' if proxy_map[pid]['dont_block'] else '0' for pid in candidate_ids)
+        caps_keys, caps_args = self.get_caps_args(proxy_map)
+        args = [self.pool_len, now, self.blocked_until(now)] + caps_args
+        args += self._checkout_args(now)
+        args += list(extra_args)
+        args += [flags, len(blocked_ids)]
+        args += list(blocked_ids)
+        args += candidate_ids
+        selected_ids = await script(self.redis, keys=list(keys) + caps_keys, args=args)
+        for proxy_id in selected_ids:
+            self.pool.append(proxy_map[int(proxy_id)])
+
+    def fill_pool_ids(self, pool_set, ids_set, proxy_map=None, sort_key=None):
         '''Given an input pool set and a second pool with optional proxy ids
-        will try to add ids to the input pool until it's full (self.pool_len)'''
-        # It uses random.shuffle to give some random choice of the proxy IDs to add
+        will try to add ids to the input pool until it's full (self.pool_len)
+        @param sort_key: function giving the order of the proxy IDs to add (optional)'''
+        # The selection strategy gives the order of the proxy IDs to add (random by default)
+        if sort_key is None:
+            ordered_ids = self.strategy.order(ids_set, proxy_map or {})
+        else:
+            ordered_ids = sorted(ids_set, key=sort_key)
         added_ids = []
-        ids_list = list(ids_set)
-        random.shuffle(ids_list)
-        for proxy_id in ids_list:
+        for proxy_id in ordered_ids:
             if len(pool_set) >= self.pool_len:
                 break
             pool_set.add(proxy_id)
@@ -91,52 +456,196 @@ class ProxyPool:
 
     async def is_blocked(self, pid: int):
         '''Check if the proxy ID (pid) is blocked'''
-        blocked_key = self.blocked_key_frmt.format(pool_id=self.pool_id, pid=pid)
-        blocked_res = await self.redis.get(blocked_key)
-        if blocked_res is not None:
-            blocked_time = datetime.strptime(blocked_res.decode('utf-8'),
-                                             self.blocked_datetime_frmt)
-            blocked_range = datetime.now() - blocked_time
-            if blocked_range < timedelta(minutes=self.standby_mins):
-                return True
-            # Remove register
-            await self.redis.delete(blocked_key)
-        return False
+        blocked_until = await self.redis.zscore(self.blocked_key, pid)
+        return blocked_until is not None and blocked_until > time.time()
 
     async def get_used_ids(self):
         '''Get the already used proxy IDs
         @return: set of IDs (int)'''
-        used_key = self.used_key_frmt.format(pool_id=self.pool_id)
-        used_list = await self.redis.smembers(used_key)
+        used_list = await self.redis.smembers(self.used_key)
         return {int(pid) for pid in used_list}
 
+    async def get_blocked_ids(self):
+        '''Get the proxy IDs blocked right now
+        @return: set of IDs (int)'''
+        blocked_list = await self.redis.zrangebyscore(self.blocked_key, min=time.time(),
+                                                      exclude=self.redis.ZSET_EXCLUDE_MIN)
+        return {int(pid) for pid in blocked_list}
+
+    async def get_fresh_ids(self, *proxies):
+        '''Get the IDs of the proxies that can be loaded without refilling the pool:
+        not used, not blocked (but `dont_block` ones) and not at their caps
+        @param *proxies: a list of already filtered proxy objects (dict)
+        @return: set of IDs (int)'''
+        proxy_map = {proxy['id']: proxy for proxy in proxies}
+        used_ids = await self.get_used_ids()
+        blocked_ids = await self.get_blocked_ids()
+        fresh_ids = {pid for pid, proxy in proxy_map.items() if pid not in used_ids and
+                     (proxy['dont_block'] or pid not in blocked_ids)}
+        caps_keys, caps_args = self.get_caps_args(proxy_map)
+        if caps_keys and fresh_ids:
+            fresh_ids -= await self.get_saturated_ids(caps_keys, caps_args)
+        return fresh_ids
+
     async def clean_used_stack(self):
         '''Clean the used proxy IDs stack'''
-        used_key = self.used_key_frmt.format(pool_id=self.pool_id)
-        await self.redis.delete(used_key)
+        await self.redis.delete(self.used_key)
+
+    async def clean_blocked(self):
+        '''Remove the expired blocks'''
+        await self.redis.zremrangebyscore(self.blocked_key, max=time.time())
 
     async def set_as_used(self, pid: int):
         '''Set the proxy ID as used'''
-        used_key = self.used_key_frmt.format(pool_id=self.pool_id)
-        await self.redis.sadd(used_key, pid)
+        await self.redis.sadd(self.used_key, pid)
 
     async def set_as_used_list(self, *pids):
         '''Set as used a list of proxy IDS'''
+        if pids:
+            await self.redis.sadd(self.used_key, *pids)
+
+    def _blocked_pairs(self, pids, now: float = None):
+        '''Return the <score>, <member> pairs to block the proxy IDs (ZADD arguments)'''
+        blocked_until = self.blocked_until(now)
+        pairs = []
         for pid in pids:
-            await self.set_as_used(pid)
+            pairs += [blocked_until, pid]
+        return pairs
 
     async def set_as_blocked(self, pid: int):
         '''Set the proxy ID as blocked'''
-        blocked_key = self.blocked_key_frmt.format(pool_id=self.pool_id, pid=pid)
-        blocked_time_str = datetime.now().strftime(self.blocked_datetime_frmt)
-        await self.redis.set(blocked_key, blocked_time_str)
+        await self.redis.zadd(self.blocked_key, self.blocked_until(), pid)
 
     async def set_as_blocked_list(self, *pids):
-        '''Set as blocked a lost of proxy IDs'''
-        for pid in pids:
-            await self.set_as_blocked(pid)
+        '''Set as blocked a lost of proxy IDs. Their leases are released'''
+        if pids:
+            lease_caps = await self.redis.hmget(self.lease_caps_key, *pids)
+            transaction = self.redis.multi_exec()
+            transaction.zadd(self.blocked_key, *self._blocked_pairs(pids))
+            self._release(transaction, pids, lease_caps)
+            await transaction.execute()
+
+    async def release(self, *pids):
+        '''Release the leases (and their cap checkouts) of the proxy IDs'''
+        if pids:
+            lease_caps = await self.redis.hmget(self.lease_caps_key, *pids)
+            transaction = self.redis.multi_exec()
+            self._release(transaction, pids, lease_caps)
+            await transaction.execute()
+
+    def _release(self, transaction, pids, lease_caps):
+        '''Add the commands releasing the leases of the proxy IDs to the transaction
+        @param lease_caps: the cap checkouts of the proxies (`lease_caps_key` values)'''
+        transaction.zrem(self.leases_key, *pids)
+        transaction.hdel(self.lease_caps_key, *pids)
+        for key, checkout in self._parse_lease_caps(lease_caps):
+            transaction.zrem(key, checkout)
+
+    @staticmethod
+    def _parse_lease_caps(lease_caps):
+        '''Return the cap checkouts of the leases: list of tuples <leases key>, <checkout>
+        @param lease_caps: the cap checkouts of the proxies (`lease_caps_key` values)'''
+        pairs = []
+        for checkouts in lease_caps:
+            if checkouts:
+                checkouts = checkouts.decode('utf-8').split(' ')
+                pairs += zip(checkouts[::2], checkouts[1::2])
+        return pairs
+
+    async def renew_leases(self, *pids):
+        '''Renew the leases (and their cap checkouts) of the proxy IDs for `lease_ttl` seconds'''
+        if pids:
+            lease_caps = await self.redis.hmget(self.lease_caps_key, *pids)
+            checkouts = self._parse_lease_caps(lease_caps)
+            now = time.time()
+            await RENEW_LEASES(
+                self.redis,
+                keys=[self.leases_key, self.lease_caps_key] + [key for key, _ in checkouts],
+                args=[now, now + self.lease_ttl, len(pids), *pids] +
+                [checkout for _, checkout in checkouts])
+
+    async def unuse(self, checkout_id, *proxies):
+        '''Undo the load of proxies that were never returned (ie: expired in a buffer)
+        They are not used anymore and their cap checkouts are released
+        @param checkout_id: the checkout ID of the load (`checkout_id`)
+        @param *proxies: the proxy objects (dict)'''
+        if not proxies:
+            return
+        transaction = self.redis.multi_exec()
+        transaction.srem(self.used_key, *[proxy['id'] for proxy in proxies])
+        if checkout_id is not None:
+            for proxy in proxies:
+                checkout = '{}:{}'.format(checkout_id, proxy['id'])
+                for group, concurrency, _ in self.get_caps_groups(proxy):
+                    if concurrency is not None:
+                        transaction.zrem(self.caps_keys_frmt[0].format(group=group), checkout)
+        await transaction.execute()
+
+    async def get_leased_ids(self):
+        '''Get the proxy IDs leased right now
+        @return: set of IDs (int)'''
+        leased_list = await self.redis.zrangebyscore(self.leases_key, min=time.time(),
+                                                     exclude=self.redis.ZSET_EXCLUDE_MIN)
+        return {int(pid) for pid in leased_list}
 
     async def unblock_proxy(self, pid: int):
         '''Force to unblock a proxy ID'''
-        blocked_key = self.blocked_key_frmt.format(pool_id=self.pool_id, pid=pid)
-        await self.redis.delete(blocked_key)
+        await self.redis.zrem(self.blocked_key, pid)
+
+    async def record_outcomes(self, *outcomes):
+        '''Record the outcomes of some requests made with the pool proxies (single Redis call)
+        It increments the outcome counters and updates the success rate and latency EWMAs
+        @param *outcomes: tuples <proxy ID>, <outcome (see `outcomes`)>, <latency ms or None>'''
+        if not outcomes:
+            return
+        args = [self.ewma_alpha]
+        for pid, outcome, latency in outcomes:
+            args += [pid, outcome, self.outcomes[outcome], '' if latency is None else latency]
+        await RECORD_OUTCOMES(self.redis,
+                              keys=[self.success_key, self.latency_key,
+                                    self.outcomes_key, self.global_outcomes_key],
+                              args=args)
+
+    async def get_stats(self):
+        '''Return the outcome counters, success rate and latency of every proxy in the pool
+        @return: dict proxy ID => stats (dict)'''
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.outcomes_key)
+        pipe.hgetall(self.success_key)
+        pipe.hgetall(self.latency_key)
+        counters, success, latency = await pipe.execute()
+        stats = {}
+        for counter, count in counters.items():
+            pid, outcome = counter.decode('utf-8').split(':', 1)
+            stats.setdefault(int(pid), {})[outcome] = int(count)
+        for pid, value in success.items():
+            stats.setdefault(int(pid), {})['success_rate'] = float(value)
+        for pid, value in latency.items():
+            stats.setdefault(int(pid), {})['latency_ms'] = float(value)
+        return stats
+
+    async def migrate_legacy_blocked(self):
+        '''Move the blocks stored in a key per proxy (`legacy_blocked_key_frmt`)
+        to the blocked sorted set. Expired blocks are just removed
+        @return: the number of migrated blocks'''
+        match = self.legacy_blocked_key_frmt.format(pool_id=self.pool_id, pid='*')
+        legacy_keys = [key async for key in self.redis.iscan(match=match)]
+        if not legacy_keys:
+            return 0
+        values = await self.redis.mget(*legacy_keys)
+        now = time.time()
+        pairs = []
+        for key, value in zip(legacy_keys, values):
+            if value is None:
+                continue
+            blocked_time = datetime.strptime(value.decode('utf-8'),
+                                             self.legacy_blocked_datetime_frmt)
+            blocked_until = self.blocked_until(blocked_time.timestamp())
+            if blocked_until > now:
+                pairs += [blocked_until, int(key.decode('utf-8').rsplit(':', 1)[1])]
+        transaction = self.redis.multi_exec()
+        if pairs:
+            transaction.zadd(self.blocked_key, *pairs)
+        transaction.delete(*legacy_keys)
+        await transaction.execute()
+        return len(pairs) // 2
@@ -0,0 +1,218 @@
+"""
+Proxy Pool Prewarmer
+
+Keeps an in memory buffer of already selected proxies for the hot targets
+(targets and filters requested at least `min_rate` times a second)
+so a proxy list request just takes its proxies from the buffer:
+no database queries and no Redis calls in the request
+
+A background task refills the buffers every `interval` seconds with enough proxies
+for the requests expected until the next refill. The proxies are selected with
+the pool selection mode (they are set as used when they enter the buffer)
+Only fresh proxies (not used and not blocked) are buffered: refilling a pool
+(cleaning the used proxies or unblocking proxies on standby) is left to the requests
+Buffered proxies older than `max_age` seconds are discarded: they are not used anymore
+and their cap checkouts are released (see ProxyPool.unuse)
+"""
+
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from collections import defaultdict
+from collections import Counter
+
+from lib.proxies.pool import ProxyPool
+
+
+class PoolPrewarmer:  # pylint: disable=too-many-instance-attributes
+    '''Proxy Pool Prewarmer'''
+
+    # Weight of the last interval in the request rates (EWMA)
+    rate_alpha = 0.3
+
+    def __init__(self, fetch_proxies, redis: object, mode: str = 'batched',
+                 strategy_factory=None, refill='reset', lease_ttl=300, interval: float = 1.0,
+                 min_rate: float = 1.0, max_age: float = 30.0, max_pools: int = 10):
+        '''
+        @param fetch_proxies: coroutine function (target identifier, codes) returning
+        the target data and the proxies allowed for the target (see get_target_proxies)
+        @param redis: the redis connection pool
+        @param mode: the pool selection mode (see ProxyPool.load_modes)
+        @param strategy_factory: function returning a new selection strategy
+        @param refill: the pool refill policy (see ProxyPool.refill_policies)
+                       or a function returning it (ie: read from the reloaded config)
+        @param lease_ttl: seconds a proxy counts for its max concurrency (see ProxyPool)
+                          or a function returning it
+        @param interval: seconds between refills
+        @param min_rate: requests per second for a target to be prewarmed
+        @param max_age: seconds a proxy can stay in the buffer
+        @param max_pools: max number of pools buffered per target'''
+        self.fetch_proxies = fetch_proxies
+        self.redis = redis
+        self.mode = mode
+        self.strategy_factory = strategy_factory
+        self._refill = refill
+        self._lease_ttl = lease_ttl
+        self.interval = interval
+        self.min_rate = min_rate
+        self.max_age = max_age
+        self.max_pools = max_pools
+        # Buffer key (target identifier, codes) =>
+        # deque of <timestamp>, <target ID>, <proxy>, <checkout ID>
+        self.buffers = {}
+        # Buffer items discarded before being taken, to be unused in the next refill
+        self.expired = []
+        self.requests = Counter()
+        self.rates = {}
+        self.pool_lens = {}
+        self.codes = {}
+        self._task = None
+        self._last_run = None
+
+    @property
+    def refill_policy(self):
+        '''Return the pool refill policy'''
+        return self._refill() if callable(self._refill) else self._refill
+
+    @property
+    def lease_ttl(self):
+        '''Return the lease TTL of the pools'''
+        return self._lease_ttl() if callable(self._lease_ttl) else self._lease_ttl
+
+    @staticmethod
+    def get_key(target_identifier: str, codes: dict):
+        '''Return the buffer key of the target and filter'''
+        return target_identifier, tuple(sorted((key, code) for key, code in codes.items()
+                                               if code is not None))
+
+    async def start(self):
+        '''Start the refill task'''
+        self._last_run = time.time()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        '''Stop the refill task'''
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def take(self, target_identifier: str, codes: dict, pool_len: int):
+        '''Take `pool_len` proxies from the buffer of the target and filter
+        The request is counted for the request rate when there are enough proxies
+        (otherwise `record` must be called once the target is known to exist)
+        @return: tuple <target ID>, <proxies (list of dicts)> or None if there are not enough'''
+        key = self.get_key(target_identifier, codes)
+        buffer = self.buffers.get(key)
+        if not buffer:
+            return None
+        self.prune(buffer)
+        if len(buffer) < pool_len:
+            return None
+        self.record(target_identifier, codes, pool_len)
+        items = [buffer.popleft() for _ in range(pool_len)]
+        return items[0][1], [item[2] for item in items]
+
+    def prune(self, buffer: deque):
+        '''Discard the items older than `max_age` seconds'''
+        min_time = time.time() - self.max_age
+        while buffer and buffer[0][0] < min_time:
+            self.expired.append(buffer.popleft())
+
+    def record(self, target_identifier: str, codes: dict, pool_len: int):
+        '''Count a request of an existing target and filter for the request rate'''
+        key = self.get_key(target_identifier, codes)
+        self.requests[key] += 1
+        self.pool_lens[key] = pool_len
+        self.codes[key] = codes
+
+    def discard(self, target_id: int, proxy_ids):
+        '''Remove the proxies from every buffer of the target (ie: they were blocked)
+        Their cap checkouts are released in the next refill'''
+        proxy_ids = set(proxy_ids)
+        for key, buffer in self.buffers.items():
+            if buffer and buffer[0][1] == target_id:
+                self.expired.extend(item for item in buffer if item[2]['id'] in proxy_ids)
+                self.buffers[key] = deque(item for item in buffer
+                                          if item[2]['id'] not in proxy_ids)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refill()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Unable to refill the proxy pool buffers')
+
+    def update_rates(self):
+        '''Update the request rates with the requests since the last refill
+        The targets not requested anymore are forgotten'''
+        now = time.time()
+        elapsed = max(now - self._last_run, 0.001)
+        self._last_run = now
+        requests, self.requests = self.requests, Counter()
+        for key in set(self.rates) | set(requests):
+            rate = requests[key] / elapsed
+            if key in self.rates:
+                rate = self.rates[key] * (1 - self.rate_alpha) + rate * self.rate_alpha
+            if rate < self.min_rate / 10:
+                self.forget(key)
+            else:
+                self.rates[key] = rate
+
+    def forget(self, key):
+        '''Forget the buffer and the request rate of the target and filter'''
+        self.rates.pop(key, None)
+        self.expired.extend(self.buffers.pop(key, ()))
+        self.pool_lens.pop(key, None)
+        self.codes.pop(key, None)
+
+    async def unuse_expired(self):
+        '''Undo the load of the discarded buffer items (see ProxyPool.unuse)'''
+        expired, self.expired = self.expired, []
+        loads = defaultdict(list)
+        for _, target_id, proxy, checkout_id in expired:
+            loads[(target_id, checkout_id)].append(proxy)
+        for (target_id, checkout_id), proxies in loads.items():
+            proxy_pool = ProxyPool(pool_id=str(target_id), pool_len=0, standby_mins=0,
+                                   redis=self.redis)
+            await proxy_pool.unuse(checkout_id, *proxies)
+
+    async def refill(self):
+        '''Refill the buffers of the hot targets'''
+        self.update_rates()
+        for buffer in self.buffers.values():
+            self.prune(buffer)
+        await self.unuse_expired()
+        for key, rate in list(self.rates.items()):
+            if rate < self.min_rate:
+                continue
+            pool_len = self.pool_lens[key]
+            pools = min(math.ceil(rate * self.interval) + 1, self.max_pools)
+            buffer = self.buffers.setdefault(key, deque())
+            missing = pools - len(buffer) // pool_len
+            if missing > 0:
+                await self.fill(key, buffer, missing)
+
+    async def fill(self, key, buffer: deque, pools: int):
+        '''Add up to `pools` pools selected by the proxy pool to the buffer
+        It stops when there are not enough fresh proxies for a pool'''
+        target_identifier, _ = key
+        target_data, all_proxies = await self.fetch_proxies(target_identifier, self.codes[key])
+        if target_data is None:
+            self.forget(key)
+            return
+        pool_len = self.pool_lens[key]
+        for _ in range(pools):
+            strategy = self.strategy_factory() if self.strategy_factory is not None else None
+            proxy_pool = ProxyPool(pool_id=str(target_data['id']), pool_len=pool_len,
+                                   standby_mins=target_data['blocked_standby'],
+                                   redis=self.redis, strategy=strategy,
+                                   lease_ttl=self.lease_ttl, refill=self.refill_policy)
+            if len(await proxy_pool.get_fresh_ids(*all_proxies)) < pool_len:
+                break
+            await proxy_pool.loader(self.mode)(*all_proxies)
+            now = time.time()
+            buffer.extend((now, target_data['id'], proxy, proxy_pool.checkout_id)
+                          for proxy in proxy_pool.pool)
@@ -0,0 +1,100 @@
+"""
+Proxy Rotation
+
+A precomputed round robin queue of proxy IDs per pool and filter in Redis
+Every call returns the next proxy in a single Redis call (see NEXT_PROXY in scripts.py)
+The blocked proxies of the pool are skipped, and so are the proxies at their caps
+(see CAPS in scripts.py): the caps of the queue proxies are stored with the queue
+
+The queue expires after `ttl` seconds so it is rebuilt with the current proxies
+"""
+
+import json
+import uuid
+import random
+
+from lib.proxies.scripts import NEXT_PROXY
+from lib.proxies.pool import ProxyPool
+
+
+class ProxyRotation:
+    '''Proxy Rotation'''
+
+    # Rotation queue of proxy IDs
+    queue_key_frmt = '{pool_id}_rotation:{signature}'
+    # Proxy ID => proxy object (JSON)
+    proxies_key_frmt = '{pool_id}_rotation:{signature}:proxies'
+    # IDs of the proxies that are never blocked
+    dont_block_key_frmt = '{pool_id}_rotation:{signature}:dont_block'
+    # Cap group keys and caps of the queue proxies (JSON, see ProxyPool.get_caps_args)
+    caps_key_frmt = '{pool_id}_rotation:{signature}:caps'
+    # Same as ProxyPool.blocked_key_frmt
+    blocked_key_frmt = '{pool_id}_blocked'
+
+    def __init__(self, pool_id: str, redis: object, signature: str = '', ttl: int = 60,
+                 lease_ttl: int = 300):
+        '''
+        @param pool_id: the pool ID (ie: the domain or the target ID)
+        @param redis: the redis connection pool
+        @param signature: the filter the proxies were selected with (one queue per filter)
+        @param ttl: seconds until the queue is rebuilt
+        @param lease_ttl: seconds a returned proxy counts for its max concurrency'''
+        self.pool_id = pool_id
+        self.redis = redis
+        self.signature = signature
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+
+    @property
+    def keys(self):
+        '''Return the Redis keys used by NEXT_PROXY'''
+        key_args = {'pool_id': self.pool_id, 'signature': self.signature}
+        return [self.queue_key_frmt.format(**key_args),
+                self.proxies_key_frmt.format(**key_args),
+                self.dont_block_key_frmt.format(**key_args),
+                self.blocked_key_frmt.format(pool_id=self.pool_id)]
+
+    @property
+    def caps_key(self):
+        '''Return the key of the caps of the queue proxies'''
+        return self.caps_key_frmt.format(pool_id=self.pool_id, signature=self.signature)
+
+    async def next(self, now: float):
+        '''Return the next proxy object (dict), an empty dict if every proxy is at its caps
+        or None if there is no queue yet'''
+        caps = await self.redis.get(self.caps_key)
+        caps_keys, caps_args = json.loads(caps) if caps else ([], ['', ''])
+        checkout = ['{}:{}'.format(self.pool_id, uuid.uuid4().hex), now + self.lease_ttl]
+        proxy_json = await NEXT_PROXY(self.redis, keys=self.keys + caps_keys,
+                                      args=['', now, ''] + caps_args + checkout)
+        if proxy_json is None:
+            return None
+        if not proxy_json:
+            return {}
+        return json.loads(proxy_json)
+
+    async def build(self, *proxies, dumps=json.dumps):
+        '''Build the rotation queue in random order
+        @param *proxies: a list of already filtered proxy objects (dict)
+        @param dumps: the JSON encoder of the proxy objects'''
+        queue_key, proxies_key, dont_block_key, _ = self.keys
+        proxy_ids = [proxy['id'] for proxy in proxies]
+        random.shuffle(proxy_ids)
+        caps_keys, caps_args = ProxyPool.get_caps_args({proxy['id']: proxy for proxy in proxies})
+        transaction = self.redis.multi_exec()
+        transaction.delete(queue_key, proxies_key, dont_block_key, self.caps_key)
+        if proxy_ids:
+            transaction.rpush(queue_key, *proxy_ids)
+            proxy_pairs = []
+            for proxy in proxies:
+                proxy_pairs += [proxy['id'], dumps(dict(proxy))]
+            transaction.hmset(proxies_key, *proxy_pairs)
+            dont_block_ids = [proxy['id'] for proxy in proxies if proxy['dont_block']]
+            if dont_block_ids:
+                transaction.sadd(dont_block_key, *dont_block_ids)
+            if caps_keys:
+                transaction.set(self.caps_key, json.dumps([caps_keys, caps_args]),
+                                expire=self.ttl)
+            for key in (queue_key, proxies_key, dont_block_key):
+                transaction.expire(key, self.ttl)
+        await transaction.execute()
@@ -0,0 +1,494 @@
+"""
+Redis Lua scripts
+
+The scripts are called by their SHA1 digest (EVALSHA)
+They are sent to Redis (EVAL) only when they are not in the script cache yet
+"""
+
+import hashlib
+
+from aioredis import ReplyError
+
+
+class RedisScript:
+    '''A Lua script registered in Redis'''
+
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    async def register(self, redis: object):
+        '''Load the script in the Redis script cache'''
+        await redis.script_load(self.source)
+
+    async def __call__(self, redis: object, keys=(), args=()):
+        '''Run the script
+        @param redis: the redis connection pool
+        @param keys: the Redis keys used by the script (KEYS)
+        @param args: the script arguments (ARGV)'''
+        keys = list(keys)
+        args = list(args)
+        try:
+            return await redis.evalsha(self.sha, keys=keys, args=args)
+        except ReplyError as err:
+            if not str(err).startswith('NOSCRIPT'):
+                raise
+        return await redis.eval(self.source, keys=keys, args=args)
+
+
+# Proxy caps shared by the selection scripts
+# A cap group is a proxy or a provider plan with caps. The caps of a plan are plan-wide:
+# all the proxies of the plan share them. Every group has two keys (the last 2 * G KEYS):
+# - <group>_leases: concurrency, sorted set <checkout> => checkout expiration timestamp
+# - <group>_bucket: token bucket hash (tokens, ts) refilled with <max rpm> tokens a minute
+# Every time a proxy is returned it takes a checkout and a token of each of its groups
+# A proxy is saturated when any of its groups is at its cap
+# ARGV[2]: current timestamp
+# ARGV[4]: cap groups of the candidates: <proxy ID>:<group>[:<group>],... (group number)
+# ARGV[5]: caps of every group: <max concurrency>:<max rpm>,... (empty value: no cap)
+# ARGV[6]: checkout ID (unique for every call)
+# ARGV[7]: checkout expiration timestamp
+CAPS = '''
+local now = tonumber(ARGV[2])
+local groups = {}
+for concurrency, rpm in string.gmatch(ARGV[5], '(%d*):(%d*)') do
+    table.insert(groups, {concurrency = tonumber(concurrency), rpm = tonumber(rpm)})
+end
+local first_cap_key = #KEYS - 2 * #groups
+for i, group in ipairs(groups) do
+    group.leases = KEYS[first_cap_key + 2 * i - 1]
+    group.bucket = KEYS[first_cap_key + 2 * i]
+end
+local proxy_groups = {}
+for entry in string.gmatch(ARGV[4], '[^,]+') do
+    local pid
+    for part in string.gmatch(entry, '[^:]+') do
+        if pid == nil then
+            pid = part
+            proxy_groups[pid] = {}
+        else
+            table.insert(proxy_groups[pid], groups[tonumber(part)])
+        end
+    end
+end
+-- Read the checkouts and the tokens of the group (once)
+local function load_group(group)
+    if group.loaded then
+        return
+    end
+    group.loaded = true
+    if group.concurrency then
+        redis.call('ZREMRANGEBYSCORE', group.leases, '-inf', now)
+        group.count = redis.call('ZCARD', group.leases)
+    end
+    if group.rpm then
+        local bucket = redis.call('HMGET', group.bucket, 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or group.rpm
+        local ts = tonumber(bucket[2]) or now
+        group.tokens = math.min(group.rpm, tokens + (now - ts) * group.rpm / 60)
+    end
+end
+-- Return true when the proxy can not be returned right now
+local function saturated(pid)
+    for _, group in ipairs(proxy_groups[pid] or {}) do
+        load_group(group)
+        if group.concurrency and group.count >= group.concurrency then
+            return true
+        end
+        if group.rpm and group.tokens < 1 then
+            return true
+        end
+    end
+    return false
+end
+-- Take a checkout and a token of every group of the proxy
+-- Return the checkouts taken: list of <leases key>, <checkout>
+local function take(pid)
+    local checkout = ARGV[6] .. ':' .. pid
+    local checkouts = {}
+    for _, group in ipairs(proxy_groups[pid] or {}) do
+        load_group(group)
+        if group.concurrency then
+            group.count = group.count + 1
+            redis.call('ZADD', group.leases, ARGV[7], checkout)
+            local last = redis.call('ZRANGE', group.leases, -1, -1, 'WITHSCORES')
+            redis.call('EXPIREAT', group.leases, math.ceil(tonumber(last[2])))
+            table.insert(checkouts, group.leases)
+            table.insert(checkouts, checkout)
+        end
+        if group.rpm then
+            group.tokens = group.tokens - 1
+            redis.call('HSET', group.bucket, 'tokens', group.tokens, 'ts', now)
+            redis.call('EXPIRE', group.bucket, 60)
+        end
+    end
+    return checkouts
+end
+'''
+
+
+# Select the pool proxies atomically
+# The saturated proxies (see CAPS) are skipped
+# KEYS[1]: the used IDs set
+# KEYS[2]: the blocked IDs sorted set (scored by the unblock timestamp)
+# KEYS[3]: the last use sorted set (scored by the timestamp the proxy was returned)
+# KEYS[4..]: the cap group keys (see CAPS)
+# ARGV[1]: pool length
+# ARGV[2]: current timestamp
+# ARGV[3]: unblock timestamp for the new blocked proxies
+# ARGV[4..7]: caps of the candidates and checkout (see CAPS)
+# ARGV[8]: refill policy (reset, lru or partial, see ProxyPool.refill_policies)
+# ARGV[9]: dont_block flag of every candidate ('0' or '1')
+# ARGV[10]: number of proxies to be set as blocked first (M)
+# ARGV[11..M+10]: the IDs of the proxies to be set as blocked
+# ARGV[M+11..]: the candidate IDs, already shuffled
+SELECT_POOL = RedisScript(CAPS + '''
+local pool_len = tonumber(ARGV[1])
+local policy = ARGV[8]
+local flags = ARGV[9]
+local first_id = tonumber(ARGV[10]) + 11
+for i = 11, first_id - 1 do
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[i])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+local blocked = {}
+local blocked_list = redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. ARGV[2], '+inf', 'WITHSCORES')
+for i = 1, #blocked_list, 2 do
+    blocked[blocked_list[i]] = tonumber(blocked_list[i + 1])
+end
+local used_list = redis.call('SMEMBERS', KEYS[1])
+local used = {}
+for _, pid in ipairs(used_list) do
+    used[pid] = true
+end
+local available = {}
+local used_ids = {}
+local blocked_ids = {}
+for i = first_id, #ARGV do
+    local pid = ARGV[i]
+    if blocked[pid] and string.sub(flags, i - first_id + 1, i - first_id + 1) == '0' then
+        table.insert(blocked_ids, pid)
+    elseif used[pid] then
+        table.insert(used_ids, pid)
+    else
+        table.insert(available, pid)
+    end
+end
+local selected = {}
+-- Select the proxy unless it is saturated
+local function pick(pid)
+    if saturated(pid) then
+        return false
+    end
+    take(pid)
+    table.insert(selected, pid)
+    return true
+end
+for _, pid in ipairs(available) do
+    if #selected >= pool_len then
+        break
+    end
+    pick(pid)
+end
+if #selected < pool_len and not (policy == 'partial' and #selected > 0) then
+    if policy == 'reset' then
+        -- First will try cleaning used proxies and adding some used proxies
+        if #used_list > 0 then
+            redis.call('DEL', KEYS[1])
+        end
+    else
+        -- First will try adding the least recently used proxies
+        local last_use = {}
+        for _, pid in ipairs(used_ids) do
+            last_use[pid] = tonumber(redis.call('ZSCORE', KEYS[3], pid)) or 0
+        end
+        table.sort(used_ids, function(a, b) return last_use[a] < last_use[b] end)
+        -- and unblocking the oldest blocks
+        table.sort(blocked_ids, function(a, b) return blocked[a] < blocked[b] end)
+    end
+    for _, pid in ipairs(used_ids) do
+        if #selected >= pool_len then
+            break
+        end
+        pick(pid)
+    end
+    -- If the length is still low then it will try using blocked proxies
+    for _, pid in ipairs(blocked_ids) do
+        if #selected >= pool_len then
+            break
+        end
+        if pick(pid) then
+            redis.call('ZREM', KEYS[2], pid)
+        end
+    end
+end
+for _, pid in ipairs(selected) do
+    redis.call('SADD', KEYS[1], pid)
+    redis.call('ZADD', KEYS[3], ARGV[2], pid)
+end
+return selected
+''')
+
+
+# Select the pool proxies atomically and lease them
+# A leased proxy is not selected again until its lease is released or expires
+# The saturated proxies (see CAPS) are skipped. The cap checkouts last as long as the lease
+# KEYS[1]: the leased IDs sorted set (scored by the lease expiration timestamp)
+# KEYS[2]: the blocked IDs sorted set (scored by the unblock timestamp)
+# KEYS[3]: the cap checkouts of the leased proxies hash
+#          (proxy ID => <leases key> <checkout> ..., see ProxyPool.release)
+# KEYS[4..]: the cap group keys (see CAPS)
+# ARGV[1]: pool length
+# ARGV[2]: current timestamp
+# ARGV[3]: unblock timestamp for the new blocked proxies
+# ARGV[4..7]: caps of the candidates and checkout (see CAPS). ARGV[7] is the lease expiration
+# ARGV[8]: dont_block flag of every candidate ('0' or '1')
+# ARGV[9]: number of proxies to be set as blocked (and released) first (M)
+#          Their cap checkouts are not released (see ProxyPool.set_as_blocked_list)
+# ARGV[10..M+9]: the IDs of the proxies to be set as blocked
+# ARGV[M+10..]: the candidate IDs, already shuffled
+LEASE_POOL = RedisScript(CAPS + '''
+local pool_len = tonumber(ARGV[1])
+local flags = ARGV[8]
+local first_id = tonumber(ARGV[9]) + 10
+for i = 10, first_id - 1 do
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[i])
+    redis.call('ZREM', KEYS[1], ARGV[i])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+local blocked = {}
+for _, pid in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. ARGV[2], '+inf')) do
+    blocked[pid] = true
+end
+local leased = {}
+for _, pid in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[2], '+inf')) do
+    leased[pid] = true
+end
+local selected = {}
+local checkouts = {}
+-- Select the proxy unless it is saturated
+local function pick(pid)
+    if saturated(pid) then
+        return false
+    end
+    checkouts[pid] = take(pid)
+    table.insert(selected, pid)
+    return true
+end
+local blocked_ids = {}
+local candidates = {}
+local on_standby = {}
+for i = first_id, #ARGV do
+    local pid = ARGV[i]
+    candidates[pid] = true
+    on_standby[pid] = blocked[pid] and string.sub(flags, i - first_id + 1, i - first_id + 1) == '0'
+    if on_standby[pid] then
+        if not leased[pid] then
+            table.insert(blocked_ids, pid)
+        end
+    elseif not leased[pid] and #selected < pool_len then
+        pick(pid)
+    end
+end
+-- If there are not enough free proxies it will try using blocked proxies
+for _, pid in ipairs(blocked_ids) do
+    if #selected >= pool_len then
+        break
+    end
+    if pick(pid) then
+        redis.call('ZREM', KEYS[2], pid)
+    end
+end
+-- If the length is still low then it will share the proxies leased the longest ago
+-- (but the blocked ones)
+if #selected < pool_len then
+    for _, pid in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[2], '+inf')) do
+        if #selected >= pool_len then
+            break
+        end
+        if candidates[pid] and not on_standby[pid] then
+            pick(pid)
+        end
+    end
+end
+local with_checkouts = false
+for _, pid in ipairs(selected) do
+    redis.call('ZADD', KEYS[1], ARGV[7], pid)
+    local entries = checkouts[pid]
+    -- A shared proxy keeps the checkouts of its previous leases
+    if leased[pid] then
+        local current = redis.call('HGET', KEYS[3], pid)
+        if current then
+            table.insert(entries, 1, current)
+        end
+    end
+    if #entries > 0 then
+        redis.call('HSET', KEYS[3], pid, table.concat(entries, ' '))
+        with_checkouts = true
+    else
+        redis.call('HDEL', KEYS[3], pid)
+    end
+end
+if with_checkouts then
+    local ttl = redis.call('TTL', KEYS[3])
+    if ttl < 0 or now + ttl < tonumber(ARGV[7]) then
+        redis.call('EXPIREAT', KEYS[3], math.ceil(tonumber(ARGV[7])))
+    end
+end
+return selected
+''')
+
+
+# Check or take the caps of some proxies (batched selection mode)
+# KEYS: the cap group keys (see CAPS)
+# ARGV[1]: '1' to take the caps of the proxies, '0' to check them only
+# ARGV[2..7]: see CAPS (ARGV[3] is not used)
+# ARGV[8..]: the proxy IDs
+# Return: the IDs of the proxies that are not saturated (their caps are taken in order)
+TAKE_CAPS = RedisScript(CAPS + '''
+local free = {}
+for i = 8, #ARGV do
+    local pid = ARGV[i]
+    if not saturated(pid) then
+        if ARGV[1] == '1' then
+            take(pid)
+        end
+        table.insert(free, pid)
+    end
+end
+return free
+''')
+
+
+# Renew the leases of some proxies and their cap checkouts
+# The expiration of the keys is only extended
+# KEYS[1]: the leased IDs sorted set (scored by the lease expiration timestamp)
+# KEYS[2]: the cap checkouts hash of the leases (proxy ID => <leases key> <checkout> ...)
+# KEYS[3..]: the cap group leases key of every checkout
+# ARGV[1]: current timestamp
+# ARGV[2]: lease expiration timestamp
+# ARGV[3]: number of proxy IDs (N)
+# ARGV[4..N+3]: the proxy IDs
+# ARGV[N+4..]: the checkouts (one for every KEYS[3..] key)
+RENEW_LEASES = RedisScript('''
+local now = tonumber(ARGV[1])
+local lease_until = tonumber(ARGV[2])
+local first_checkout = tonumber(ARGV[3]) + 4
+local function extend(key)
+    local ttl = redis.call('TTL', key)
+    if ttl >= 0 and now + ttl < lease_until then
+        redis.call('EXPIREAT', key, math.ceil(lease_until))
+    end
+end
+for i = 4, first_checkout - 1 do
+    redis.call('ZADD', KEYS[1], lease_until, ARGV[i])
+end
+extend(KEYS[2])
+for i = first_checkout, #ARGV do
+    local key = KEYS[i - first_checkout + 3]
+    -- An expired checkout is not taken again
+    if redis.call('ZSCORE', key, ARGV[i]) then
+        redis.call('ZADD', key, lease_until, ARGV[i])
+        extend(key)
+    end
+end
+return first_checkout - 4
+''')
+
+
+# Pin a proxy to a session unless another proxy was pinned in the meantime
+# KEYS[1]: the session key
+# ARGV[1]: the proxy ID pinned when the new proxy was selected ('' if none)
+# ARGV[2]: the new proxy ID
+# ARGV[3]: seconds the session lasts
+# Return: the proxy ID pinned to the session
+PIN_SESSION = RedisScript('''
+local current = redis.call('GET', KEYS[1])
+if current and current ~= ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return current
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return ARGV[2]
+''')
+
+
+# Return the next proxy of a rotation queue skipping the blocked and the saturated proxies
+# (see CAPS). The caps of the proxy returned are taken
+# The queue is rotated with RPOPLPUSH (round robin)
+# If every proxy is blocked the first one not saturated is unblocked and returned
+# KEYS[1]: the rotation queue (list of IDs)
+# KEYS[2]: proxies hash (proxy ID => proxy object JSON)
+# KEYS[3]: the IDs of the proxies that are never blocked (set)
+# KEYS[4]: the blocked IDs sorted set (scored by the unblock timestamp)
+# KEYS[5..]: the cap group keys (see CAPS)
+# ARGV[2..7]: current timestamp, caps of the queue proxies and checkout (see CAPS)
+#             ARGV[1] and ARGV[3] are not used
+# Return: the proxy object JSON, nil if there is no queue
+#         or an empty string if every proxy is saturated
+NEXT_PROXY = RedisScript(CAPS + '''
+local length = redis.call('LLEN', KEYS[1])
+if length == 0 then
+    return false
+end
+local first
+for _ = 1, length do
+    local pid = redis.call('RPOPLPUSH', KEYS[1], KEYS[1])
+    if not saturated(pid) then
+        first = first or pid
+        local unblock = redis.call('ZSCORE', KEYS[4], pid)
+        if not unblock or tonumber(unblock) <= now or
+                redis.call('SISMEMBER', KEYS[3], pid) == 1 then
+            take(pid)
+            return redis.call('HGET', KEYS[2], pid)
+        end
+    end
+end
+if not first then
+    return ''
+end
+redis.call('ZREM', KEYS[4], first)
+take(first)
+return redis.call('HGET', KEYS[2], first)
+''')
+
+
+# Record the outcomes of some proxy requests
+# Outcome counters are incremented and the success rate and latency EWMAs updated
+# KEYS[1]: success rate hash (proxy ID => EWMA)
+# KEYS[2]: latency hash (proxy ID => EWMA in ms)
+# KEYS[3]: pool outcome counters hash (<proxy ID>:<outcome> => count)
+# KEYS[4]: global outcome counters hash (<proxy ID>:<outcome> => count)
+# ARGV[1]: EWMA alpha (weight of the new value)
+# ARGV[2..]: quads <proxy ID>, <outcome>, <success: '1' or '0'>, <latency ms or ''>
+RECORD_OUTCOMES = RedisScript('''
+local alpha = tonumber(ARGV[1])
+local function update(key, pid, value)
+    local current = redis.call('HGET', key, pid)
+    if current then
+        value = tonumber(current) * (1 - alpha) + value * alpha
+    end
+    redis.call('HSET', key, pid, value)
+end
+for i = 2, #ARGV, 4 do
+    local counter = ARGV[i] .. ':' .. ARGV[i + 1]
+    redis.call('HINCRBY', KEYS[3], counter, 1)
+    redis.call('HINCRBY', KEYS[4], counter, 1)
+    update(KEYS[1], ARGV[i], tonumber(ARGV[i + 2]))
+    if ARGV[i + 3] ~= '' then
+        update(KEYS[2], ARGV[i], tonumber(ARGV[i + 3]))
+    end
+end
+return (#ARGV - 1) / 4
+''')
+
+
+SCRIPTS = (SELECT_POOL, LEASE_POOL, TAKE_CAPS, RENEW_LEASES, PIN_SESSION, NEXT_PROXY,
+           RECORD_OUTCOMES)
+
+
+async def register_scripts(redis: object):
+    '''Load all the scripts in the Redis script cache'''
+    for script in SCRIPTS:
+        await script.register(redis)
@@ -0,0 +1,85 @@
+"""
+Proxy selection strategies
+
+A strategy decides the order the pool takes the candidate proxies in
+- random: every proxy has the same chance
+- weighted: weighted random by the success rate and latency observed for the target
+  (EWMAs stored in Redis, see ProxyPool.record_outcomes)
+"""
+
+import random
+
+
+class RandomStrategy:
+    '''Every proxy has the same chance'''
+
+    name = 'random'
+
+    def stats_commands(self, pipe: object, pool: object):  # pylint: disable=unused-argument
+        '''Add the commands to fetch the stats the strategy needs to the Redis pipeline
+        @return: the number of commands added'''
+        return 0
+
+    def load_stats(self, results: list):
+        '''Load the stats given the results of the commands added by `stats_commands`'''
+
+    def order(self, ids, proxy_map: dict):  # pylint: disable=unused-argument
+        '''Return the proxy IDs in the order they should be taken
+        @param ids: the candidate proxy IDs
+        @param proxy_map: proxy ID => proxy object (dict)'''
+        ids = list(ids)
+        random.shuffle(ids)
+        return ids
+
+
+class WeightedStrategy(RandomStrategy):
+    '''Weighted random choice. Fast and healthy proxies come first more often
+    weight = success rate ^ success_exponent / latency'''
+
+    name = 'weighted'
+    min_success = 0.01
+    min_latency_ms = 10
+
+    def __init__(self, default_latency_ms: int = 1000, success_exponent: int = 2):
+        '''
+        @param default_latency_ms: latency of the proxies without any observation
+        @param success_exponent: how much the success rate matters compared to the latency'''
+        self.default_latency_ms = default_latency_ms
+        self.success_exponent = success_exponent
+        self.success = {}
+        self.latency = {}
+
+    def stats_commands(self, pipe, pool):
+        pipe.hgetall(pool.success_key)
+        pipe.hgetall(pool.latency_key)
+        return 2
+
+    def load_stats(self, results):
+        success, latency = results
+        self.success = {int(pid): float(value) for pid, value in success.items()}
+        self.latency = {int(pid): float(value) for pid, value in latency.items()}
+
+    def weight(self, pid: int, proxy: dict):
+        '''Return the weight of the proxy
+        The last latency measured by the health checker is used when there is no EWMA'''
+        success = max(self.success.get(pid, 1.0), self.min_success)
+        latency = self.latency.get(pid)
+        if latency is None:
+            latency = (proxy or {}).get('last_latency_ms') or self.default_latency_ms
+        return success ** self.success_exponent / max(latency, self.min_latency_ms)
+
+    def order(self, ids, proxy_map):
+        # Weighted random sampling without replacement:
+        # sort by an exponential random key with rate = weight
+        keys = {pid: random.expovariate(self.weight(pid, proxy_map.get(pid))) for pid in ids}
+        return sorted(keys, key=keys.get)
+
+
+STRATEGIES = {strategy.name: strategy for strategy in (RandomStrategy, WeightedStrategy)}
+
+
+def get_strategy(name: str, **kwargs):
+    '''Return a new strategy instance given its name'''
+    if name not in STRATEGIES:
+        raise ValueError('Not valid selection strategy: {}'.format(name))
+    return STRATEGIES[name](**kwargs)
@@ -0,0 +1,167 @@
+"""
+Tor Controller
+
+Renews the identity (exit node) of the Tor proxies sending `SIGNAL NEWNYM`
+through their control port instead of setting them as blocked
+
+- The control connections are authenticated once and reused. A reused connection
+  closed by Tor (idle timeout or restart) is opened again once
+- Tor does not build new circuits for a NEWNYM signal sent less than 10 seconds
+  after the previous one, so a port is signaled once every `min_interval` seconds.
+  A renewal requested in that interval is considered done: the identity was just renewed
+- The renewals of a request are bounded by `renew_timeout`: the ones not done by then
+  are considered not renewed
+"""
+
+import time
+import asyncio
+import logging
+from urllib.parse import urlparse
+
+
+class TorControlError(Exception):
+    '''Used when the control port replies with an error'''
+
+
+class TorControlConnection:
+    '''A connection to a Tor control port'''
+
+    def __init__(self, host: str, port: int, password: str = None, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self._reader = None
+        self._writer = None
+
+    @property
+    def connected(self):
+        '''Return True if the connection is open'''
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        '''Open the connection and authenticate'''
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        if self.password is not None:
+            password = self.password.replace('\\', '\\\\').replace('"', '\\"')
+            await self.command('AUTHENTICATE "{}"'.format(password))
+        else:
+            await self.command('AUTHENTICATE')
+
+    async def command(self, command: str):
+        '''Send a command and return the reply
+        Raise TorControlError if the reply status is not 250'''
+        self._writer.write(command.encode('utf-8') + b'\r\n')
+        await self._writer.drain()
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            if not line:
+                raise ConnectionResetError('Tor control connection closed')
+            line = line.decode('utf-8').rstrip('\r\n')
+            lines.append(line)
+            # The last line of a reply is <status code><space><text>
+            if len(line) > 3 and line[3] == ' ':
+                break
+        if not lines[-1].startswith('250'):
+            raise TorControlError(lines[-1])
+        return lines
+
+    async def close(self):
+        '''Close the connection'''
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+
+class TorController:
+    '''Renews the identity of the Tor proxies'''
+
+    def __init__(self, min_interval: float = 10.0, timeout: float = 5.0,
+                 renew_timeout: float = 5.0):
+        '''
+        @param min_interval: min seconds between two NEWNYM signals to the same control port
+        @param timeout: seconds to wait for the control port
+        @param renew_timeout: max seconds to wait for the renewals of `renew_list`'''
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.renew_timeout = renew_timeout
+        # Control address (host, port) => TorControlConnection
+        self.connections = {}
+        # Control address (host, port) => last NEWNYM timestamp
+        self.renewed = {}
+
+    @staticmethod
+    def can_renew(proxy: dict):
+        '''Return True if the proxy is a Tor proxy with identity renewal'''
+        return bool(proxy.get('tor_renew_identity') and proxy.get('tor_control_port'))
+
+    @staticmethod
+    def get_address(proxy: dict):
+        '''Return the control port address (host, port) of the Tor proxy'''
+        return urlparse(proxy['url']).hostname, proxy['tor_control_port']
+
+    async def renew(self, proxy: dict):
+        '''Renew the identity of the Tor proxy
+        @return: True if the identity was renewed (or it was just renewed)'''
+        address = self.get_address(proxy)
+        connection = self.connections.get(address)
+        if connection is None:
+            connection = TorControlConnection(*address, password=proxy.get('tor_control_pswd'),
+                                              timeout=self.timeout)
+            self.connections[address] = connection
+        async with connection.lock:
+            if time.time() - self.renewed.get(address, 0) < self.min_interval:
+                return True
+            try:
+                await self.send_newnym(connection)
+            except (OSError, asyncio.TimeoutError, TorControlError) as err:
+                logging.warning('Unable to renew the Tor identity of proxy %s: %s',
+                                proxy['id'], err)
+                await connection.close()
+                return False
+            except asyncio.CancelledError:
+                # The reply may be read partially: the connection can not be reused
+                await connection.close()
+                raise
+            self.renewed[address] = time.time()
+        return True
+
+    @staticmethod
+    async def send_newnym(connection: TorControlConnection):
+        '''Send SIGNAL NEWNYM through the control connection (opened if needed)
+        If a reused connection fails it is opened again and the signal sent once more'''
+        if connection.connected:
+            try:
+                await connection.command('SIGNAL NEWNYM')
+                return
+            except OSError:
+                await connection.close()
+        await connection.connect()
+        await connection.command('SIGNAL NEWNYM')
+
+    async def renew_list(self, *proxies):
+        '''Renew the identity of the Tor proxies concurrently
+        The renewals not done after `renew_timeout` seconds are cancelled
+        @return: set of IDs of the proxies renewed'''
+        proxies = [proxy for proxy in proxies if self.can_renew(proxy)]
+        if not proxies:
+            return set()
+        tasks = [asyncio.ensure_future(self.renew(proxy)) for proxy in proxies]
+        _, pending = await asyncio.wait(tasks, timeout=self.renew_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning('Tor identity renewal timed out for %s proxies', len(pending))
+            await asyncio.wait(pending)
+        return {proxy['id'] for proxy, task in zip(proxies, tasks)
+                if not task.cancelled() and task.result()}
+
+    async def close(self):
+        '''Close all the control connections'''
+        for connection in self.connections.values():
+            await connection.close()
+        self.connections = {}
@@ -0,0 +1,78 @@
+"""
+JSON Serializer
+
+The JSON encoder used by the API responses is pluggable:
+- json: standard library encoder (default)
+- orjson: fast encoder (optional package)
+- auto: orjson when it is installed, json in other case
+
+Both encoders return bytes and encode the dates and datetimes in the same format
+(DEFAULT_DATE_FORMAT and DEFAULT_DATETIME_FORMAT, ie: 2020-01-31, 2020-01-31 10:00:00)
+"""
+
+import json
+import datetime
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+ENCODERS = ('auto', 'orjson', 'json')
+DEFAULT_DATE_FORMAT = '%Y-%m-%d'
+DEFAULT_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def default(content):
+    '''Encode the types not supported by the encoders'''
+    if isinstance(content, datetime.datetime):
+        return content.strftime(DEFAULT_DATETIME_FORMAT)
+    if isinstance(content, datetime.date):
+        return content.strftime(DEFAULT_DATE_FORMAT)
+    if isinstance(content, datetime.time):
+        return content.isoformat()
+    if isinstance(content, Decimal):
+        return float(content)
+    if isinstance(content, (set, frozenset)):
+        return list(content)
+    raise TypeError('Object of type {} is not JSON serializable'.format(
+        type(content).__name__))
+
+
+def json_dumps(content):
+    '''Encode the content using the standard library encoder'''
+    return json.dumps(content, default=default).encode('utf-8')
+
+
+def orjson_dumps(content):
+    '''Encode the content using orjson
+    The dates and datetimes are passed through to `default` (the API format, not ISO 8601)'''
+    return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS |
+                        orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def get_dumps(encoder: str = 'json'):
+    '''Return the function encoding the content to JSON (bytes)'''
+    if encoder not in ENCODERS:
+        raise ValueError('Not valid JSON encoder: {}'.format(encoder))
+    if encoder == 'orjson' and orjson is None:
+        raise ValueError('The orjson JSON encoder is not installed')
+    if encoder == 'json' or orjson is None:
+        return json_dumps
+    return orjson_dumps
+
+
+_DUMPS = get_dumps()
+
+
+def set_encoder(encoder: str):
+    '''Set the JSON encoder used by `dumps`'''
+    global _DUMPS  # pylint: disable=global-statement
+    _DUMPS = get_dumps(encoder)
+
+
+def dumps(content):
+    '''Encode the content to JSON (bytes) using the current encoder'''
+    return _DUMPS(content)
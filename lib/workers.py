@@ -0,0 +1,267 @@
+"""
+Worker processes
+
+The server forks N worker processes. Each worker runs its own event loop, app,
+database and Redis pools, and listens on the same port (SO_REUSEPORT):
+the kernel balances the connections between them
+
+The master process only supervises the workers:
+- SIGTERM / SIGINT: stop the workers gracefully and exit
+- SIGHUP: forwarded to the workers (config reload)
+- SIGUSR2: rolling restart. The workers are replaced one by one: a new worker is started
+  and the old one is stopped only when the new one is listening
+- A worker that dies is started again. A worker that dies before it is listening
+  (ie: invalid config, database down) is a boot failure: it is started again after
+  a growing delay and the master exits after `max_boot_failures` consecutive failures
+
+A worker notifies it is listening writing to a pipe (`notify_ready`)
+"""
+
+import os
+import time
+import select
+import signal
+import logging
+
+
+class WorkerSupervisor:
+    '''Fork and supervise the worker processes'''
+
+    # Max seconds between two starts of a worker that fails to boot
+    max_respawn_delay = 60.0
+
+    def __init__(self, worker, workers: int = 2, ready_timeout: float = 30.0,
+                 shutdown_timeout: float = 60.0, respawn_delay: float = 1.0,
+                 max_boot_failures: int = 5):
+        '''
+        @param worker: function run in the worker processes: worker(notify_ready)
+                       `notify_ready` must be called once the worker is listening
+        @param workers: number of worker processes
+        @param ready_timeout: seconds to wait for a new worker to be listening
+        @param shutdown_timeout: seconds to wait for a worker to stop before it is killed
+        @param respawn_delay: min seconds between two starts of a worker that died
+                              (doubled after every consecutive boot failure)
+        @param max_boot_failures: consecutive boot failures before the master exits'''
+        self.worker = worker
+        self.workers = workers
+        self.ready_timeout = ready_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.respawn_delay = respawn_delay
+        self.max_boot_failures = max_boot_failures
+        # PID => start timestamp
+        self.pids = {}
+        # PIDs of the workers being stopped
+        self.stopping = set()
+        # PIDs of the new workers not listening yet (rolling restart). They are not
+        # started again if they die
+        self.starting = set()
+        # Start timestamps of the workers that died
+        self.died = []
+        # PID => read end of the ready pipe of the workers not listening yet
+        self.ready_pipes = {}
+        self.boot_failures = 0
+        self.signals = []
+
+    def spawn(self):
+        '''Fork a worker process
+        @return: tuple <PID>, <read end of the ready pipe>'''
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            self._run_worker(ready_w)
+        os.close(ready_w)
+        self.pids[pid] = time.monotonic()
+        logging.info('Worker %s started', pid)
+        return pid, ready_r
+
+    def _run_worker(self, ready_w):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR2):
+            signal.signal(signum, signal.SIG_DFL)
+        # A config reload forwarded before the app handles SIGHUP must not kill the worker
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        def notify_ready():
+            try:
+                os.write(ready_w, b'1')
+            except OSError:
+                pass  # The master is not waiting for this worker
+            os.close(ready_w)
+
+        exit_code = 1
+        try:
+            self.worker(notify_ready)
+            exit_code = 0
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Worker %s failed', os.getpid())
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)  # pylint: disable=protected-access
+
+    def wait_ready(self, pid: int, ready_r: int):
+        '''Return True if the worker notified it is listening before `ready_timeout`'''
+        try:
+            deadline = time.monotonic() + self.ready_timeout
+            while pid in self.pids:
+                timeout = min(0.5, deadline - time.monotonic())
+                if timeout <= 0:
+                    return False
+                readable, _, _ = select.select([ready_r], [], [], timeout)
+                if readable:
+                    return os.read(ready_r, 1) == b'1'
+                self.reap()
+            return False
+        finally:
+            os.close(ready_r)
+
+    def start_worker(self):
+        '''Start a worker and wait until it is listening
+        @return: PID of the worker or None if it is not listening'''
+        pid, ready_r = self.spawn()
+        self.starting.add(pid)
+        try:
+            if self.wait_ready(pid, ready_r):
+                return pid
+            logging.error('Worker %s is not listening', pid)
+            if pid in self.pids:
+                self.stop(pid)
+                self.wait_stopped([pid], self.shutdown_timeout)
+            return None
+        finally:
+            self.starting.discard(pid)
+
+    def stop(self, pid: int):
+        '''Stop a worker gracefully (SIGTERM)'''
+        self.stopping.add(pid)
+        self.send_signal(pid, signal.SIGTERM)
+
+    @staticmethod
+    def send_signal(pid: int, signum: int):
+        '''Send a signal to a worker'''
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        '''Collect the workers that exited'''
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            started = self.pids.pop(pid, None)
+            if started is None:
+                continue
+            ready_r = self.ready_pipes.pop(pid, None)
+            if ready_r is not None:
+                os.close(ready_r)
+            if pid in self.stopping:
+                self.stopping.discard(pid)
+                logging.info('Worker %s stopped', pid)
+            elif pid in self.starting:
+                self.starting.discard(pid)
+                logging.error('Worker %s failed to start (status: %s)', pid, status)
+            elif ready_r is not None:
+                self.boot_failures += 1
+                logging.error('Worker %s failed to start (status: %s, consecutive failures: %s)',
+                              pid, status, self.boot_failures)
+                self.died.append(started)
+            else:
+                logging.error('Worker %s died (status: %s)', pid, status)
+                self.died.append(started)
+
+    def check_ready(self):
+        '''Check the ready pipes of the workers not listening yet (without waiting)'''
+        if not self.ready_pipes:
+            return
+        pipes = {ready_r: pid for pid, ready_r in self.ready_pipes.items()}
+        readable, _, _ = select.select(list(pipes), [], [], 0)
+        for ready_r in readable:
+            if os.read(ready_r, 1) == b'1':
+                del self.ready_pipes[pipes[ready_r]]
+                os.close(ready_r)
+                self.boot_failures = 0
+
+    def spawn_supervised(self):
+        '''Fork a worker process. Its boot is checked by `check_ready`'''
+        pid, ready_r = self.spawn()
+        self.ready_pipes[pid] = ready_r
+
+    def get_respawn_delay(self):
+        '''Return the seconds to wait before starting again a worker that died'''
+        if not self.boot_failures:
+            return self.respawn_delay
+        return min(self.respawn_delay * 2 ** (self.boot_failures - 1), self.max_respawn_delay)
+
+    def wait_stopped(self, pids, timeout: float):
+        '''Wait for the workers to exit. They are killed after `timeout` seconds'''
+        deadline = time.monotonic() + timeout
+        while set(pids) & set(self.pids):
+            if time.monotonic() > deadline:
+                for pid in set(pids) & set(self.pids):
+                    logging.warning('Worker %s killed', pid)
+                    self.send_signal(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.1)
+            self.reap()
+
+    def rolling_restart(self):
+        '''Replace the workers one by one'''
+        logging.info('Rolling restart of %s workers', len(self.pids))
+        for pid in list(self.pids):
+            if pid in self.stopping or pid not in self.pids:
+                continue
+            if self.start_worker() is None:
+                logging.error('Rolling restart aborted: the old workers are kept')
+                return
+            self.stop(pid)
+            self.wait_stopped([pid], self.shutdown_timeout)
+
+    def shutdown(self):
+        '''Stop all the workers'''
+        logging.info('Stopping %s workers', len(self.pids))
+        for pid in list(self.pids):
+            self.stop(pid)
+        self.wait_stopped(list(self.pids), self.shutdown_timeout)
+
+    def _on_signal(self, signum, _frame):
+        self.signals.append(signum)
+
+    def run(self):
+        '''Start the workers and supervise them until SIGTERM / SIGINT
+        @return: exit code (1 if the workers failed to boot too many times)'''
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR2):
+            signal.signal(signum, self._on_signal)
+        for _ in range(self.workers):
+            self.spawn_supervised()
+        respawn_at = []
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.shutdown()
+                    return 0
+                if signum == signal.SIGHUP:
+                    for pid in self.pids:
+                        self.send_signal(pid, signal.SIGHUP)
+                elif signum == signal.SIGUSR2:
+                    self.rolling_restart()
+            self.check_ready()
+            self.reap()
+            if self.boot_failures >= self.max_boot_failures:
+                logging.critical('The workers failed to start %s times in a row: exiting',
+                                 self.boot_failures)
+                self.shutdown()
+                return 1
+            while self.died:
+                # A worker that dies at startup is not started again right away
+                started = self.died.pop(0)
+                respawn_at.append(max(time.monotonic(), started + self.get_respawn_delay()))
+            now = time.monotonic()
+            for timestamp in [timestamp for timestamp in respawn_at if timestamp <= now]:
+                respawn_at.remove(timestamp)
+                self.spawn_supervised()
+            time.sleep(0.1)
@@ -0,0 +1,49 @@
+"""
+Migrate the blocked proxies
+
+Blocked proxies used to be stored in a Redis key per proxy: `<target_id>_blocked:<proxy_id>`
+Now they are stored in a sorted set per target scored by the unblock timestamp
+"""
+
+import sys
+
+import asyncio
+import logging
+
+import aioredis
+
+from asyncpg_connect.db import DBSession
+
+from config import get_config
+from lib.proxies.pool import ProxyPool
+
+
+async def migrate_target(redis: object, target_id: int, blocked_standby: int):
+    '''Migrate the blocked proxies of the target with ID `target_id`'''
+    proxy_pool = ProxyPool(pool_id=str(target_id), pool_len=0,
+                           standby_mins=blocked_standby, redis=redis)
+    migrated = await proxy_pool.migrate_legacy_blocked()
+    logging.info('Target %d: %d blocked proxies migrated', target_id, migrated)
+
+
+async def main():
+    '''All happens here'''
+    log_format = '%(levelname)s: %(asctime)s %(filename)s: %(message)s'
+    logging.basicConfig(stream=sys.stdout, level=logging.NOTSET,
+                        format=log_format, datefmt='%Y-%m-%d %H:%M:%S')
+
+    config = get_config()
+    db_uri = config['database']['postgres']['uri']
+    async with DBSession(db_uri) as db_session:
+        targets = await db_session.connection.fetch('SELECT id, blocked_standby FROM targets')
+    redis = await aioredis.create_redis_pool(config['database']['redis']['uri'])
+    try:
+        for target in targets:
+            await migrate_target(redis, target['id'], target['blocked_standby'])
+    finally:
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
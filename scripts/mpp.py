@@ -1,19 +1,29 @@
 """
 Utilities for MPP
+
+The plan proxies are synced with the MPP API list:
+- New proxies are inserted and changed proxies are updated
+- Proxies not in the list anymore are deactivated
+Proxy IDs do not change, so the Redis state (used, blocked, ...) of every proxy is kept
+
+The legacy mode (--replace) deletes all the plan proxies and inserts them again
 """
 
 import sys
 import logging
+import argparse
 
 import asyncio
 
-import requests
+import aiohttp
 
 from asyncpg_connect.db import DBSession
 
 from config import get_config
 
 
+DESCRIPTION = 'Proxy Service - MPP proxies sync'
+
 COUNTRY_LOCATIONS = {
     'USA': 'US',
     'UK': 'UK',
@@ -27,27 +37,46 @@ COUNTRY_LOCATIONS = {
     'Germany': 'DE',
 }
 
+UPSERT_QUERY = '''INSERT INTO proxies
+    (url, proxy_type_id, proxy_location_id, provider_id, provider_plan_id, active)
+SELECT * FROM unnest($1::varchar[], $2::integer[], $3::integer[],
+                     $4::integer[], $5::integer[], $6::boolean[])
+ON CONFLICT (url) DO UPDATE SET
+    proxy_type_id = EXCLUDED.proxy_type_id,
+    proxy_location_id = EXCLUDED.proxy_location_id,
+    provider_id = EXCLUDED.provider_id,
+    provider_plan_id = EXCLUDED.provider_plan_id,
+    active = EXCLUDED.active'''
+# Proxy columns compared to detect changes
+SYNC_COLUMNS = ('proxy_type_id', 'proxy_location_id', 'provider_id', 'provider_plan_id', 'active')
+
 
 logging.basicConfig(stream=sys.stdout, level=logging.NOTSET)
 
 
-async def update_mpp_list(api_url, plan_code, db_session):
-    # Get plan
-    plan = await db_session.connection.fetchrow(
-        'SELECT * FROM provider_plans WHERE code = $1', plan_code)
-    if plan is None:
-        logging.error('Plan "%s" does not exist', plan_code)
-        return
-    # Remove old proxies
-    await db_session.connection.fetchval(
-        'DELETE FROM proxies WHERE provider_plan_id = $1', plan['id'])
-    # Useful data for relations
-    proxy_type_id = await db_session.connection.fetchval(
-        'SELECT id FROM proxy_types WHERE code = $1', 'PRV')  # Get proxy type ID
-    location_id_map = {}  # Map Location CODE => Location ID
-    # Fetch and add proxies
-    resp = requests.get(api_url)
-    data = resp.json()
+def parse_arguments():
+    '''Parse the command line arguments'''
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--replace', action='store_true', dest='replace',
+                        help='Delete all the plan proxies and insert them again (IDs change)')
+    return parser.parse_args()
+
+
+async def fetch_mpp_list(api_url):
+    '''Fetch the proxy list from the MPP API'''
+    async with aiohttp.ClientSession() as session:
+        async with session.get(api_url) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+
+def get_proxy_rows(data, plan, proxy_type_id, location_id_map):
+    '''Return the proxy rows (dict: URL => row) given the MPP API data
+    @param data: the MPP API proxy list
+    @param plan: the provider plan row
+    @param proxy_type_id: the proxy type ID
+    @param location_id_map: Location CODE => Location ID'''
+    proxy_rows = {}
     for proxy in data:
         proxy_url = f"http://{proxy['proxy_ip']}:{proxy['proxy_port']}"
         if proxy['proxy_country'] not in COUNTRY_LOCATIONS:
@@ -55,32 +84,90 @@ async def update_mpp_list(api_url, plan_code, db_session):
             continue
         location_code = COUNTRY_LOCATIONS[proxy['proxy_country']]
         if location_code not in location_id_map:
-            location_id = await db_session.connection.fetchval(
-                'SELECT id FROM proxy_locations WHERE code = $1', location_code)
-            if location_id is None:
-                logging.error('Location CODE does not exist: %s', location_code)
-                continue
-            location_id_map[location_code] = location_id
-
-        proxy_row = {
+            logging.error('Location CODE does not exist: %s', location_code)
+            continue
+        proxy_rows[proxy_url] = {
             'url': proxy_url,
             'proxy_type_id': proxy_type_id,
             'proxy_location_id': location_id_map[location_code],
             'provider_id': plan['provider_id'],
             'provider_plan_id': plan['id'],
+            'active': True,
         }
+    return proxy_rows
 
+
+async def get_sync_data(api_url, plan_code, db_session):
+    '''Return the plan and the proxy rows to sync (see `get_proxy_rows`)
+    The plan is None if it does not exist'''
+    plan = await db_session.connection.fetchrow(
+        'SELECT * FROM provider_plans WHERE code = $1', plan_code)
+    if plan is None:
+        logging.error('Plan "%s" does not exist', plan_code)
+        return None, {}
+    # Useful data for relations
+    proxy_type_id = await db_session.connection.fetchval(
+        'SELECT id FROM proxy_types WHERE code = $1', 'PRV')  # Get proxy type ID
+    location_rows = await db_session.connection.fetch('SELECT id, code FROM proxy_locations')
+    location_id_map = {row['code']: row['id'] for row in location_rows}
+    data = await fetch_mpp_list(api_url)
+    return plan, get_proxy_rows(data, plan, proxy_type_id, location_id_map)
+
+
+async def sync_mpp_list(api_url, plan_code, db_session):
+    '''Sync the plan proxies with the MPP API list
+    The changes are applied in a single transaction'''
+    plan, proxy_rows = await get_sync_data(api_url, plan_code, db_session)
+    if plan is None:
+        return
+    connection = db_session.connection
+    existing_rows = await connection.fetch(
+        'SELECT * FROM proxies WHERE provider_plan_id = $1 OR url = ANY($2)',
+        plan['id'], list(proxy_rows))
+    existing = {row['url']: row for row in existing_rows}
+    upserts = []
+    for proxy_url, proxy_row in proxy_rows.items():
+        current = existing.get(proxy_url)
+        if current is None or any(current[c] != proxy_row[c] for c in SYNC_COLUMNS):
+            upserts.append(proxy_row)
+    deactivate_ids = [row['id'] for url, row in existing.items()
+                      if url not in proxy_rows and row['provider_plan_id'] == plan['id']
+                      and row['active']]
+    async with connection.transaction():
+        if upserts:
+            await connection.execute(UPSERT_QUERY,
+                                     *[[row[c] for row in upserts] for c in ('url', ) + SYNC_COLUMNS])
+        if deactivate_ids:
+            await connection.execute(
+                'UPDATE proxies SET active = FALSE WHERE id = ANY($1)', deactivate_ids)
+    logging.info('Plan "%s": %d proxies, %d inserted or updated, %d deactivated',
+                 plan_code, len(proxy_rows), len(upserts), len(deactivate_ids))
+
+
+async def update_mpp_list(api_url, plan_code, db_session):
+    '''Replace the plan proxies with the MPP API list (legacy mode)'''
+    plan, proxy_rows = await get_sync_data(api_url, plan_code, db_session)
+    if plan is None:
+        return
+    # Remove old proxies
+    await db_session.connection.fetchval(
+        'DELETE FROM proxies WHERE provider_plan_id = $1', plan['id'])
+    for proxy_row in proxy_rows.values():
         proxy_id = await db_session.find_or_create('proxies', proxy_row, return_field='id')
         logging.debug('Proxy with ID: %d', proxy_id)
 
 
 async def main():
+    args = parse_arguments()
     config = get_config()
     db_uri = config['database']['postgres']['uri']
     api_url = config['mpp']['api_url']
     plan_code = config['mpp']['plan_code']
     async with DBSession(db_uri) as db_session:
-        await update_mpp_list(api_url, plan_code, db_session)
+        if args.replace:
+            await update_mpp_list(api_url, plan_code, db_session)
+        else:
+            await sync_mpp_list(api_url, plan_code, db_session)
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -30,6 +30,30 @@ URL_RE = re.compile(
 
 DESCRIPTION = 'Proxy Service - Proxy data management'
 
+# Bulk import: the URLs are copied to this temporary table and upserted in one query
+BULK_IMPORT_TABLE = 'proxies_import'
+BULK_IMPORT_UPSERT = {
+    'update': '''ON CONFLICT (url) DO UPDATE SET
+        proxy_type_id = EXCLUDED.proxy_type_id,
+        proxy_location_id = EXCLUDED.proxy_location_id,
+        provider_id = EXCLUDED.provider_id,
+        provider_plan_id = EXCLUDED.provider_plan_id
+        WHERE (proxies.proxy_type_id, proxies.proxy_location_id,
+               proxies.provider_id, proxies.provider_plan_id)
+        IS DISTINCT FROM (EXCLUDED.proxy_type_id, EXCLUDED.proxy_location_id,
+                          EXCLUDED.provider_id, EXCLUDED.provider_plan_id)''',
+    'nothing': 'ON CONFLICT (url) DO NOTHING',
+}
+BULK_IMPORT_QUERY = '''WITH upsert AS (
+    INSERT INTO proxies (url, proxy_type_id, proxy_location_id, provider_id, provider_plan_id)
+    SELECT DISTINCT url, $1::integer, $2::integer, $3::integer, $4::integer FROM {table}
+    {on_conflict}
+    RETURNING (xmax = 0) AS inserted)
+SELECT
+    count(*) FILTER (WHERE inserted) AS "inserted",
+    count(*) FILTER (WHERE NOT inserted) AS "updated"
+FROM upsert'''
+
 
 def parse_arguments():
     '''Parse the command line arguments'''
@@ -50,6 +74,11 @@ def parse_arguments():
                         help='Proxy list type (Type code)')
     parser.add_argument('--proxy_txt_location', type=str, dest='proxy_txt_loc',
                         help='Proxy list location (Location code)')
+    parser.add_argument('--proxy_txt_bulk', action='store_true', dest='proxy_txt_bulk',
+                        help='Import the proxy list with COPY and a single upsert')
+    parser.add_argument('--proxy_txt_on_conflict', type=str, dest='proxy_txt_on_conflict',
+                        choices=sorted(BULK_IMPORT_UPSERT), default='update',
+                        help='Bulk import: update or keep (nothing) the existing proxies')
     return parser.parse_args()
 
 
@@ -101,23 +130,23 @@ async def add_new_location(db_session: DBSession, code: str, name: str):
     logging.debug('Added proxy location with ID: %d', loc_id)
 
 
-async def import_proxy_list_txt(  # pylint: disable=too-many-locals
-        db_session: DBSession, txt_file: str, proxy_type: str,
-        proxy_plan: str = None, proxy_location: str = None):
-    '''Import a TXT file with proxies'''
+async def get_proxy_list_relations(db_session: DBSession, proxy_type: str,
+                                   proxy_plan: str = None, proxy_location: str = None):
+    '''Return the IDs of the proxy list relations (dict) given their codes
+    It returns None if any of them does not exist'''
     proxy_type_code = proxy_type.strip()
     proxy_type_id = await db_session.connection.fetchval(
         'SELECT id FROM proxy_types WHERE code = $1', proxy_type_code)
     if proxy_type_id is None:
         logging.error('Not valid proxy type: %s', proxy_type_code)
-        return
+        return None
     if proxy_plan is not None:
         proxy_plan_code = proxy_plan.strip()
         proxy_plan = await db_session.connection.fetchrow(
             'SELECT * FROM provider_plans WHERE code = $1', proxy_plan_code)
         if proxy_plan is None:
             logging.error('Not valid provider plan: %s', proxy_plan_code)
-            return
+            return None
         proxy_provider_id = proxy_plan['provider_id']
         proxy_plan_id = proxy_plan['id']
     else:
@@ -129,33 +158,96 @@ async def import_proxy_list_txt(  # pylint: disable=too-many-locals
             'SELECT id FROM proxy_locations WHERE code = $1', proxy_location_code)
         if proxy_location_id is None:
             logging.error('Not valid location: %s', proxy_location_code)
-            return
+            return None
     else:
         proxy_location_id = None
+    return {
+        'proxy_type_id': proxy_type_id,
+        'proxy_location_id': proxy_location_id,
+        'provider_id': proxy_provider_id,
+        'provider_plan_id': proxy_plan_id,
+    }
+
+
+def read_proxy_list_txt(f_txt, stats: dict):
+    '''Yield the valid proxy URLs in the TXT file
+    The not valid URLs are counted in stats['skipped']'''
+    for line in f_txt:
+        proxy_url = line.strip()
+        if not proxy_url:
+            continue
+        if not URL_RE.match(proxy_url):
+            logging.warning('Ignoring not valid proxy URL: %s', proxy_url)
+            stats['skipped'] += 1
+            continue
+        stats['read'] += 1
+        yield proxy_url
+
+
+async def import_proxy_list_txt(
+        db_session: DBSession, txt_file: str, proxy_type: str,
+        proxy_plan: str = None, proxy_location: str = None):
+    '''Import a TXT file with proxies'''
+    relations = await get_proxy_list_relations(db_session, proxy_type, proxy_plan, proxy_location)
+    if relations is None:
+        return
 
     if not os.path.exists(txt_file):
         logging.error('File does not exist in current directory: %s', txt_file)
         return
 
+    stats = {'read': 0, 'skipped': 0}
     with open(txt_file) as f_txt:
-        for line in f_txt:
-            proxy_url = line.strip()
-            if not proxy_url:
-                continue
-            if not URL_RE.match(proxy_url):
-                logging.warning('Ignoring not valid proxy URL: %s', proxy_url)
-                continue
-            proxy_row = {
-                'url': proxy_url,
-                'proxy_type_id': proxy_type_id,
-                'proxy_location_id': proxy_location_id,
-                'provider_id': proxy_provider_id,
-                'provider_plan_id': proxy_plan_id,
-            }
+        for proxy_url in read_proxy_list_txt(f_txt, stats):
+            proxy_row = dict(relations, url=proxy_url)
             proxy_id = await db_session.find_or_create('proxies', proxy_row, return_field='id')
             logging.debug('Added proxy with ID: %d', proxy_id)
 
 
+async def bulk_import_proxy_list_txt(  # pylint: disable=too-many-arguments
+        db_session: DBSession, txt_file: str, proxy_type: str,
+        proxy_plan: str = None, proxy_location: str = None, on_conflict: str = 'update'):
+    '''Import a TXT file with proxies in bulk
+    The valid URLs are streamed into a temporary table with COPY
+    and then upserted into `proxies` with a single query
+    @param on_conflict: `update` or `nothing` for the already existing proxy URLs
+    @return: dict with the inserted, updated and skipped counts'''
+    relations = await get_proxy_list_relations(db_session, proxy_type, proxy_plan, proxy_location)
+    if relations is None:
+        return None
+
+    if not os.path.exists(txt_file):
+        logging.error('File does not exist in current directory: %s', txt_file)
+        return None
+
+    connection = db_session.connection
+    query = BULK_IMPORT_QUERY.format(table=BULK_IMPORT_TABLE,
+                                     on_conflict=BULK_IMPORT_UPSERT[on_conflict])
+    stats = {'read': 0, 'skipped': 0}
+    with open(txt_file) as f_txt:
+        async with connection.transaction():
+            await connection.execute(
+                'CREATE TEMPORARY TABLE {} (url varchar(1024) NOT NULL) ON COMMIT DROP'.format(
+                    BULK_IMPORT_TABLE))
+            await connection.copy_records_to_table(
+                BULK_IMPORT_TABLE, columns=['url'],
+                records=((proxy_url, ) for proxy_url in read_proxy_list_txt(f_txt, stats)))
+            result = await connection.fetchrow(query,
+                                               relations['proxy_type_id'],
+                                               relations['proxy_location_id'],
+                                               relations['provider_id'],
+                                               relations['provider_plan_id'])
+    counts = {
+        'inserted': result['inserted'],
+        'updated': result['updated'],
+        # Not valid URLs, duplicated URLs in the file and not changed proxies
+        'skipped': stats['skipped'] + stats['read'] - result['inserted'] - result['updated'],
+    }
+    logging.info('Proxies inserted: %(inserted)d, updated: %(updated)d, skipped: %(skipped)d',
+                 counts)
+    return counts
+
+
 async def main():
     '''All happens here'''
     args = parse_arguments()
@@ -181,9 +273,15 @@ async def main():
             await add_new_location(db_session, *args.proxy_loc.split(','))
         if args.proxy_txt:
             logging.info('Importing TXT file: %s', args.proxy_txt)
-            await import_proxy_list_txt(db_session,
-                                        args.proxy_txt, args.proxy_txt_type,
-                                        args.proxy_txt_plan, args.proxy_txt_loc)
+            if args.proxy_txt_bulk:
+                await bulk_import_proxy_list_txt(db_session,
+                                                 args.proxy_txt, args.proxy_txt_type,
+                                                 args.proxy_txt_plan, args.proxy_txt_loc,
+                                                 on_conflict=args.proxy_txt_on_conflict)
+            else:
+                await import_proxy_list_txt(db_session,
+                                            args.proxy_txt, args.proxy_txt_type,
+                                            args.proxy_txt_plan, args.proxy_txt_loc)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,22 @@
 """
 Test all proxies
+
+The proxies are tested concurrently (up to --concurrency requests at the same time)
+The status and latency of every proxy can be saved in database (--save)
+Only HTTP(S) proxies can be tested: the other ones (ie: SOCKS, Tor) are skipped
+and their status is never saved
 """
 
 import sys
-import os
-import re
+import time
 
 import asyncio
 import logging
 import argparse
-import requests
+from datetime import datetime
+from urllib.parse import urlparse
 
-from requests.exceptions import RequestException
+import aiohttp
 
 from asyncpg_connect.db import DBSession
 
@@ -21,9 +26,19 @@ from config import get_config
 TARGET_URL = 'https://api.myip.com/'
 CONCURRENT_REQUESTS = 64
 TIMEOUT_SEC = 10
+# Proxy URL schemes supported by aiohttp
+TESTED_SCHEMES = ('http', 'https')
 
 DESCRIPTION = 'Proxy Service - Test Proxies'
 
+SAVE_RESULTS_QUERY = '''UPDATE proxies prx SET
+    active = res.active,
+    last_latency_ms = res.latency_ms,
+    last_check_time = res.check_time
+FROM unnest($1::integer[], $2::boolean[], $3::integer[], $4::timestamp[])
+    AS res(id, active, latency_ms, check_time)
+WHERE prx.id = res.id'''
+
 
 def parse_arguments():
     '''Parse the command line arguments'''
@@ -34,36 +49,76 @@ def parse_arguments():
                         help='Filter by proxy type code')
     parser.add_argument('--location', type=str, dest='location',
                         help='Filter by location code')
+    parser.add_argument('--all', action='store_true', dest='all',
+                        help='Test the not active proxies as well')
+    parser.add_argument('--concurrency', type=int, dest='concurrency',
+                        default=CONCURRENT_REQUESTS, help='Max concurrent requests')
+    parser.add_argument('--timeout', type=int, dest='timeout',
+                        default=TIMEOUT_SEC, help='Request timeout (seconds)')
+    parser.add_argument('--save', action='store_true', dest='save',
+                        help='Save the active flag, latency and check time of every proxy')
     return parser.parse_args()
 
 
-async def test_proxy(proxy: dict):
-    logging.info('TESTING PROXY: %s', proxy['url'])
-    try:
-        res = requests.get(TARGET_URL,
-                           proxies={'http': proxy['url'],
-                                    'https': proxy['url']},
-                           timeout=TIMEOUT_SEC)
-    except RequestException as exp:
-        logging.error('Proxy failed with error: %r -> %s', proxy, exp)
-        return
-
-    if res.status_code != 200:
-        logging.error('Proxy returned no 200 code: %d', res.status_code)
-
-
-async def test_proxy_list(proxy_list: list):
-    futures = []
-    while proxy_list:
-        proxy = proxy_list.pop(0)
-        futures.append(test_proxy(proxy))
-        if len(futures) == CONCURRENT_REQUESTS or not proxy_list:
-            await asyncio.gather(*futures)
-            futures = []
-
-
-async def get_proxy_list(db_session: DBSession, provider_code: str, location_code: str, type_code: str) -> list:
+async def test_proxy(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, proxy: dict):
+    '''Test the proxy and return the result (dict)
+    - active: True if the proxy returned a 200 response (None if it can not be tested)
+    - latency_ms: the response time (None if the proxy failed)
+    - check_time: when the proxy was tested'''
+    result = {'id': proxy['id'], 'active': False, 'latency_ms': None, 'check_time': None}
+    if urlparse(proxy['url']).scheme not in TESTED_SCHEMES:
+        logging.warning('Proxy not tested (not supported scheme): %s', proxy['url'])
+        result['active'] = None
+        return result
+    async with semaphore:
+        # The proxy is tested when a request slot is free, not when the task is created
+        result['check_time'] = datetime.now()
+        logging.info('TESTING PROXY: %s', proxy['url'])
+        start = time.monotonic()
+        try:
+            async with session.get(TARGET_URL, proxy=proxy['url']) as res:
+                await res.read()
+                status = res.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exp:
+            logging.error('Proxy failed with error: %r -> %r', proxy, exp)
+            return result
+    if status != 200:
+        logging.error('Proxy returned no 200 code: %d', status)
+        return result
+    result['active'] = True
+    result['latency_ms'] = int((time.monotonic() - start) * 1000)
+    return result
+
+
+async def test_proxy_list(proxy_list: list, concurrency: int = CONCURRENT_REQUESTS,
+                          timeout: int = TIMEOUT_SEC):
+    '''Test all the proxies. There are up to `concurrency` requests at the same time
+    A new request starts as soon as another one finishes
+    @return: the list of results (see `test_proxy`)'''
+    semaphore = asyncio.Semaphore(concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+    async with aiohttp.ClientSession(timeout=client_timeout, connector=connector) as session:
+        return await asyncio.gather(*[test_proxy(session, semaphore, proxy)
+                                      for proxy in proxy_list])
+
+
+async def save_results(db_session: DBSession, results: list):
+    '''Save the results in database in a single query
+    The results of the proxies not tested are not saved'''
+    results = [res for res in results if res['active'] is not None]
+    await db_session.connection.execute(
+        SAVE_RESULTS_QUERY,
+        [res['id'] for res in results],
+        [res['active'] for res in results],
+        [res['latency_ms'] for res in results],
+        [res['check_time'] for res in results])
+
+
+async def get_proxy_list(db_session: DBSession, provider_code: str, location_code: str,
+                         type_code: str, only_active: bool = True) -> list:
     query = '''SELECT
+        prx.id as "id",
         prx.url as "url",
         prv.name as "provider",
         loc.name as "location",
@@ -73,17 +128,19 @@ async def get_proxy_list(db_session: DBSession, provider_code: str, location_cod
         LEFT JOIN providers prv ON (prx.provider_id = prv.id)
         LEFT JOIN proxy_locations loc ON (prx.proxy_location_id = loc.id)
         LEFT JOIN proxy_types pty ON (prx.proxy_type_id = pty.id)'''
-    where = ['prx.active = $1']
-    args = [True]
+    where = []
+    args = []
+    if only_active:
+        where.append('prx.active')
     if provider_code:
         args.append(provider_code)
-        where.append(f'prv.code = ${len(args)+1}')
+        where.append(f'prv.code = ${len(args)}')
     if location_code:
         args.append(location_code)
-        where.append(f'loc.code = ${len(args)+1}')
+        where.append(f'loc.code = ${len(args)}')
     if type_code:
         args.append(type_code)
-        where.append(f'pty.code = ${len(args)+1}')
+        where.append(f'pty.code = ${len(args)}')
 
     if where:
         where_str = ' AND '.join(where)
@@ -105,11 +162,21 @@ async def main():
     db_uri = config['database']['postgres']['uri']
     async with DBSession(db_uri) as db_session:
         logging.info('Testing proxies: %r', args)
-        proxy_list = await get_proxy_list(db_session, args.provider, args.location, args.proxy_type)
+        proxy_list = await get_proxy_list(db_session, args.provider, args.location,
+                                          args.proxy_type, only_active=not args.all)
 
     logging.info('%d PROXIES LOADED', len(proxy_list))
 
-    await test_proxy_list(proxy_list)
+    results = await test_proxy_list(proxy_list, args.concurrency, args.timeout)
+
+    logging.info('%d PROXIES ACTIVE', sum(1 for res in results if res['active']))
+    logging.info('%d PROXIES NOT TESTED', sum(1 for res in results if res['active'] is None))
+
+    if args.save:
+        async with DBSession(db_uri) as db_session:
+            await save_results(db_session, results)
+        logging.info('%d RESULTS SAVED',
+                     sum(1 for res in results if res['active'] is not None))
 
 
 if __name__ == '__main__':
@@ -1,12 +1,21 @@
 """
 This is the main AIOHTTP server for the Proxy Service API
+
+With `--workers N` (or `workers` in the [server] config section) N worker processes
+share the port (SO_REUSEPORT), see lib/workers.py
 """
 
+import sys
+import signal
 import asyncio
+import logging
 import argparse
 from aiohttp import web
+from config import Config
+from config import ConfigError
 from config import get_config
 from api import init_app
+from lib.workers import WorkerSupervisor
 
 
 DESCRIPTION = 'Proxy Service API: aiohttp server'
@@ -16,17 +25,70 @@ def parse_arguments():
     '''Parse the command line arguments'''
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument('--path')
-    parser.add_argument('--port')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--workers', type=int, help='Number of worker processes')
     return parser.parse_args()
 
 
+def set_event_loop_policy(server_config):
+    '''Use the uvloop event loop (optional)'''
+    if not server_config.get('uvloop', False):
+        return
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logging.warning('uvloop is not installed: using the default event loop')
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def run_worker(config_path, host, port, shutdown_timeout, notify_ready):
+    '''Run the aiohttp server in a worker process
+    The config file is read again: a restarted worker gets all the config changes'''
+    config = Config(config_path)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = loop.run_until_complete(init_app(loop, config))
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port, reuse_port=True, shutdown_timeout=shutdown_timeout)
+    loop.run_until_complete(site.start())
+    notify_ready()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    try:
+        loop.run_until_complete(stop.wait())
+    finally:
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
 def run_server():
     '''Run the main aiohttp server'''
     config = get_config()
+    args = parse_arguments()
+    server_config = config.get('server', {})
+    host = args.host or server_config.get('host')  # Default: 0.0.0.0
+    port = args.port or server_config.get('port')  # Default: 8080
+    shutdown_timeout = server_config.get('shutdown_timeout', 60.0)
+    workers = args.workers or server_config.get('workers', 1)
+    set_event_loop_policy(server_config)
+    if workers > 1:
+        if args.path:
+            raise ConfigError('The worker processes can not share a UNIX socket')
+        supervisor = WorkerSupervisor(
+            lambda notify_ready: run_worker(config.path, host, port, shutdown_timeout,
+                                            notify_ready),
+            workers=workers,
+            ready_timeout=server_config.get('ready_timeout', 30.0),
+            shutdown_timeout=shutdown_timeout + 5,
+            max_boot_failures=server_config.get('max_boot_failures', 5))
+        sys.exit(supervisor.run())
     loop = asyncio.get_event_loop()
     app = loop.run_until_complete(init_app(loop, config))
-    args = parse_arguments()
-    web.run_app(app, path=args.path, port=args.port)
+    web.run_app(app, path=args.path, host=host, port=port, shutdown_timeout=shutdown_timeout)
 
 
 if __name__ == '__main__':
@@ -24,6 +24,8 @@ CREATE TABLE provider_plans (
        provider_id integer NOT NULL REFERENCES providers (id) ON DELETE CASCADE,
        name varchar(256) NOT NULL,
        code varchar(8) UNIQUE NOT NULL,
+       max_concurrency integer,
+       max_rpm integer,
        UNIQUE (provider_id, name));
 
 CREATE INDEX provider_plans_provider_id_ix ON provider_plans (provider_id);
@@ -40,7 +42,13 @@ CREATE TABLE proxies (
        tor_control_port integer,
        tor_control_pswd text,
        tor_renew_identity boolean DEFAULT FALSE,
-       dont_block boolean DEFAULT FALSE);
+       dont_block boolean DEFAULT FALSE,
+       last_latency_ms integer,
+       last_check_time timestamp,
+       max_concurrency integer,
+       max_rpm integer,
+       virtual_slots integer,
+       slot_mode varchar(8) CHECK (slot_mode IN ('session', 'port')));
 
 CREATE INDEX proxies_proxy_type_id_ix ON proxies (proxy_type_id);
 CREATE INDEX proxies_proxy_location_id_ix ON proxies (proxy_location_id) WHERE proxy_location_id IS NOT NULL;
@@ -71,7 +79,8 @@ CREATE INDEX target_provider_plans_target_id_ix ON target_provider_plans (target
 -- Views
 
 CREATE VIEW provider_plans_view AS
-    SELECT plan.id, plan.code, plan.provider_id, prov.name as "provider_desc", plan.name
+    SELECT plan.id, plan.code, plan.provider_id, prov.name as "provider_desc", plan.name,
+           plan.max_concurrency, plan.max_rpm
     FROM provider_plans plan JOIN providers prov ON (plan.provider_id = prov.id);
 
 CREATE VIEW proxies_view AS
@@ -79,9 +88,48 @@ CREATE VIEW proxies_view AS
         proxy.id, proxy.url, proxy.active, CASE WHEN proxy.active THEN 'Yes' ELSE 'No' END active_desc,
         proxy.proxy_type_id, ptype.name as "type_desc", proxy.proxy_location_id, ploc.name as "location_desc",
         proxy.provider_id, pprov.name as "provider_name", proxy.provider_plan_id, pplan.name as "plan_desc",
-        proxy.dont_block
+        proxy.dont_block, proxy.last_latency_ms, proxy.last_check_time,
+        proxy.max_concurrency, proxy.max_rpm, proxy.virtual_slots, proxy.slot_mode
     FROM
         proxies proxy LEFT JOIN proxy_types ptype ON (proxy.proxy_type_id = ptype.id)
                       LEFT JOIN proxy_locations ploc ON (proxy.proxy_location_id = ploc.id)
                       LEFT JOIN providers pprov ON (proxy.provider_id = pprov.id)
                       LEFT JOIN provider_plans pplan ON (proxy.provider_plan_id = pplan.id);
+
+
+-- Proxy catalog notifications (LISTEN proxy_catalog)
+
+CREATE FUNCTION notify_proxy_catalog() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        row_data := to_jsonb(OLD);
+        PERFORM pg_notify('proxy_catalog', json_build_object(
+            'table', TG_TABLE_NAME, 'id', row_data->'id', 'target_id', row_data->'target_id')::text);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        row_data := to_jsonb(NEW);
+        PERFORM pg_notify('proxy_catalog', json_build_object(
+            'table', TG_TABLE_NAME, 'id', row_data->'id', 'target_id', row_data->'target_id')::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER proxies_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON proxies
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER targets_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON targets
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER target_providers_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON target_providers
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER target_provider_plans_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON target_provider_plans
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER proxy_types_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON proxy_types
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER proxy_locations_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON proxy_locations
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER providers_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON providers
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+CREATE TRIGGER provider_plans_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON provider_plans
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
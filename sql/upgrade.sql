@@ -0,0 +1,84 @@
+-- Upgrade a database created with a previous sql/schema.sql
+-- Every statement can be run more than once
+
+-- Proxy checks (scripts/test_proxies.py --save)
+ALTER TABLE proxies ADD COLUMN IF NOT EXISTS last_latency_ms integer;
+ALTER TABLE proxies ADD COLUMN IF NOT EXISTS last_check_time timestamp;
+
+-- Proxy and plan caps
+ALTER TABLE provider_plans ADD COLUMN IF NOT EXISTS max_concurrency integer;
+ALTER TABLE provider_plans ADD COLUMN IF NOT EXISTS max_rpm integer;
+ALTER TABLE proxies ADD COLUMN IF NOT EXISTS max_concurrency integer;
+ALTER TABLE proxies ADD COLUMN IF NOT EXISTS max_rpm integer;
+
+-- Backconnect virtual slots
+ALTER TABLE proxies ADD COLUMN IF NOT EXISTS virtual_slots integer;
+ALTER TABLE proxies ADD COLUMN IF NOT EXISTS slot_mode varchar(8)
+    CHECK (slot_mode IN ('session', 'port'));
+
+
+-- Views (the new columns are appended)
+
+CREATE OR REPLACE VIEW provider_plans_view AS
+    SELECT plan.id, plan.code, plan.provider_id, prov.name as "provider_desc", plan.name,
+           plan.max_concurrency, plan.max_rpm
+    FROM provider_plans plan JOIN providers prov ON (plan.provider_id = prov.id);
+
+CREATE OR REPLACE VIEW proxies_view AS
+    SELECT
+        proxy.id, proxy.url, proxy.active, CASE WHEN proxy.active THEN 'Yes' ELSE 'No' END active_desc,
+        proxy.proxy_type_id, ptype.name as "type_desc", proxy.proxy_location_id, ploc.name as "location_desc",
+        proxy.provider_id, pprov.name as "provider_name", proxy.provider_plan_id, pplan.name as "plan_desc",
+        proxy.dont_block, proxy.last_latency_ms, proxy.last_check_time,
+        proxy.max_concurrency, proxy.max_rpm, proxy.virtual_slots, proxy.slot_mode
+    FROM
+        proxies proxy LEFT JOIN proxy_types ptype ON (proxy.proxy_type_id = ptype.id)
+                      LEFT JOIN proxy_locations ploc ON (proxy.proxy_location_id = ploc.id)
+                      LEFT JOIN providers pprov ON (proxy.provider_id = pprov.id)
+                      LEFT JOIN provider_plans pplan ON (proxy.provider_plan_id = pplan.id);
+
+
+-- Proxy catalog notifications (LISTEN proxy_catalog, see lib/proxies/catalog.py)
+
+CREATE OR REPLACE FUNCTION notify_proxy_catalog() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        row_data := to_jsonb(OLD);
+        PERFORM pg_notify('proxy_catalog', json_build_object(
+            'table', TG_TABLE_NAME, 'id', row_data->'id', 'target_id', row_data->'target_id')::text);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        row_data := to_jsonb(NEW);
+        PERFORM pg_notify('proxy_catalog', json_build_object(
+            'table', TG_TABLE_NAME, 'id', row_data->'id', 'target_id', row_data->'target_id')::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS proxies_catalog_tg ON proxies;
+CREATE TRIGGER proxies_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON proxies
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS targets_catalog_tg ON targets;
+CREATE TRIGGER targets_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON targets
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS target_providers_catalog_tg ON target_providers;
+CREATE TRIGGER target_providers_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON target_providers
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS target_provider_plans_catalog_tg ON target_provider_plans;
+CREATE TRIGGER target_provider_plans_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON target_provider_plans
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS proxy_types_catalog_tg ON proxy_types;
+CREATE TRIGGER proxy_types_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON proxy_types
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS proxy_locations_catalog_tg ON proxy_locations;
+CREATE TRIGGER proxy_locations_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON proxy_locations
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS providers_catalog_tg ON providers;
+CREATE TRIGGER providers_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON providers
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
+DROP TRIGGER IF EXISTS provider_plans_catalog_tg ON provider_plans;
+CREATE TRIGGER provider_plans_catalog_tg AFTER INSERT OR UPDATE OR DELETE ON provider_plans
+    FOR EACH ROW EXECUTE PROCEDURE notify_proxy_catalog();
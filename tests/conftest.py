@@ -0,0 +1,36 @@
+"""
+Test fixtures
+
+The Redis tests run against fakeredis (the Lua scripts need lupa)
+Every test gets its own fake Redis server
+"""
+
+import asyncio
+
+import pytest
+import fakeredis
+import fakeredis.aioredis
+
+
+@pytest.fixture
+def run_redis():
+    '''Return a function running a coroutine function with a new fake Redis connection pool
+    ie: run_redis(test) where test is `async def test(redis): ...`'''
+    server = fakeredis.FakeServer()
+
+    def run(test):
+        async def main():
+            redis = await fakeredis.aioredis.create_redis_pool(server)
+            try:
+                return await test(redis)
+            finally:
+                redis.close()
+                await redis.wait_closed()
+        return asyncio.run(main())
+    return run
+
+
+def proxy(pid: int, dont_block: bool = False, **caps):
+    '''Return a proxy object as loaded from the database
+    @param **caps: max_concurrency, max_rpm, provider_plan_id, plan_max_concurrency...'''
+    return dict(id=pid, dont_block=dont_block, **caps)
@@ -0,0 +1,65 @@
+"""
+Authentication cache tests
+"""
+
+import asyncio
+
+from passlib.apps import custom_app_context as pwd_context
+
+from api.auth import TokenAuth
+from api.models.user import UserDB
+
+
+class Users(UserDB):
+    '''Users held in memory: username => password hash'''
+
+    def __init__(self, app, users: dict):
+        super().__init__(app)
+        self.users = users
+
+    async def get_user(self, username):
+        if username not in self.users:
+            return None
+        return {'username': username, 'password': self.users[username]}
+
+
+def test_credentials_cache(monkeypatch):
+    verified = []
+    verify = pwd_context.verify
+
+    def counted_verify(password, password_hash):
+        verified.append(password)
+        return verify(password, password_hash)
+    monkeypatch.setattr(pwd_context, 'verify', counted_verify)
+    app = {'pool': None, 'auth': TokenAuth('secret', 600)}
+    users = Users(app, {'user': UserDB.password_hash('pass1')})
+
+    async def test():
+        assert await users.verify_identity('user', 'pass1')
+        assert await users.verify_identity('user', 'pass1')
+        assert verified == ['pass1']
+        assert not await users.verify_identity('user', 'wrong')
+        assert not await users.verify_identity('user', 'wrong')
+        assert verified == ['pass1', 'wrong', 'wrong']
+        # Password changed: the old password is not valid anymore
+        users.users['user'] = UserDB.password_hash('pass2')
+        assert not await users.verify_identity('user', 'pass1')
+        assert await users.verify_identity('user', 'pass2')
+        # User removed
+        del users.users['user']
+        assert not await users.verify_identity('user', 'pass2')
+    asyncio.run(test())
+
+
+def test_disabled_credentials_cache():
+    auth = TokenAuth('secret', 600, credentials_ttl=0)
+    auth.set_verified('user', 'pass', 'hash')
+    assert not auth.is_verified('user', 'pass', 'hash')
+
+
+def test_tokens():
+    auth = TokenAuth('secret', 600)
+    token = auth.dump_token({'user': 'user'})
+    assert auth.load_token(token) == {'user': 'user'}
+    assert auth.load_token(token) == {'user': 'user'}
+    assert len(auth.tokens) == 1
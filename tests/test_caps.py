@@ -0,0 +1,143 @@
+"""
+Proxy caps tests: max concurrency and max requests per minute of the proxies and plans
+in every selection mode (see CAPS in lib/proxies/scripts.py)
+"""
+
+import pytest
+
+from lib.proxies.pool import ProxyPool
+from lib.proxies.backconnect import get_virtual_id
+from tests.conftest import proxy
+
+
+MODES = ('batched', 'atomic', 'lease')
+
+
+def pool_ids(proxy_pool):
+    return sorted(proxy['id'] for proxy in proxy_pool.pool)
+
+
+async def load(redis, mode, proxies, pool_len=4, lease_ttl=60):
+    proxy_pool = ProxyPool('test', pool_len, 10, redis, lease_ttl=lease_ttl)
+    await proxy_pool.loader(mode)(*proxies)
+    return proxy_pool
+
+
+def concurrency_proxies():
+    # 1: max concurrency 1, 2 and 3: plan 7 with a plan wide max concurrency 1, 4: no caps
+    return [proxy(1, max_concurrency=1),
+            proxy(2, provider_plan_id=7, plan_max_concurrency=1),
+            proxy(3, provider_plan_id=7, plan_max_concurrency=1),
+            proxy(4)]
+
+
+def test_caps_args():
+    proxies = concurrency_proxies() + [proxy(5, max_rpm=30, provider_plan_id=8)]
+    caps_keys, caps_args = ProxyPool.get_caps_args({proxy['id']: proxy for proxy in proxies})
+    assert caps_keys == ['proxy_1_leases', 'proxy_1_bucket', 'plan_7_leases', 'plan_7_bucket',
+                         'proxy_5_leases', 'proxy_5_bucket']
+    assert caps_args == ['1:1,2:2,3:2,5:3', '1:,1:,:30']
+    assert ProxyPool.get_caps_args({4: proxy(4)}) == ([], ['', ''])
+
+
+def test_virtual_slots_share_the_gateway_caps():
+    slots = {get_virtual_id(9, slot): proxy(get_virtual_id(9, slot), max_concurrency=1)
+             for slot in (1, 2)}
+    caps_keys, caps_args = ProxyPool.get_caps_args(slots)
+    assert caps_keys == ['proxy_9_leases', 'proxy_9_bucket']
+    assert caps_args[1] == '1:'
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_max_concurrency(run_redis, mode):
+    proxies = concurrency_proxies()
+
+    async def test(redis):
+        first = await load(redis, mode, proxies)
+        assert 1 in pool_ids(first) and 4 in pool_ids(first)
+        assert len(set(pool_ids(first)) & {2, 3}) == 1
+        # Neither proxy 1 nor another proxy of plan 7 until the checkouts expire
+        second = await load(redis, mode, proxies)
+        assert not set(pool_ids(second)) & {1, 2, 3}
+        assert await redis.zcard('proxy_1_leases') == 1
+        assert await redis.zcard('plan_7_leases') == 1
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_expired_checkouts(run_redis, mode):
+    proxies = concurrency_proxies()
+
+    async def test(redis):
+        await load(redis, mode, proxies, lease_ttl=0)
+        await redis.delete('test_used_list', 'test_leases')
+        second = await load(redis, mode, proxies)
+        assert 1 in pool_ids(second)
+        assert len(set(pool_ids(second)) & {2, 3}) == 1
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_max_rpm(run_redis, mode):
+    # Plan 9: plan wide max 2 requests per minute
+    proxies = [proxy(pid, provider_plan_id=9, plan_max_rpm=2) for pid in (1, 2, 3)]
+
+    async def test(redis):
+        first = await load(redis, mode, proxies, pool_len=3)
+        assert len(first.pool) == 2
+        second = await load(redis, mode, proxies, pool_len=3)
+        assert second.pool == []
+        assert float(await redis.hget('plan_9_bucket', 'tokens')) < 1
+    run_redis(test)
+
+
+def test_lease_release_frees_the_concurrency(run_redis):
+    proxies = concurrency_proxies()
+
+    async def test(redis):
+        first = await load(redis, 'lease', proxies)
+        await first.release(1)
+        assert await redis.zcard('proxy_1_leases') == 0
+        assert await redis.hget('test_lease_caps', 1) is None
+        second = await load(redis, 'lease', proxies)
+        assert 1 in pool_ids(second)
+    run_redis(test)
+
+
+def test_blocked_lease_frees_the_concurrency(run_redis):
+    proxies = concurrency_proxies()
+
+    async def test(redis):
+        first = await load(redis, 'lease', proxies)
+        plan_id = (set(pool_ids(first)) & {2, 3}).pop()
+        await first.set_as_blocked_list(1, plan_id)
+        assert await redis.zcard('proxy_1_leases') == 0
+        assert await redis.zcard('plan_7_leases') == 0
+        assert await first.get_leased_ids() == {4}
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', ('batched', 'atomic'))
+def test_unuse(run_redis, mode):
+    proxies = concurrency_proxies()
+
+    async def test(redis):
+        first = await load(redis, mode, proxies)
+        await first.unuse(first.checkout_id, *first.pool)
+        assert await first.get_used_ids() == set()
+        assert await redis.zcard('proxy_1_leases') == 0
+        assert await redis.zcard('plan_7_leases') == 0
+        assert await first.get_fresh_ids(*proxies) == {1, 2, 3, 4}
+    run_redis(test)
+
+
+def test_fresh_ids(run_redis):
+    proxies = concurrency_proxies() + [proxy(5, dont_block=True), proxy(6)]
+
+    async def test(redis):
+        proxy_pool = ProxyPool('test', 1, 10, redis)
+        await proxy_pool.set_as_blocked_list(5, 6)
+        await proxy_pool.set_as_used_list(4)
+        await proxy_pool.take_caps(*ProxyPool.get_caps_args({1: proxies[0]}), [1])
+        assert await proxy_pool.get_fresh_ids(*proxies) == {2, 3, 5}
+    run_redis(test)
@@ -0,0 +1,308 @@
+"""
+Proxy catalog tests: load, select, LISTEN/NOTIFY refresh and reconnection
+The database is an in memory fake of the asyncpg pool answering the catalog queries
+"""
+
+import re
+import json
+import asyncio
+
+import asyncpg
+
+from lib.proxies.catalog import ProxyCatalog
+
+
+class Database:
+    '''In memory tables queried by the catalog
+    `failures` queries fail (OSError) before the next one succeeds'''
+
+    def __init__(self):
+        self.failures = 0
+        self.tables = {
+            'proxy_types': [{'id': 1, 'code': 'DC'}, {'id': 2, 'code': 'RES'}],
+            'proxy_locations': [{'id': 1, 'code': 'US'}, {'id': 2, 'code': 'DE'}],
+            'providers': [{'id': 1, 'code': 'P1'}, {'id': 2, 'code': 'P2'}],
+            'provider_plans': [{'id': 1, 'code': 'PL1', 'max_concurrency': 5, 'max_rpm': None}],
+            'proxies': [
+                self.proxy(1, 1, 1, 1, 1),
+                self.proxy(2, 1, 2, 1, None),
+                self.proxy(3, 2, 1, 2, None),
+                self.proxy(4, 1, 1, 2, None, active=False),
+            ],
+            'targets': [{'id': 1, 'identifier': 'example.com'},
+                        {'id': 2, 'identifier': 'example.org'}],
+            # example.org: proxies of provider 2 only
+            'target_providers': [{'target_id': 2, 'provider_id': 2}],
+            'target_provider_plans': [],
+        }
+
+    @staticmethod
+    def proxy(pid, type_id, location_id, provider_id, plan_id, active=True):
+        return {'id': pid, 'proxy_type_id': type_id, 'proxy_location_id': location_id,
+                'provider_id': provider_id, 'provider_plan_id': plan_id, 'active': active}
+
+    def update(self, table, row):
+        self.delete(table, row['id'])
+        self.tables[table].append(row)
+
+    def delete(self, table, row_id):
+        self.tables[table] = [row for row in self.tables[table] if row['id'] != row_id]
+
+    def fetch(self, query, *args):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('Connection refused')
+        values = set(args[0]) if args else None
+        if query.startswith(ProxyCatalog.proxies_query):
+            plans = {plan['id']: plan for plan in self.tables['provider_plans']}
+            rows = []
+            for row in self.tables['proxies']:
+                plan = plans.get(row['provider_plan_id'], {})
+                rows.append(dict(row, plan_max_concurrency=plan.get('max_concurrency'),
+                                 plan_max_rpm=plan.get('max_rpm')))
+            columns, column = '*', 'id'
+        else:
+            match = re.match(r'SELECT (.+) FROM (\w+)(?: WHERE (\w+) = ANY)?', query)
+            columns, table, column = match.groups()
+            rows = self.tables[table]
+        if values is not None:
+            rows = [row for row in rows if row[column] in values]
+        if columns != '*':
+            rows = [{key: row[key] for key in columns.split(', ')} for row in rows]
+        return rows
+
+
+class Connection:
+
+    def __init__(self, database):
+        self.database = database
+
+    async def fetch(self, query, *args):
+        return self.database.fetch(query, *args)
+
+
+class Acquire:
+
+    def __init__(self, database):
+        self.database = database
+
+    async def __aenter__(self):
+        return Connection(self.database)
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class Pool:
+
+    def __init__(self, database):
+        self.database = database
+
+    def acquire(self):
+        return Acquire(self.database)
+
+
+class Listener:
+    '''LISTEN connection'''
+
+    def __init__(self):
+        self.listeners = {}
+        self.termination_listeners = []
+        self.closed = False
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    def remove_termination_listener(self, callback):
+        self.termination_listeners.remove(callback)
+
+    async def close(self):
+        self.closed = True
+
+    def notify(self, payload):
+        self.listeners[ProxyCatalog.channel](self, 1, ProxyCatalog.channel, json.dumps(payload))
+
+    def terminate(self):
+        for callback in self.termination_listeners:
+            callback(self)
+
+
+class Connector:
+    '''asyncpg.connect replacement opening LISTEN connections
+    The next `failures` connections fail (OSError)'''
+
+    def __init__(self):
+        self.listeners = []
+        self.failures = 0
+
+    async def __call__(self, dsn):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('Connection refused')
+        listener = Listener()
+        self.listeners.append(listener)
+        return listener
+
+
+def new_catalog(monkeypatch, database):
+    '''Return a catalog with fast refreshes and retries and its LISTEN connector'''
+    connector = Connector()
+    monkeypatch.setattr(asyncpg, 'connect', connector)
+    catalog = ProxyCatalog(Pool(database), 'postgres://')
+    catalog.flush_delay = 0.01
+    catalog.retry_delay = 0.01
+    return catalog, connector
+
+
+def selected_ids(catalog, target_id, **codes):
+    return sorted(proxy['id'] for proxy in catalog.select(target_id, **codes))
+
+
+async def wait_for(condition, timeout=1.0):
+    '''Wait until `condition()` is true (the catalog refreshes in background)'''
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, 'Timeout'
+        await asyncio.sleep(0.005)
+
+
+def test_load_and_select(monkeypatch):
+    database = Database()
+    catalog, _ = new_catalog(monkeypatch, database)
+
+    async def test():
+        await catalog.start()
+        assert catalog.get_target('example.com')['id'] == 1
+        assert catalog.get_target('unknown') is None
+        # Inactive proxies are excluded
+        assert selected_ids(catalog, 1) == [1, 2, 3]
+        assert selected_ids(catalog, 1, loc='US') == [1, 3]
+        assert selected_ids(catalog, 1, loc='US', type='DC') == [1]
+        assert selected_ids(catalog, 1, plan='PL1') == [1]
+        # Unknown codes are ignored
+        assert selected_ids(catalog, 1, loc='XX', type=None) == [1, 2, 3]
+        # Provider restrictions
+        assert selected_ids(catalog, 2) == [3]
+        assert catalog.proxies[1]['plan_max_concurrency'] == 5
+        await catalog.close()
+    asyncio.run(test())
+
+
+def test_refresh(monkeypatch):
+    database = Database()
+    catalog, connector = new_catalog(monkeypatch, database)
+
+    async def test():
+        await catalog.start()
+        listener = connector.listeners[0]
+        assert selected_ids(catalog, 2) == [3]
+        # Proxy 3 deactivated, proxy 4 activated, proxy 2 removed and proxy 5 added
+        database.update('proxies', Database.proxy(3, 2, 1, 2, None, active=False))
+        database.update('proxies', Database.proxy(4, 1, 1, 2, None))
+        database.delete('proxies', 2)
+        database.update('proxies', Database.proxy(5, 2, 2, 2, None))
+        for pid in (3, 4, 2, 5):
+            listener.notify({'table': 'proxies', 'id': pid, 'target_id': None})
+        await wait_for(lambda: 5 in catalog.proxies)
+        assert selected_ids(catalog, 1) == [1, 4, 5]
+        assert selected_ids(catalog, 2) == [4, 5]
+        assert selected_ids(catalog, 1, loc='DE') == [5]
+        # The position of the removed proxy is reused
+        assert catalog.positions[5] == 1
+        # New restriction of example.com
+        database.tables['target_providers'].append({'target_id': 1, 'provider_id': 1})
+        listener.notify({'table': 'target_providers', 'id': None, 'target_id': 1})
+        await wait_for(lambda: selected_ids(catalog, 1) == [1])
+        # New code and new plan caps (the proxies of the plan carry them)
+        database.tables['proxy_locations'].append({'id': 3, 'code': 'FR'})
+        listener.notify({'table': 'proxy_locations', 'id': 3, 'target_id': None})
+        database.update('provider_plans', {'id': 1, 'code': 'PL1', 'max_concurrency': 10,
+                                           'max_rpm': 60})
+        listener.notify({'table': 'provider_plans', 'id': 1, 'target_id': None})
+        await wait_for(lambda: catalog.proxies[1]['plan_max_rpm'] == 60)
+        assert catalog.get_id_from_code('loc', 'FR') == 3
+        assert catalog.proxies[1]['plan_max_concurrency'] == 10
+        # Target renamed and target removed
+        database.update('targets', {'id': 1, 'identifier': 'example.net'})
+        database.delete('targets', 2)
+        listener.notify({'table': 'targets', 'id': 1, 'target_id': None})
+        listener.notify({'table': 'targets', 'id': 2, 'target_id': None})
+        await wait_for(lambda: catalog.get_target('example.net') is not None)
+        assert catalog.get_target('example.com') is None
+        assert catalog.get_target('example.org') is None
+        await catalog.close()
+    asyncio.run(test())
+
+
+def test_changes_applied_in_batches(monkeypatch):
+    database = Database()
+    catalog, connector = new_catalog(monkeypatch, database)
+    queries = []
+    fetch = database.fetch
+
+    def counted_fetch(query, *args):
+        queries.append(query)
+        return fetch(query, *args)
+
+    async def test():
+        await catalog.start()
+        database.fetch = counted_fetch
+        for pid in (1, 2, 1):
+            connector.listeners[0].notify({'table': 'proxies', 'id': pid, 'target_id': None})
+        await wait_for(lambda: catalog._flush_handle is None and not catalog._pending)
+        await asyncio.sleep(0.02)
+        assert len(queries) == 1
+        # Too many changes: the whole catalog is reloaded
+        catalog.max_pending = 1
+        for pid in (1, 2):
+            connector.listeners[0].notify({'table': 'proxies', 'id': pid, 'target_id': None})
+        await wait_for(lambda: len(queries) > 1)
+        await asyncio.sleep(0.02)
+        assert queries[1] == ProxyCatalog.proxies_query
+        await catalog.close()
+    asyncio.run(test())
+
+
+def test_failed_refresh_is_retried(monkeypatch):
+    database = Database()
+    catalog, connector = new_catalog(monkeypatch, database)
+
+    async def test():
+        await catalog.start()
+        database.update('proxies', Database.proxy(5, 1, 1, 1, None))
+        database.failures = 2
+        connector.listeners[0].notify({'table': 'proxies', 'id': 5, 'target_id': None})
+        await wait_for(lambda: 5 in catalog.proxies)
+        assert database.failures == 0
+        assert not catalog._pending
+        await catalog.close()
+    asyncio.run(test())
+
+
+def test_listener_lost(monkeypatch):
+    database = Database()
+    catalog, connector = new_catalog(monkeypatch, database)
+
+    async def test():
+        await catalog.start()
+        # The changes made while the connection is down are not notified
+        database.delete('proxies', 1)
+        connector.failures = 2
+        database.failures = 1
+        listeners = connector.listeners
+        listeners[0].terminate()
+        await wait_for(lambda: len(listeners) == 2 and 1 not in catalog.proxies)
+        assert connector.failures == 0 and database.failures == 0
+        assert catalog._listener is listeners[1]
+        assert catalog._reconnect_task is None or catalog._reconnect_task.done()
+        # Notifications of the new connection
+        database.update('proxies', Database.proxy(1, 1, 1, 1, 1))
+        listeners[1].notify({'table': 'proxies', 'id': 1, 'target_id': None})
+        await wait_for(lambda: 1 in catalog.proxies)
+        await catalog.close()
+        assert listeners[1].closed and not listeners[1].termination_listeners
+    asyncio.run(test())
@@ -0,0 +1,43 @@
+"""
+Proxy checker tests (scripts/test_proxies.py)
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('asyncpg_connect')
+
+import scripts.test_proxies as checker  # noqa: E402 pylint: disable=wrong-import-position
+
+
+class Connection:
+    '''Connection recording the executed queries'''
+
+    def __init__(self):
+        self.queries = []
+
+    async def execute(self, query, *args):
+        self.queries.append((query, args))
+
+
+class DBSession:
+
+    def __init__(self):
+        self.connection = Connection()
+
+
+def test_not_supported_schemes_are_not_tested():
+    proxies = [{'id': 1, 'url': 'socks5://127.0.0.1:1080'},
+               {'id': 2, 'url': 'socks4://127.0.0.1:1080'},
+               {'id': 3, 'url': 'http://127.0.0.1:1'}]
+
+    async def test():
+        results = await checker.test_proxy_list(proxies, concurrency=2, timeout=2)
+        assert [res['active'] for res in results] == [None, None, False]
+        assert results[2]['check_time'] is not None
+        db_session = DBSession()
+        await checker.save_results(db_session, results)
+        (_, (ids, active, latencies, _)), = db_session.connection.queries
+        assert ids == [3] and active == [False] and latencies == [None]
+    asyncio.run(test())
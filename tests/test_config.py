@@ -0,0 +1,88 @@
+"""
+Config reload tests
+"""
+
+import os
+import shutil
+
+import pytest
+
+from config import Config
+from config import ConfigError
+from api import validate_config
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+CONFIG_EXAMPLE = os.path.join(HERE, '..', 'config.toml.example')
+
+
+def valid_config():
+    return {'api': {'auth_method': 'key', 'api_key': 'key'},
+            'pool': {'length': 10, 'mode': 'batched', 'strategy': 'random', 'refill': 'reset',
+                     'lease_ttl': 300}}
+
+
+def test_valid_config():
+    validate_config(valid_config())
+    config = valid_config()
+    del config['pool']['mode']
+    validate_config(config)
+
+
+@pytest.mark.parametrize('section, key, value', [
+    ('pool', 'length', None),
+    ('pool', 'length', 0),
+    ('pool', 'length', '10'),
+    ('pool', 'length', True),
+    ('pool', 'lease_ttl', -1),
+    ('pool', 'max_lease_ttl', 1.5),
+    ('pool', 'mode', 'unknown'),
+    ('pool', 'strategy', 'unknown'),
+    ('pool', 'refill', 'unknown'),
+    ('api', 'api_key', None),
+])
+def test_not_valid_config(section, key, value):
+    config = valid_config()
+    if value is None:
+        del config[section][key]
+    else:
+        config[section][key] = value
+    with pytest.raises(ConfigError):
+        validate_config(config)
+
+
+@pytest.mark.parametrize('section', ['api', 'pool'])
+def test_missing_section(section):
+    config = valid_config()
+    del config[section]
+    with pytest.raises(ConfigError):
+        validate_config(config)
+
+
+def test_reload(tmp_path):
+    path = str(tmp_path / 'config.toml')
+    shutil.copy(CONFIG_EXAMPLE, path)
+    config = Config(path)
+    length = config['pool']['length']
+    with open(path) as c_f:
+        content = c_f.read()
+    # The pool mode needs a restart
+    with open(path, 'w') as c_f:
+        c_f.write(content.replace('length = {}'.format(length), 'length = 99')
+                  .replace('mode = "{}"'.format(config['pool']['mode']), 'mode = "lease"'))
+    assert config.reload(validate=validate_config)
+    assert config['pool']['length'] == 99
+    assert config['pool']['mode'] != 'lease'
+    # Not valid configs are not applied
+    with open(path, 'w') as c_f:
+        c_f.write(content.replace('length = {}'.format(length), ''))
+    assert not config.reload(validate=validate_config)
+    with open(path, 'w') as c_f:
+        c_f.write(content.replace('[pool]', '[pool_]'))
+    assert not config.reload(validate=validate_config)
+    with open(path, 'w') as c_f:
+        c_f.write('[api')
+    assert not config.reload(validate=validate_config)
+    assert config['pool']['length'] == 99
+    with pytest.raises(TypeError):
+        config['pool']['length'] = 1
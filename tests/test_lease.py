@@ -0,0 +1,138 @@
+"""
+Proxy lease tests: `lease` selection mode (see LEASE_POOL and RENEW_LEASES in
+lib/proxies/scripts.py) and the `lease` parameter of the proxy list
+"""
+
+import time
+
+import pytest
+
+from lib.proxies.pool import ProxyPool
+from api.handlers.proxy_list import get_lease_ttl
+from tests.conftest import proxy
+
+
+class Request:
+    '''Request with a query only'''
+
+    def __init__(self, **query):
+        self.query = query
+
+
+def pool_ids(proxy_pool):
+    return sorted(proxy['id'] for proxy in proxy_pool.pool)
+
+
+async def load(redis, proxies, pool_len=2, lease_ttl=60, **kwargs):
+    proxy_pool = ProxyPool('test', pool_len, 10, redis, lease_ttl=lease_ttl)
+    await proxy_pool.load_leased(*proxies, **kwargs)
+    return proxy_pool
+
+
+def test_disjoint_leases(run_redis):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        first = await load(redis, proxies)
+        second = await load(redis, proxies)
+        assert sorted(pool_ids(first) + pool_ids(second)) == [1, 2, 3, 4]
+        assert await first.get_leased_ids() == {1, 2, 3, 4}
+        assert await redis.zscore('test_leases', 1) > time.time() + 50
+    run_redis(test)
+
+
+def test_released_and_expired_leases(run_redis):
+    proxies = [proxy(pid) for pid in range(1, 4)]
+
+    async def test(redis):
+        first = await load(redis, proxies, pool_len=3)
+        await first.release(1)
+        await redis.zadd('test_leases', time.time() - 1, 2)
+        second = await load(redis, proxies)
+        assert pool_ids(second) == [1, 2]
+    run_redis(test)
+
+
+def test_share_the_oldest_leases(run_redis):
+    proxies = [proxy(1), proxy(2), proxy(3)]
+
+    async def test(redis):
+        now = time.time()
+        await redis.zadd('test_leases', now + 30, 1, now + 10, 2, now + 20, 3)
+        first = await load(redis, proxies, pool_len=1)
+        assert pool_ids(first) == [2]
+        # The shared proxy is leased again
+        assert await redis.zscore('test_leases', 2) > now + 50
+    run_redis(test)
+
+
+def test_blocked_proxies(run_redis):
+    proxies = [proxy(1), proxy(2), proxy(3, dont_block=True)]
+
+    async def test(redis):
+        first = await load(redis, proxies, pool_len=3)
+        # Proxy 1 blocked by another client: not shared even if it is still leased
+        await redis.zadd('test_blocked', time.time() + 100, 1)
+        second = await load(redis, proxies, pool_len=3)
+        assert 1 not in pool_ids(second)
+        # Blocked by this client: the lease is released
+        third = await load(redis, proxies + [proxy(4)], pool_len=1, blocked_ids=[2])
+        assert pool_ids(third) == [4]
+        assert await third.get_blocked_ids() == {1, 2}
+        assert 2 not in await first.get_leased_ids()
+    run_redis(test)
+
+
+def test_blocked_proxies_when_not_enough(run_redis):
+    proxies = [proxy(1), proxy(2)]
+
+    async def test(redis):
+        await redis.zadd('test_blocked', time.time() + 100, 1)
+        first = await load(redis, proxies)
+        assert pool_ids(first) == [1, 2]
+        assert await first.get_blocked_ids() == set()
+    run_redis(test)
+
+
+def test_renew_leases(run_redis):
+    proxies = [proxy(1, max_concurrency=2), proxy(2)]
+
+    async def test(redis):
+        first = await load(redis, proxies, lease_ttl=10)
+        renewed = ProxyPool('test', 2, 10, redis, lease_ttl=100)
+        await renewed.renew_leases(1, 2)
+        now = time.time()
+        assert await redis.zscore('test_leases', 1) > now + 90
+        assert await redis.zscore('test_leases', 2) > now + 90
+        checkout = '{}:1'.format(first.checkout_id)
+        assert await redis.zscore('proxy_1_leases', checkout) > now + 90
+        # A released lease is leased again (ie: a session proxy) but its checkouts are gone
+        await first.release(1)
+        await renewed.renew_leases(1)
+        assert await redis.zscore('test_leases', 1) > now + 90
+        assert await redis.zcard('proxy_1_leases') == 0
+    run_redis(test)
+
+
+def test_shared_lease_keeps_the_checkouts(run_redis):
+    proxies = [proxy(1, max_concurrency=2)]
+
+    async def test(redis):
+        first = await load(redis, proxies, pool_len=1)
+        second = await load(redis, proxies, pool_len=1)
+        assert pool_ids(first) == pool_ids(second) == [1]
+        assert await redis.zcard('proxy_1_leases') == 2
+        await second.release(1)
+        assert await redis.zcard('proxy_1_leases') == 0
+    run_redis(test)
+
+
+def test_lease_ttl_param():
+    pool_config = {'lease_ttl': 300, 'max_lease_ttl': 600}
+    assert get_lease_ttl(Request(), pool_config) == 300
+    assert get_lease_ttl(Request(), {}) == 300
+    assert get_lease_ttl(Request(lease='600'), pool_config) == 600
+    assert get_lease_ttl(Request(lease='3600'), {}) == 3600
+    for lease in ('0', '-5', '601', 'abc', '1.5', ''):
+        with pytest.raises(ValueError):
+            get_lease_ttl(Request(lease=lease), pool_config)
@@ -0,0 +1,161 @@
+"""
+Proxy pool tests: batched and atomic selection modes and refill policies
+"""
+
+import time
+
+import pytest
+
+from lib.proxies.pool import ProxyPool
+from tests.conftest import proxy
+
+
+MODES = ('batched', 'atomic')
+
+
+def pool_ids(proxy_pool):
+    return sorted(proxy['id'] for proxy in proxy_pool.pool)
+
+
+async def load(redis, mode, proxies, pool_len=2, refill='reset', **kwargs):
+    proxy_pool = ProxyPool('test', pool_len, 10, redis, refill=refill)
+    await proxy_pool.loader(mode)(*proxies, **kwargs)
+    return proxy_pool
+
+
+def test_not_valid_mode_and_refill_policy():
+    with pytest.raises(ValueError):
+        ProxyPool('test', 2, 10, None).loader('unknown')
+    with pytest.raises(ValueError):
+        ProxyPool('test', 2, 10, None, refill='unknown')
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_fresh_proxies_first(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        first = await load(redis, mode, proxies)
+        second = await load(redis, mode, proxies)
+        assert len(first.pool) == 2 and len(second.pool) == 2
+        assert not set(pool_ids(first)) & set(pool_ids(second))
+        assert await first.get_used_ids() == {1, 2, 3, 4}
+        assert set(dict(await redis.zrange('test_lru', withscores=True))) == {
+            b'1', b'2', b'3', b'4'}
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_blocked_proxies_excluded(run_redis, mode):
+    proxies = [proxy(1), proxy(2), proxy(3), proxy(4, dont_block=True)]
+
+    async def test(redis):
+        first = await load(redis, mode, proxies, blocked_ids=[1, 2, 4])
+        assert pool_ids(first) == [3, 4]
+        assert await first.get_blocked_ids() == {1, 2, 4}
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_expired_blocks_removed(run_redis, mode):
+    proxies = [proxy(1), proxy(2)]
+
+    async def test(redis):
+        await redis.zadd('test_blocked', time.time() - 1, 1)
+        first = await load(redis, mode, proxies)
+        assert pool_ids(first) == [1, 2]
+        assert await redis.zscore('test_blocked', 1) is None
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_reset_refill(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 4)]
+
+    async def test(redis):
+        await redis.sadd('test_used_list', 1, 2)
+        first = await load(redis, mode, proxies)
+        # The used stack is cleaned: only the new used IDs are kept
+        assert 3 in pool_ids(first) and len(first.pool) == 2
+        assert await first.get_used_ids() == set(pool_ids(first))
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_reset_refill_unblocks(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 4)]
+
+    async def test(redis):
+        now = time.time()
+        await redis.zadd('test_blocked', now + 100, 1, now + 200, 2, now + 300, 3)
+        first = await load(redis, mode, proxies)
+        assert len(first.pool) == 2
+        assert await first.get_blocked_ids() == {1, 2, 3} - set(pool_ids(first))
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_lru_refill(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        await redis.sadd('test_used_list', 1, 2, 3)
+        await redis.zadd('test_lru', 30, 1, 10, 2, 20, 3)
+        first = await load(redis, mode, proxies, refill='lru')
+        # The fresh proxy and the least recently used one
+        assert pool_ids(first) == [2, 4]
+        # The used stack is not cleaned
+        assert await first.get_used_ids() == {1, 2, 3, 4}
+        second = await load(redis, mode, proxies, refill='lru')
+        assert pool_ids(second) == [1, 3]
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_lru_refill_unblocks_oldest_blocks(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 4)]
+
+    async def test(redis):
+        now = time.time()
+        await redis.zadd('test_blocked', now + 300, 1, now + 100, 2, now + 200, 3)
+        first = await load(redis, mode, proxies, pool_len=1, refill='lru')
+        assert pool_ids(first) == [2]
+        assert await first.get_blocked_ids() == {1, 3}
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_partial_refill(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        await redis.sadd('test_used_list', 1, 2, 3)
+        await redis.zadd('test_lru', 30, 1, 10, 2, 20, 3)
+        # Only the fresh proxies are returned
+        first = await load(redis, mode, proxies, refill='partial')
+        assert pool_ids(first) == [4]
+        # No fresh proxies at all: same as lru
+        second = await load(redis, mode, proxies, refill='partial')
+        assert pool_ids(second) == [2, 3]
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_no_proxies(run_redis, mode):
+    async def test(redis):
+        first = await load(redis, mode, [], blocked_ids=[1])
+        assert first.pool == []
+        assert await first.get_blocked_ids() == {1}
+    run_redis(test)
+
+
+def test_migrate_legacy_blocked(run_redis):
+    async def test(redis):
+        proxy_pool = ProxyPool('test', 2, 10, redis)
+        frmt = proxy_pool.legacy_blocked_datetime_frmt
+        await redis.set('test_blocked:1', time.strftime(frmt, time.localtime()))
+        await redis.set('test_blocked:2', time.strftime(frmt, time.localtime(time.time() - 3600)))
+        assert await proxy_pool.migrate_legacy_blocked() == 1
+        assert await proxy_pool.get_blocked_ids() == {1}
+        assert await redis.keys('test_blocked:*') == []
+    run_redis(test)
@@ -0,0 +1,132 @@
+"""
+Proxy pool prewarmer tests
+"""
+
+import time
+
+import pytest
+
+from lib.proxies.prewarm import PoolPrewarmer
+from tests.conftest import proxy
+
+
+TARGET = {'id': 1, 'blocked_standby': 10}
+
+
+def new_prewarmer(redis, proxies, mode='batched', **kwargs):
+    '''Return a prewarmer of the `example.com` target (ID 1) with `proxies`'''
+    async def fetch_proxies(target_identifier, codes):  # pylint: disable=unused-argument
+        if target_identifier != 'example.com':
+            return None, []
+        return TARGET, proxies
+    return PoolPrewarmer(fetch_proxies, redis, mode=mode, **kwargs)
+
+
+async def warm_up(prewarmer, target_identifier='example.com', pool_len=2, requests=3):
+    '''Record `requests` requests in the last second and refill'''
+    prewarmer._last_run = time.time() - 1
+    for _ in range(requests):
+        prewarmer.record(target_identifier, {'loc': None}, pool_len)
+    await prewarmer.refill()
+
+
+@pytest.mark.parametrize('mode', ('batched', 'atomic', 'lease'))
+def test_take(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 11)]
+
+    async def test(redis):
+        prewarmer = new_prewarmer(redis, proxies, mode=mode)
+        assert prewarmer.take('example.com', {}, 2) is None
+        await warm_up(prewarmer)
+        # 3 requests per second: 4 pools of 2 proxies
+        buffer = prewarmer.buffers[PoolPrewarmer.get_key('example.com', {})]
+        assert len(buffer) == 8
+        target_id, pool = prewarmer.take('example.com', {'loc': None}, 2)
+        assert target_id == 1 and len(pool) == 2
+        assert len(buffer) == 6
+        # Only the taken requests are recorded
+        assert prewarmer.take('example.com', {}, 7) is None
+        assert sum(prewarmer.requests.values()) == 1
+        # Every buffered proxy is different
+        ids = [item[2]['id'] for item in buffer] + [pool[0]['id'], pool[1]['id']]
+        assert len(set(ids)) == 8
+    run_redis(test)
+
+
+def test_only_fresh_proxies(run_redis):
+    proxies = [proxy(pid) for pid in range(1, 6)]
+
+    async def test(redis):
+        prewarmer = new_prewarmer(redis, proxies)
+        await redis.zadd('1_blocked', time.time() + 100, 5)
+        await warm_up(prewarmer)
+        # 4 fresh proxies: 2 pools
+        assert len(prewarmer.buffers[PoolPrewarmer.get_key('example.com', {})]) == 4
+        assert set(await redis.smembers('1_used_list')) == {b'1', b'2', b'3', b'4'}
+    run_redis(test)
+
+
+def test_expired_proxies_are_unused(run_redis):
+    proxies = [proxy(pid, max_concurrency=1) for pid in range(1, 5)]
+
+    async def test(redis):
+        prewarmer = new_prewarmer(redis, proxies, max_age=0.01)
+        await warm_up(prewarmer)
+        assert await redis.zcard('proxy_1_leases') == 1
+        time.sleep(0.02)
+        assert prewarmer.take('example.com', {}, 2) is None
+        assert len(prewarmer.expired) == 4
+        # The expired proxies are unused before the refill: they are fresh again
+        prewarmer._last_run = time.time() - 1
+        await prewarmer.refill()
+        assert prewarmer.expired == []
+        assert len(prewarmer.buffers[PoolPrewarmer.get_key('example.com', {})]) == 4
+        for pid in range(1, 5):
+            assert await redis.zcard('proxy_{}_leases'.format(pid)) == 1
+        # Not requested anymore: the buffer is forgotten and the proxies unused
+        prewarmer.rates = {key: 0.1 for key in prewarmer.rates}
+        prewarmer._last_run = time.time() - 1
+        await prewarmer.refill()
+        assert prewarmer.buffers == {} and prewarmer.expired == []
+        assert await redis.smembers('1_used_list') == []
+        assert await redis.zcard('proxy_1_leases') == 0
+    run_redis(test)
+
+
+def test_discard(run_redis):
+    proxies = [proxy(pid, max_concurrency=1) for pid in range(1, 5)]
+
+    async def test(redis):
+        prewarmer = new_prewarmer(redis, proxies)
+        await warm_up(prewarmer, requests=2)
+        prewarmer.discard(1, [1, 2, 3])
+        buffer = prewarmer.buffers[PoolPrewarmer.get_key('example.com', {})]
+        assert [item[2]['id'] for item in buffer] == [4]
+        await prewarmer.unuse_expired()
+        assert await redis.smembers('1_used_list') == [b'4']
+        assert await redis.zcard('proxy_1_leases') == 0
+        assert await redis.zcard('proxy_4_leases') == 1
+    run_redis(test)
+
+
+def test_lease_ttl_and_refill_policy(run_redis):
+    proxies = [proxy(pid, max_concurrency=1) for pid in range(1, 3)]
+    config = {'lease_ttl': 100, 'refill': 'lru'}
+
+    async def test(redis):
+        prewarmer = new_prewarmer(redis, proxies, lease_ttl=lambda: config['lease_ttl'],
+                                  refill=lambda: config['refill'])
+        assert prewarmer.refill_policy == 'lru'
+        config['lease_ttl'] = 500
+        await warm_up(prewarmer)
+        _, score = (await redis.zrange('proxy_1_leases', withscores=True))[0]
+        assert score > time.time() + 490
+    run_redis(test)
+
+
+def test_unknown_target(run_redis):
+    async def test(redis):
+        prewarmer = new_prewarmer(redis, [proxy(1)])
+        await warm_up(prewarmer, target_identifier='unknown')
+        assert prewarmer.buffers == {} and prewarmer.rates == {}
+    run_redis(test)
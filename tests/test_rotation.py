@@ -0,0 +1,102 @@
+"""
+Proxy rotation tests: `ProxyRotation` and NEXT_PROXY (lib/proxies/scripts.py)
+"""
+
+import time
+
+from lib.proxies.rotation import ProxyRotation
+from tests.conftest import proxy
+
+
+async def next_ids(rotation, number):
+    ids = []
+    for _ in range(number):
+        next_proxy = await rotation.next(time.time())
+        ids.append(next_proxy.get('id') if next_proxy is not None else None)
+    return ids
+
+
+def test_round_robin(run_redis):
+    proxies = [proxy(pid, url='http://10.0.0.{}'.format(pid)) for pid in range(1, 4)]
+
+    async def test(redis):
+        rotation = ProxyRotation('test', redis, signature='loc=US')
+        assert await rotation.next(time.time()) is None
+        await rotation.build(*proxies)
+        ids = await next_ids(rotation, 6)
+        assert sorted(ids[:3]) == [1, 2, 3]
+        assert ids[3:] == ids[:3]
+        assert await rotation.next(time.time()) == proxies[ids[0] - 1]
+        assert 50 < await redis.ttl('test_rotation:loc=US') <= 60
+        # Every filter gets its own queue
+        assert await ProxyRotation('test', redis).next(time.time()) is None
+    run_redis(test)
+
+
+def test_empty_queue(run_redis):
+    async def test(redis):
+        rotation = ProxyRotation('test', redis)
+        await rotation.build(proxy(1))
+        await rotation.build()
+        assert await rotation.next(time.time()) is None
+        assert await redis.keys('test_rotation*') == []
+    run_redis(test)
+
+
+def test_blocked_proxies(run_redis):
+    proxies = [proxy(1), proxy(2), proxy(3, dont_block=True)]
+
+    async def test(redis):
+        rotation = ProxyRotation('test', redis)
+        await rotation.build(*proxies)
+        await redis.zadd('test_blocked', time.time() + 100, 1, time.time() + 100, 3)
+        assert set(await next_ids(rotation, 6)) == {2, 3}
+        # Expired blocks
+        await redis.zadd('test_blocked', time.time() - 1, 1)
+        assert set(await next_ids(rotation, 6)) == {1, 2, 3}
+    run_redis(test)
+
+
+def test_every_proxy_blocked(run_redis):
+    async def test(redis):
+        rotation = ProxyRotation('test', redis)
+        await rotation.build(proxy(1), proxy(2))
+        await redis.zadd('test_blocked', time.time() + 100, 1, time.time() + 100, 2)
+        pid = (await rotation.next(time.time()))['id']
+        assert await redis.zrange('test_blocked') == [str(3 - pid).encode()]
+    run_redis(test)
+
+
+def test_caps(run_redis):
+    proxies = [proxy(1, max_concurrency=1), proxy(2, max_rpm=2), proxy(3, max_concurrency=1)]
+
+    async def test(redis):
+        rotation = ProxyRotation('test', redis)
+        await rotation.build(*proxies)
+        assert 50 < await redis.ttl(rotation.caps_key) <= 60
+        ids = await next_ids(rotation, 4)
+        assert sorted(ids) == [1, 2, 2, 3]
+        # Every proxy is at its caps
+        assert await rotation.next(time.time()) == {}
+        assert await redis.zcard('proxy_1_leases') == 1
+        # The checkouts expire after the lease TTL
+        await redis.delete('proxy_1_leases')
+        assert (await rotation.next(time.time()))['id'] == 1
+    run_redis(test)
+
+
+def test_every_proxy_blocked_or_saturated(run_redis):
+    proxies = [proxy(1, max_concurrency=1), proxy(2)]
+
+    async def test(redis):
+        rotation = ProxyRotation('test', redis, lease_ttl=60)
+        await rotation.build(*proxies)
+        await next_ids(rotation, 2)
+        await redis.zadd('test_blocked', time.time() + 100, 1, time.time() + 100, 2)
+        # Proxy 1 is saturated: proxy 2 is unblocked
+        assert (await rotation.next(time.time()))['id'] == 2
+        assert await redis.zrange('test_blocked') == [b'1']
+        # Only a saturated proxy left
+        await rotation.build(proxies[0])
+        assert await rotation.next(time.time()) == {}
+    run_redis(test)
@@ -0,0 +1,44 @@
+"""
+JSON serializer tests: both encoders give the same output
+"""
+
+import json
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from lib import serializer
+
+
+ENCODERS = ['json'] + (['orjson'] if serializer.orjson is not None else [])
+
+
+@pytest.mark.parametrize('encoder', ENCODERS)
+def test_encoder(encoder):
+    dumps = serializer.get_dumps(encoder)
+    content = {
+        'datetime': datetime.datetime(2020, 1, 31, 10, 0, 5, 123),
+        'date': datetime.date(2020, 1, 31),
+        'time': datetime.time(10, 0, 5),
+        'decimal': Decimal('1.5'),
+        'set': {1},
+        'nested': [{'datetime': datetime.datetime(2020, 1, 31)}],
+    }
+    assert json.loads(dumps(content)) == {
+        'datetime': '2020-01-31 10:00:05',
+        'date': '2020-01-31',
+        'time': '10:00:05',
+        'decimal': 1.5,
+        'set': [1],
+        'nested': [{'datetime': '2020-01-31 00:00:00'}],
+    }
+    assert json.loads(dumps({1: 'a'})) == {'1': 'a'}
+    with pytest.raises(TypeError):
+        dumps({'object': object()})
+
+
+def test_default_encoder():
+    assert serializer.get_dumps() is serializer.json_dumps
+    with pytest.raises(ValueError):
+        serializer.get_dumps('unknown')
@@ -0,0 +1,120 @@
+"""
+Sticky session tests: `ProxyPool.load_session` and PIN_SESSION (lib/proxies/scripts.py)
+"""
+
+import time
+import asyncio
+
+import pytest
+
+from lib.proxies.pool import ProxyPool
+from tests.conftest import proxy
+
+
+MODES = ('batched', 'atomic', 'lease')
+
+
+async def load_session(redis, mode, proxies, session='s1', **kwargs):
+    '''Return the ID of the session proxy (None if there is no proxy)'''
+    proxy_pool = ProxyPool('test', 1, 10, redis, lease_ttl=60)
+    await proxy_pool.load_session(session, 120, *proxies, mode=mode, **kwargs)
+    assert len(proxy_pool.pool) <= 1
+    return proxy_pool.pool[0]['id'] if proxy_pool.pool else None
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_same_proxy(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        pid = await load_session(redis, mode, proxies)
+        for _ in range(3):
+            assert await load_session(redis, mode, proxies) == pid
+        assert int(await redis.get('test_session:s1')) == pid
+        assert 110 < await redis.ttl('test_session:s1') <= 120
+        assert await load_session(redis, mode, proxies, session='s2') != pid
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_blocked_proxy(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        pid = await load_session(redis, mode, proxies)
+        new_pid = await load_session(redis, mode, proxies, blocked_ids=[pid])
+        assert new_pid not in (None, pid)
+        assert int(await redis.get('test_session:s1')) == new_pid
+        # Blocked by another client
+        await redis.zadd('test_blocked', time.time() + 100, new_pid)
+        assert await load_session(redis, mode, proxies) not in (None, pid, new_pid)
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_dont_block_proxy(run_redis, mode):
+    proxies = [proxy(1, dont_block=True)]
+
+    async def test(redis):
+        assert await load_session(redis, mode, proxies) == 1
+        await redis.zadd('test_blocked', time.time() + 100, 1)
+        assert await load_session(redis, mode, proxies) == 1
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_proxy_not_available(run_redis, mode):
+    proxies = [proxy(1), proxy(2)]
+
+    async def test(redis):
+        await redis.set('test_session:s1', 3)
+        assert await load_session(redis, mode, proxies) in (1, 2)
+        assert await load_session(redis, mode, []) is None
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_proxy_at_its_rpm(run_redis, mode):
+    proxies = [proxy(pid, max_rpm=2) for pid in range(1, 4)]
+
+    async def test(redis):
+        pids = [await load_session(redis, mode, proxies) for _ in range(3)]
+        assert pids[0] == pids[1]
+        assert pids[2] not in (None, pids[0])
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', ('batched', 'atomic'))
+def test_proxy_at_its_concurrency(run_redis, mode):
+    proxies = [proxy(pid, max_concurrency=1) for pid in range(1, 4)]
+
+    async def test(redis):
+        pids = [await load_session(redis, mode, proxies) for _ in range(2)]
+        assert pids[1] not in (None, pids[0])
+    run_redis(test)
+
+
+def test_lease_holds_the_concurrency(run_redis):
+    proxies = [proxy(pid, max_concurrency=1) for pid in range(1, 4)]
+
+    async def test(redis):
+        pid = await load_session(redis, 'lease', proxies)
+        await redis.zadd('test_leases', time.time() + 5, pid)
+        assert await load_session(redis, 'lease', proxies) == pid
+        # Renewed lease, and the cap checkout is not taken twice
+        assert await redis.zscore('test_leases', pid) > time.time() + 50
+        assert await redis.zcard('proxy_{}_leases'.format(pid)) == 1
+    run_redis(test)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_concurrent_new_session(run_redis, mode):
+    proxies = [proxy(pid) for pid in range(1, 5)]
+
+    async def test(redis):
+        pids = await asyncio.gather(*[load_session(redis, mode, proxies) for _ in range(4)])
+        assert len(set(pids)) == 1
+        if mode == 'lease':
+            # The proxies loaded by the requests that lost the race are released
+            assert await ProxyPool('test', 1, 10, redis).get_leased_ids() == set(pids)
+    run_redis(test)
@@ -0,0 +1,89 @@
+"""
+Worker supervisor tests. The workers are forked processes and the signals are real
+"""
+
+import os
+import time
+import signal
+import threading
+
+import pytest
+
+from lib.workers import WorkerSupervisor
+
+
+MASTER_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR2)
+
+
+@pytest.fixture(autouse=True)
+def master_signals():
+    '''Restore the signal handlers set by the supervisor'''
+    handlers = {signum: signal.getsignal(signum) for signum in MASTER_SIGNALS}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def send_signals(*signals, delay: float = 0.5):
+    '''Send the signals to this process (the master) one after the other'''
+    def send():
+        for signum in signals:
+            time.sleep(delay)
+            os.kill(os.getpid(), signum)
+    thread = threading.Thread(target=send, daemon=True)
+    thread.start()
+    return thread
+
+
+def listening_worker(starts_dir):
+    '''Return a worker recording its start in `starts_dir` and listening until stopped'''
+    def worker(notify_ready):
+        with open(os.path.join(starts_dir, str(os.getpid())), 'w'):
+            pass
+        notify_ready()
+        while True:
+            time.sleep(0.05)
+    return worker
+
+
+def test_respawn_delay():
+    supervisor = WorkerSupervisor(None, respawn_delay=1.0)
+    assert supervisor.get_respawn_delay() == 1.0
+    supervisor.boot_failures = 1
+    assert supervisor.get_respawn_delay() == 1.0
+    supervisor.boot_failures = 3
+    assert supervisor.get_respawn_delay() == 4.0
+    supervisor.boot_failures = 20
+    assert supervisor.get_respawn_delay() == supervisor.max_respawn_delay
+
+
+@pytest.mark.parametrize('failure', ['exception', 'exit'])
+def test_boot_failures(failure):
+    def worker(notify_ready):  # pylint: disable=unused-argument
+        if failure == 'exit':
+            raise SystemExit(0)
+        raise RuntimeError('Database down')
+    supervisor = WorkerSupervisor(worker, workers=2, respawn_delay=0.01, max_boot_failures=3)
+    assert supervisor.run() == 1
+    assert supervisor.boot_failures >= 3
+    assert not supervisor.pids
+
+
+def test_shutdown_and_config_reload(tmp_path):
+    supervisor = WorkerSupervisor(listening_worker(str(tmp_path)), workers=2,
+                                  shutdown_timeout=5)
+    # The workers ignore SIGHUP until the app handles it
+    send_signals(signal.SIGHUP, signal.SIGTERM)
+    assert supervisor.run() == 0
+    assert not supervisor.pids
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert supervisor.boot_failures == 0
+
+
+def test_rolling_restart(tmp_path):
+    supervisor = WorkerSupervisor(listening_worker(str(tmp_path)), workers=2,
+                                  shutdown_timeout=5)
+    send_signals(signal.SIGUSR2, signal.SIGTERM, delay=1.0)
+    assert supervisor.run() == 0
+    assert not supervisor.pids
+    assert len(os.listdir(str(tmp_path))) == 4